@@ -0,0 +1,146 @@
+"""
+Micro-benchmark for the embeds of hot responses.
+
+Compares the previous way of building the "Added to queue", now playing and
+queue page embeds (formatting every field on every call, strptime for upload
+dates) with the display text formatted once per track and the now playing
+template rendered once per song.
+
+Run from the repository root:
+    python benchmarks/bench_embeds.py [runs]
+"""
+import io
+import os
+import sys
+import timeit
+from datetime import datetime
+from types import SimpleNamespace
+
+import discord
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from music_player import MusicPlayer, Track, TrackQueue, YTDLSource
+
+REQUESTER = SimpleNamespace(mention='<@123456789012345678>')
+
+
+def fake_info(index):
+    video_id = f'video{index:06d}'
+    return {
+        'id': video_id,
+        'title': f'Some popular song number {index}',
+        'webpage_url': f'https://www.youtube.com/watch?v={video_id}',
+        'duration': 215,
+        'thumbnail': f'https://i.ytimg.com/vi/{video_id}/maxresdefault.jpg',
+        'uploader': 'Some Artist',
+        'uploader_url': 'https://www.youtube.com/@someartist',
+        'upload_date': '20230101',
+        'view_count': 123456789,
+    }
+
+
+# Previous implementations, as they were in create_source, player_loop and the queue command
+
+def old_queued_embed(data, requester):
+    embed = discord.Embed(
+        title="✅ Added to queue",
+        description=f"[{data['title']}]({data['webpage_url']})",
+        color=discord.Color.green()
+    )
+    if data.get('thumbnail'):
+        embed.set_thumbnail(url=data['thumbnail'])
+    embed.add_field(name="Duration", value=YTDLSource.format_duration(data.get('duration', 0)), inline=True)
+    embed.add_field(name="Uploader", value=data.get('uploader', 'Unknown'), inline=True)
+    embed.add_field(name="Requested by", value=requester.mention, inline=True)
+    if data.get('view_count'):
+        embed.add_field(name="Views", value=f"{data['view_count']:,}", inline=True)
+    if data.get('upload_date'):
+        try:
+            upload_date = datetime.strptime(data['upload_date'], '%Y%m%d')
+            embed.add_field(name="Uploaded", value=upload_date.strftime('%Y-%m-%d'), inline=True)
+        except ValueError:
+            pass
+    return embed
+
+
+def old_now_playing_embed(player):
+    source = player.current
+    embed = discord.Embed(
+        title="🎵 Now playing",
+        description=f"[{source.title}]({source.web_url})",
+        color=discord.Color.blue()
+    )
+    embed.set_thumbnail(url=source.thumbnail or '')
+    fields = [
+        ("Duration", YTDLSource.format_duration(source.duration), True),
+        ("Requested by", source.requester.mention, True),
+        ("Uploader", f"[{source.uploader}]({source.uploader_url})" if source.uploader_url else source.uploader, True),
+        ("Volume", f"{int(source.volume * 100)}%", True),
+        ("Repeat", player.repeat_mode.upper(), True),
+        ("Queue", f"{player.queue.qsize()} songs", True)
+    ]
+    for name, value, inline in fields:
+        embed.add_field(name=name, value=value, inline=inline)
+    bar, time_display = YTDLSource.format_progress(source.position, source.duration)
+    embed.add_field(name="Progress", value=f"```{bar}```{time_display}", inline=False)
+    return embed
+
+
+def old_queue_page(queue):
+    queue_text = []
+    for idx, song in enumerate(queue.page(0, 10), start=1):
+        duration = YTDLSource.format_duration(song.duration)
+        queue_text.append(f'**{idx}.** [{song.title}]({song.webpage_url}) | `{duration}` | {song.requester.mention}')
+    return discord.Embed(title='📋 Queue', description='\n'.join(queue_text), color=discord.Color.green())
+
+
+def new_queue_page(queue):
+    queue_text = [f'**{idx}.** {song.display.queue_entry}' for idx, song in enumerate(queue.page(0, 10), start=1)]
+    return discord.Embed(title='📋 Queue', description='\n'.join(queue_text), color=discord.Color.green())
+
+
+def make_player():
+    """A MusicPlayer with a song half way through, without a bot or a player loop"""
+    player = MusicPlayer.__new__(MusicPlayer)
+    player.repeat_mode = 'off'
+    player.queue = TrackQueue()
+    for index in range(20):
+        player.queue.put_nowait(Track.from_info(fake_info(index), REQUESTER))
+    player._np_template = None
+
+    track = Track.from_info(fake_info(100), REQUESTER)
+    player.current = YTDLSource(discord.PCMAudio(io.BytesIO()), track=track)
+    player.current.frames_read = 5000
+    return player
+
+
+def bench(label, stmt, number):
+    seconds = timeit.timeit(stmt, number=number)
+    print(f"  {label:<12} {seconds / number * 1e6:8.1f} us/embed {number / seconds:10.0f} embeds/s")
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    data = fake_info(0)
+    track = Track.from_info(data, REQUESTER)
+    player = make_player()
+
+    def queued():
+        # The display text is formatted once when the track is created
+        track._display = None
+        return YTDLSource.queued_embed(track)
+
+    print(f"Runs: {runs}")
+    print("Formatted on every call:")
+    bench('queued', lambda: old_queued_embed(data, REQUESTER), runs)
+    bench('now playing', lambda: old_now_playing_embed(player), runs)
+    bench('queue page', lambda: old_queue_page(player.queue), runs)
+
+    print("Display text and now playing template:")
+    bench('queued', queued, runs)
+    bench('now playing', player.now_playing_embed, runs)
+    bench('queue page', lambda: new_queue_page(player.queue), runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Time-to-first-audio-frame for each FFmpeg profile.
+
+Opens the same song with every profile in FFMPEG_PROFILES and reports how long
+FFmpeg takes to produce its first 20 ms frame. Needs FFmpeg on the PATH, and
+network access for URLs. The running bot reports the same measurement for real
+songs with the profile command.
+
+Run from the repository root:
+    python benchmarks/bench_ffmpeg_profiles.py <URL, search or file> [runs]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from music_player import FFMPEG_PROFILES, Track, YTDLSource, ytdl
+
+
+def load_track(query):
+    if os.path.exists(query):
+        track = Track(title=os.path.basename(query), webpage_url=query, requester=None)
+        track.set_local(query)
+        return track
+
+    data = ytdl.extract_info(query, download=False)
+    if 'entries' in data:
+        data = data['entries'][0]
+    return Track.from_info(data, None)
+
+
+async def first_frame(track, profile):
+    started = time.perf_counter()
+    # Below 100% volume so only profiles that copy Opus skip the PCM path
+    source = await YTDLSource.open_track(track, volume=0.5, profile=profile)
+    try:
+        if not source.read():
+            raise RuntimeError(f'FFmpeg produced no audio with profile {profile}')
+        return time.perf_counter() - started
+    finally:
+        source.cleanup()
+
+
+async def run(query, runs):
+    track = load_track(query)
+    print(f"Song: {track.title} ({track.codec or 'unknown codec'})")
+    print(f"Runs per profile: {runs}")
+
+    for profile in FFMPEG_PROFILES:
+        times = [await first_frame(track, profile) for _ in range(runs)]
+        print(f"  {profile:<12} median {statistics.median(times) * 1000:7.0f} ms"
+              f"   min {min(times) * 1000:7.0f} ms   max {max(times) * 1000:7.0f} ms")
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    asyncio.run(run(sys.argv[1], runs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Micro-benchmark for queue operations.
+
+Compares the previous approach (copying ``asyncio.Queue._queue`` into a list,
+mutating it and re-appending every element) with TrackQueue.
+
+Run from the repository root:
+    python benchmarks/bench_queue.py [entries]
+"""
+import asyncio
+import itertools
+import os
+import random
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from music_player import Track, TrackQueue
+
+
+def make_tracks(count):
+    return [Track(title=f'Song {n}', webpage_url=f'https://example.com/{n}', requester=None, duration=200)
+            for n in range(count)]
+
+
+# Previous implementations, as they were in the queue commands
+
+def old_remove(queue, index):
+    queue_list = list(queue._queue)
+    removed = queue_list.pop(index)
+    queue._queue.clear()
+    for song in queue_list:
+        queue._queue.append(song)
+    queue._queue.append(removed)  # Keep the size constant between runs
+
+
+def old_move(queue, from_index, to_index):
+    queue_list = list(queue._queue)
+    song = queue_list.pop(from_index)
+    queue_list.insert(to_index, song)
+    queue._queue.clear()
+    for song in queue_list:
+        queue._queue.append(song)
+
+
+def old_shuffle(queue):
+    queue_list = list(queue._queue)
+    random.shuffle(queue_list)
+    queue._queue.clear()
+    for song in queue_list:
+        queue._queue.append(song)
+
+
+def old_page(queue, start, end):
+    queue_list = list(itertools.islice(queue._queue, 0, queue.qsize()))
+    total = sum(song.duration for song in queue_list)
+    return queue_list[start:end], total
+
+
+def new_remove(queue, index):
+    queue.put_nowait(queue.remove(index))
+
+
+def new_page(queue, start, end):
+    return queue.page(start, end), queue.total_duration
+
+
+def bench(label, stmt, number):
+    seconds = timeit.timeit(stmt, number=number)
+    print(f"  {label:<10} {seconds / number * 1e6:12.1f} us/op")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    tracks = make_tracks(count)
+    middle = count // 2
+    last_page = count - 10
+
+    old = asyncio.Queue()
+    for track in tracks:
+        old.put_nowait(track)
+
+    new = TrackQueue()
+    for track in tracks:
+        new.put_nowait(track)
+
+    print(f"Entries: {count}")
+    print("asyncio.Queue + list rebuild:")
+    bench('remove', lambda: old_remove(old, middle), 200)
+    bench('move', lambda: old_move(old, 0, middle), 200)
+    bench('shuffle', lambda: old_shuffle(old), 50)
+    bench('page', lambda: old_page(old, last_page, count), 200)
+    bench('put+get', lambda: (old.put_nowait(old.get_nowait())), 100000)
+
+    print("TrackQueue:")
+    bench('remove', lambda: new_remove(new, middle), 200)
+    bench('move', lambda: new.move(0, middle), 200)
+    bench('shuffle', new.shuffle, 50)
+    bench('page', lambda: new_page(new, last_page, count), 200)
+    bench('put+get', lambda: (new.put_nowait(new.get_nowait())), 100000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Memory benchmark for queue entries.
+
+Compares the per-entry footprint of the old queue entry (a dict holding the
+complete yt-dlp info dict under 'data') with the slotted Track record.
+
+Run from the repository root:
+    python benchmarks/bench_track_memory.py [entries]
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from music_player import Track, slim_info
+
+
+def fake_info(index):
+    """Build an info dict shaped like a real yt-dlp extraction result"""
+    video_id = f'video{index:06d}'
+    return {
+        'id': video_id,
+        'title': f'Some popular song number {index}',
+        'webpage_url': f'https://www.youtube.com/watch?v={video_id}',
+        'url': f'https://rr1.googlevideo.com/videoplayback?expire=1700000000&id={video_id}&' + 'x' * 600,
+        'duration': 215,
+        'thumbnail': f'https://i.ytimg.com/vi/{video_id}/maxresdefault.jpg',
+        'uploader': 'Some Artist',
+        'uploader_url': 'https://www.youtube.com/@someartist',
+        'upload_date': '20230101',
+        'view_count': 123456789,
+        'like_count': 1234567,
+        'description': 'Lyrics, credits and links. ' * 150,
+        'tags': [f'tag{n}' for n in range(30)],
+        'thumbnails': [{'url': f'https://i.ytimg.com/vi/{video_id}/{n}.jpg', 'width': 120 * n,
+                        'height': 90 * n, 'id': str(n)} for n in range(40)],
+        'formats': [{'format_id': str(n), 'url': f'https://rr1.googlevideo.com/{video_id}/{n}?' + 'y' * 600,
+                     'ext': 'webm', 'acodec': 'opus', 'vcodec': 'none', 'abr': 160,
+                     'http_headers': {'User-Agent': 'Mozilla/5.0', 'Accept': '*/*'},
+                     'fragments': [{'url': f'seg{k}', 'duration': 5.0} for k in range(10)]}
+                    for n in range(25)],
+        'automatic_captions': {lang: [{'ext': 'vtt', 'url': 'https://example.com/' + 'z' * 300}]
+                               for lang in ('en', 'de', 'fr', 'es', 'it', 'ja')},
+    }
+
+
+def measure(build, count):
+    """Return the bytes allocated per entry by ``build``"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    entries = [build(index) for index in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    assert len(entries) == count
+    return allocated / count
+
+
+def old_entry(index):
+    """Queue entry as returned by create_source before Track existed"""
+    data = fake_info(index)
+    return {'webpage_url': data['webpage_url'], 'requester': None, 'title': data['title'],
+            'thumbnail': data.get('thumbnail'), 'duration': data.get('duration', 0),
+            'uploader': data.get('uploader', 'Unknown'), 'data': data}
+
+
+def track_entry(index):
+    """Queue entry as returned by create_source now (the full dict is dropped)"""
+    return Track.from_info(slim_info(fake_info(index)), None)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    old = measure(old_entry, count)
+    new = measure(track_entry, count)
+
+    print(f"Entries: {count}")
+    print(f"dict + full info:  {old / 1024:10.1f} KB per entry")
+    print(f"Track:             {new / 1024:10.1f} KB per entry")
+    print(f"Reduction:         {old / new:10.1f}x")
+
+
+if __name__ == '__main__':
+    main()
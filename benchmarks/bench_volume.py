@@ -0,0 +1,55 @@
+"""
+Micro-benchmark for the volume stage.
+
+Compares the per-frame cost of discord.PCMVolumeTransformer with
+GainTransformer at unity gain, at a reduced volume and with a normalization
+boost. One frame is 20 ms of audio, so a voice
+connection reads 50 frames per second.
+
+Run from the repository root:
+    python benchmarks/bench_volume.py [frames]
+"""
+import os
+import sys
+import timeit
+
+import discord
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from music_player import GainTransformer
+
+
+class LoopingSource(discord.AudioSource):
+    """Returns the same noisy PCM frame forever"""
+
+    def __init__(self):
+        self.frame = os.urandom(discord.opus.Encoder.FRAME_SIZE)
+
+    def read(self):
+        return self.frame
+
+
+def bench(label, transformer, number):
+    seconds = timeit.timeit(transformer.read, number=number)
+    print(f"  {label:<28} {seconds / number * 1e6:8.2f} us/frame")
+
+
+def run(number):
+    bench('PCMVolumeTransformer 50%', discord.PCMVolumeTransformer(LoopingSource(), volume=0.5), number)
+    bench('GainTransformer 100%', GainTransformer(LoopingSource(), volume=1.0), number)
+    bench('GainTransformer 50%', GainTransformer(LoopingSource(), volume=0.5), number)
+
+    boosted = GainTransformer(LoopingSource(), volume=1.0)
+    boosted.gain_db = 4.0
+    bench('GainTransformer 100% +4 dB', boosted, number)
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    print(f"Frames: {number}")
+    run(number)
+
+
+if __name__ == '__main__':
+    main()
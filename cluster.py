@@ -0,0 +1,345 @@
+"""
+Cluster mode: run the bot's shards across several processes.
+
+The launcher splits the shards into contiguous ranges and starts one worker
+process per range, so the gateway, voice and audio work of each range gets a
+core of its own. Workers connect back to the launcher over a local
+``multiprocessing.connection`` socket authenticated with a random key. The
+launcher uses it for health checks and restarts, and workers use it to gather
+stats from every process and to broadcast owner commands (shutdown, reload).
+"""
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+from functools import partial
+from multiprocessing.connection import Client, Listener
+
+logger = logging.getLogger('discord_bot.cluster')
+
+HEALTH_INTERVAL = int(os.getenv('CLUSTER_HEALTH_INTERVAL', '15'))  # Seconds between health checks
+HEALTH_TIMEOUT = int(os.getenv('CLUSTER_HEALTH_TIMEOUT', '120'))  # Restart workers silent for this long
+REQUEST_TIMEOUT = 10  # Seconds the launcher waits for workers to answer a request
+SHUTDOWN_TIMEOUT = 30  # Seconds workers get to disconnect before they are terminated
+IDENTIFY_INTERVAL = 5  # Discord allows one shard to identify every 5 seconds
+
+
+def shard_ranges(shard_count, processes):
+    """Split shard IDs 0 to shard_count - 1 into at most ``processes`` contiguous ranges"""
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        end = start + size + (index < extra)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+def worker_main(cluster_id, shard_ids, shard_count, address, authkey):
+    """Entry point of a worker process: run the bot for one range of shards"""
+    # main.py reads its configuration when it is imported, and only builds the
+    # bot in main(), so the copy spawn already ran as __mp_main__ has none
+    os.environ['SHARD_COUNT'] = str(shard_count)
+    os.environ['SHARD_IDS'] = ','.join(map(str, shard_ids))
+    os.environ['CLUSTER_ID'] = str(cluster_id)
+    os.environ['CLUSTER_ADDRESS'] = f'{address[0]}:{address[1]}'
+    os.environ['CLUSTER_AUTHKEY'] = authkey.hex()
+
+    import main
+    try:
+        asyncio.run(main.main())
+    except KeyboardInterrupt:
+        pass  # Ctrl+C reaches every process; the launcher does the reporting
+
+
+class Worker:
+    """Launcher-side state of one worker process"""
+
+    def __init__(self, cluster_id, shard_ids):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process = None
+        self.conn = None
+        self.connected = False  # Whether the current process has connected yet
+        self.last_seen = 0.0
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        conn = self.conn
+        if conn is None:
+            return False
+        try:
+            with self._lock:
+                conn.send(message)
+            return True
+        except (OSError, ValueError):
+            return False
+
+
+class ClusterLauncher:
+    """Starts the worker processes and relays requests between them"""
+
+    def __init__(self, processes, shard_count):
+        self.shard_count = shard_count
+        self.workers = [Worker(cluster_id, shard_ids)
+                        for cluster_id, shard_ids in enumerate(shard_ranges(shard_count, processes))]
+        self.authkey = secrets.token_bytes(32)
+        self.listener = Listener(('127.0.0.1', 0), authkey=self.authkey)
+        self.address = self.listener.address
+        self.stopping = threading.Event()
+        self._pending = {}  # Request ID -> replies being collected
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def serve(self):
+        """Start accepting worker connections in the background"""
+        threading.Thread(target=self._accept, name='cluster-accept', daemon=True).start()
+
+    def run(self):
+        """Run the cluster until it is shut down"""
+        self.serve()
+        logger.info(f"Starting {len(self.workers)} processes for {self.shard_count} shards")
+        try:
+            for worker in self.workers:
+                self._start(worker)
+                # Keep the processes from identifying their shards all at once
+                if self.stopping.wait(IDENTIFY_INTERVAL * len(worker.shard_ids)):
+                    break
+            while not self.stopping.wait(HEALTH_INTERVAL):
+                self._check_health()
+        except KeyboardInterrupt:
+            self.stopping.set()  # The workers got the Ctrl+C as well
+
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            worker.process.join(SHUTDOWN_TIMEOUT)
+            if worker.process.is_alive():
+                logger.warning(f"Cluster {worker.cluster_id} did not stop in time, terminating it")
+                worker.process.terminate()
+        self.listener.close()
+        logger.info("Cluster has shut down")
+
+    def stop(self):
+        """Shut every worker down and stop restarting them"""
+        if self.stopping.is_set():
+            return
+        logger.info("Shutting the cluster down")
+        self.stopping.set()
+        self.broadcast('shutdown')
+
+    def broadcast(self, op, args=None, timeout=REQUEST_TIMEOUT):
+        """Run ``op`` on every connected worker; returns {cluster ID: result or None}"""
+        request_id = next(self._ids)
+        pending = {'event': threading.Event(), 'replies': {}, 'expected': set()}
+        with self._lock:
+            self._pending[request_id] = pending
+
+        message = {'op': op, 'id': request_id, 'args': args or {}}
+        for worker in self.workers:
+            if worker.send(message):
+                with self._lock:
+                    pending['expected'].add(worker.cluster_id)
+        with self._lock:
+            if pending['expected'] <= pending['replies'].keys():
+                pending['event'].set()
+
+        pending['event'].wait(timeout)
+        with self._lock:
+            del self._pending[request_id]
+        return {worker.cluster_id: pending['replies'].get(worker.cluster_id) for worker in self.workers}
+
+    def _start(self, worker):
+        context = multiprocessing.get_context('spawn')
+        worker.process = context.Process(
+            target=worker_main,
+            args=(worker.cluster_id, worker.shard_ids, self.shard_count, self.address, self.authkey),
+            name=f'cluster-{worker.cluster_id}',
+        )
+        worker.connected = False
+        worker.last_seen = time.monotonic()
+        worker.process.start()
+        logger.info(f"Started cluster {worker.cluster_id} (pid {worker.process.pid}) "
+                    f"with shards {worker.shard_ids[0]}-{worker.shard_ids[-1]}")
+
+    def _check_health(self):
+        self.broadcast('ping')  # Replies refresh last_seen
+        now = time.monotonic()
+        for worker in self.workers:
+            if not worker.process.is_alive():
+                if not worker.connected:
+                    # Most likely a configuration problem such as a bad token
+                    logger.error(f"Cluster {worker.cluster_id} exited before it started, stopping the cluster")
+                    self.stop()
+                    return
+                logger.warning(f"Cluster {worker.cluster_id} exited with code {worker.process.exitcode}, restarting it")
+                self._start(worker)
+            elif now - worker.last_seen > HEALTH_TIMEOUT:
+                logger.warning(f"Cluster {worker.cluster_id} stopped answering health checks, restarting it")
+                worker.process.terminate()
+                worker.process.join(SHUTDOWN_TIMEOUT)
+                self._start(worker)
+
+    def _accept(self):
+        while not self.stopping.is_set():
+            try:
+                conn = self.listener.accept()
+                hello = conn.recv()
+                worker = self.workers[hello['cluster_id']]
+            except (OSError, EOFError, multiprocessing.AuthenticationError, KeyError, IndexError, TypeError) as e:
+                if not self.stopping.is_set():
+                    logger.warning(f"Rejected a cluster connection: {e}")
+                continue
+
+            worker.conn = conn
+            worker.connected = True
+            worker.last_seen = time.monotonic()
+            threading.Thread(target=self._serve_worker, args=(worker, conn),
+                             name=f'cluster-{worker.cluster_id}-ipc', daemon=True).start()
+
+    def _serve_worker(self, worker, conn):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            worker.last_seen = time.monotonic()
+
+            if message['op'] == 'reply':
+                self._on_reply(worker, message)
+            elif message['op'] == 'request':
+                # Requests wait for the other workers, so they get a thread of their own
+                threading.Thread(target=self._on_request, args=(worker, message), daemon=True).start()
+
+        if worker.conn is conn:
+            worker.conn = None
+        conn.close()
+
+    def _on_reply(self, worker, message):
+        with self._lock:
+            pending = self._pending.get(message['id'])
+            if pending is None:
+                return  # Too late, the request already timed out
+            pending['replies'][worker.cluster_id] = message['data']
+            if pending['expected'] <= pending['replies'].keys():
+                pending['event'].set()
+
+    def _on_request(self, worker, message):
+        if message['action'] == 'shutdown':
+            logger.info(f"Cluster {worker.cluster_id} asked for a shutdown")
+            self.stop()
+            return
+        data = self.broadcast(message['action'], message['args'])
+        if message['id'] is not None:
+            worker.send({'op': 'reply', 'id': message['id'], 'data': data})
+
+
+class ClusterClient:
+    """Worker-side end of the IPC channel, used by the bot of a worker process"""
+
+    def __init__(self, bot, cluster_id, address, authkey):
+        self.bot = bot
+        self.cluster_id = cluster_id
+        self.address = address
+        self.authkey = authkey
+        self.conn = None
+        self.loop = None
+        self._pending = {}  # Request ID -> future of the reply
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.conn = await self.loop.run_in_executor(None, partial(Client, self.address, authkey=self.authkey))
+        self._send({'op': 'hello', 'cluster_id': self.cluster_id})
+        threading.Thread(target=self._read, name='cluster-ipc', daemon=True).start()
+        logger.info(f"Cluster {self.cluster_id} connected to the launcher")
+
+    def close(self):
+        self._closed = True
+        if self.conn is not None:
+            self.conn.close()
+
+    async def request(self, action, timeout=REQUEST_TIMEOUT + 5, **args):
+        """Run ``action`` on every process of the cluster; returns {cluster ID: result or None}"""
+        request_id = next(self._ids)
+        future = self.loop.create_future()
+        self._pending[request_id] = future
+        try:
+            self._send({'op': 'request', 'id': request_id, 'action': action, 'args': args})
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    def notify(self, action, **args):
+        """Ask the launcher to run ``action`` without waiting for the result"""
+        self._send({'op': 'request', 'id': None, 'action': action, 'args': args})
+
+    def _send(self, message):
+        if self.conn is None:
+            raise ConnectionError("Not connected to the cluster launcher")
+        with self._lock:
+            self.conn.send(message)
+
+    def _read(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError, TypeError):
+                break  # TypeError: close() was called while waiting
+            if message['op'] == 'reply':
+                self.loop.call_soon_threadsafe(self._resolve, message)
+            else:
+                asyncio.run_coroutine_threadsafe(self._handle(message), self.loop)
+
+        if not self._closed:
+            # Without a launcher nothing restarts or stops this process
+            logger.error("Lost the connection to the cluster launcher, shutting down")
+            asyncio.run_coroutine_threadsafe(self.bot.close(), self.loop)
+
+    def _resolve(self, message):
+        future = self._pending.get(message['id'])
+        if future is not None and not future.done():
+            future.set_result(message['data'])
+
+    async def _handle(self, message):
+        op = message['op']
+        try:
+            if op == 'ping':
+                data = True
+            elif op == 'stats':
+                data = self.bot.process_stats()
+            elif op == 'reload':
+                await self.bot.reload_extension(message['args'].get('extension', 'music_player'))
+                data = 'ok'
+            elif op == 'shutdown':
+                data = True
+            else:
+                data = {'error': f"Unknown operation {op!r}"}
+        except Exception as e:
+            logger.error(f"Cluster operation {op} failed: {e}")
+            data = {'error': str(e)}
+
+        try:
+            self._send({'op': 'reply', 'id': message['id'], 'data': data})
+        except (ConnectionError, OSError):
+            pass
+
+        if op == 'shutdown':
+            logger.info("Shutting down at the request of the cluster")
+            for voice_client in list(self.bot.voice_clients):
+                await voice_client.disconnect()
+            self._closed = True
+            await self.bot.close()
+
+
+def run(processes, shard_count):
+    """Run ``shard_count`` shards in ``processes`` worker processes until shut down"""
+    ClusterLauncher(processes, shard_count).run()
@@ -8,6 +8,10 @@ from datetime import datetime
 from typing import Optional
 from dotenv import load_dotenv
 
+import cluster
+import metrics
+import outbound
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -36,6 +40,19 @@ logger = logging.getLogger('discord_bot')
 COMMAND_PREFIX = os.getenv('COMMAND_PREFIX', '!')
 BOT_OWNER_ID = int(os.getenv('BOT_OWNER_ID', '0')) if os.getenv('BOT_OWNER_ID') else None
 DEVELOPMENT_MODE = os.getenv('DEVELOPMENT_MODE', 'false').lower() == 'true'
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # Serve /metrics on this port (0 = disabled)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0')) or None  # Total shards (0 = ask Discord)
+SHARD_IDS = [int(shard) for shard in os.getenv('SHARD_IDS', '').split(',') if shard.strip()] or None
+AUTO_SHARD = os.getenv('AUTO_SHARD', 'false').lower() == 'true' or bool(SHARD_COUNT or SHARD_IDS)
+CLUSTER_PROCESSES = int(os.getenv('CLUSTER_PROCESSES', '0'))  # Run the shards in this many processes
+CLUSTER_ID = int(os.getenv('CLUSTER_ID')) if os.getenv('CLUSTER_ID') else None  # Set by the cluster launcher
+LOOP_MONITOR = os.getenv('LOOP_MONITOR', 'true').lower() == 'true'  # Log what blocks the event loop
+SLOW_CALLBACK_MS = int(os.getenv('SLOW_CALLBACK_MS', '100'))  # Blocking longer than this is logged
+
+# Command metrics live in the metrics module so they are exported with the rest
+commands_total = metrics.registry.counter('bot_commands_total', 'Commands invoked', ('command',))
+command_errors_total = metrics.registry.counter('bot_command_errors_total', 'Commands that failed', ('error',))
 
 # Set up intents - these tell Discord what events your bot needs access to
 intents = discord.Intents.default()
@@ -44,11 +61,16 @@ intents.voice_states = True     # Required for voice channel operations
 intents.guilds = True          # Required for guild operations
 intents.members = True         # Required for member information
 
-class MusicBot(commands.Bot):
+# One gateway connection per shard once the bot is in enough servers
+BotBase = commands.AutoShardedBot if AUTO_SHARD else commands.Bot
+shard_options = {'shard_count': SHARD_COUNT, 'shard_ids': SHARD_IDS} if AUTO_SHARD else {}
+
+class MusicBot(BotBase):
     """Custom bot class with enhanced functionality and error handling"""
     
     def __init__(self):
         super().__init__(
+            **shard_options,
             command_prefix=COMMAND_PREFIX,
             intents=intents,
             help_command=commands.DefaultHelpCommand(
@@ -72,6 +94,8 @@ class MusicBot(commands.Bot):
         self.start_time = datetime.utcnow()
         self.command_stats = {}
         self.error_count = 0
+        self.metrics_runner = None
+        self.cluster = None  # IPC channel to the launcher when running in cluster mode
         
     async def setup_hook(self):
         """This is called when the bot is starting up"""
@@ -88,10 +112,46 @@ class MusicBot(commands.Bot):
         # Load any additional cogs here in the future
         # Example: await self.load_extension('moderation')
         
+        if CLUSTER_ID is not None:
+            host, port = os.getenv('CLUSTER_ADDRESS').rsplit(':', 1)
+            self.cluster = cluster.ClusterClient(self, CLUSTER_ID, (host, int(port)),
+                                                 bytes.fromhex(os.getenv('CLUSTER_AUTHKEY')))
+            await self.cluster.connect()
+        
+        if METRICS_PORT:
+            # Every process of a cluster serves its own metrics on the next port
+            port = METRICS_PORT + (CLUSTER_ID or 0)
+            try:
+                self.metrics_runner = await metrics.start_http_server(port, METRICS_HOST)
+            except OSError as e:
+                logger.error(f"Could not start the metrics endpoint: {e}")
+        
+        if LOOP_MONITOR:
+            # Choppy audio usually means something held up the event loop
+            metrics.loop_monitor.threshold = SLOW_CALLBACK_MS / 1000
+            metrics.loop_monitor.start()
+    
+    async def get_context(self, origin, *, cls=outbound.Context):
+        """Contexts whose replies go through the outbound queue"""
+        return await super().get_context(origin, cls=cls)
+    
+    async def close(self):
+        """Stop the metrics endpoint, loop monitor, outbound queue and cluster channel along with the bot"""
+        metrics.loop_monitor.stop()
+        outbound.outbound.close()
+        if self.cluster:
+            self.cluster.close()
+        if self.metrics_runner:
+            await self.metrics_runner.cleanup()
+            self.metrics_runner = None
+        await super().close()
+        
     async def on_ready(self):
         """Called when the bot is fully ready"""
         logger.info(f'Logged in as {self.user} (ID: {self.user.id})')
         logger.info(f'Connected to {len(self.guilds)} guilds')
+        if self.shard_count:
+            logger.info(f'Running shards {self.shard_ids or "all"} of {self.shard_count}')
         logger.info(f'Total users: {sum(guild.member_count for guild in self.guilds)}')
         logger.info('Bot is ready!')
         print('------')
@@ -105,6 +165,53 @@ class MusicBot(commands.Bot):
             status=discord.Status.online
         )
         
+    async def on_shard_ready(self, shard_id):
+        logger.info(f"Shard {shard_id} is ready")
+    
+    async def on_shard_disconnect(self, shard_id):
+        logger.warning(f"Shard {shard_id} disconnected")
+    
+    async def on_shard_resumed(self, shard_id):
+        logger.info(f"Shard {shard_id} resumed its session")
+    
+    def shard_stats(self):
+        """Latency, servers, voice sessions and music players of every shard in this process"""
+        if isinstance(self, commands.AutoShardedBot):
+            latencies = dict(self.latencies)
+        else:
+            latencies = {self.shard_id or 0: self.latency}
+        shards = {shard_id: {'latency': latency, 'guilds': 0, 'voice': 0, 'players': 0}
+                  for shard_id, latency in latencies.items()}
+        
+        for guild in self.guilds:
+            shards.setdefault(guild.shard_id, {'latency': None, 'guilds': 0, 'voice': 0, 'players': 0})
+            shards[guild.shard_id]['guilds'] += 1
+        for voice_client in self.voice_clients:
+            if voice_client.guild.shard_id in shards:
+                shards[voice_client.guild.shard_id]['voice'] += 1
+        
+        music = self.get_cog('Music')
+        if music:
+            for shard_id, players in music.shard_players.items():
+                if shard_id in shards:
+                    shards[shard_id]['players'] = players
+        return shards
+    
+    def process_stats(self):
+        """Totals of this process, collected from every process for !stats in cluster mode"""
+        music = self.get_cog('Music')
+        return {
+            'shard_ids': list(self.shard_ids or []) if isinstance(self, commands.AutoShardedBot) else [],
+            'guilds': len(self.guilds),
+            'users': sum(guild.member_count or 0 for guild in self.guilds),
+            'voice': len(self.voice_clients),
+            'players': len(music.players) if music else 0,
+            'latency': self.latency,
+            'memory': metrics.process_rss(),
+            'commands': sum(self.command_stats.values()),
+            'errors': self.error_count,
+        }
+    
     async def on_guild_join(self, guild):
         """Called when the bot joins a new guild"""
         logger.info(f"Joined new guild: {guild.name} (ID: {guild.id}) with {guild.member_count} members")
@@ -123,19 +230,21 @@ class MusicBot(commands.Bot):
                 inline=False
             )
             try:
-                await guild.system_channel.send(embed=embed)
+                await outbound.outbound.send(guild.system_channel, embed=embed)
             except discord.Forbidden:
                 logger.warning(f"Could not send welcome message to {guild.name}")
                 
     async def on_guild_remove(self, guild):
         """Called when the bot is removed from a guild"""
         logger.info(f"Removed from guild: {guild.name} (ID: {guild.id})")
+        metrics.latency.forget(guild.id)
         
     async def on_command(self, ctx):
         """Called when a command is successfully invoked"""
         # Track command usage statistics
         command_name = ctx.command.qualified_name
         self.command_stats[command_name] = self.command_stats.get(command_name, 0) + 1
+        commands_total.inc(command=command_name)
         
         logger.info(f"Command '{command_name}' used by {ctx.author} in {ctx.guild.name if ctx.guild else 'DM'}")
         
@@ -150,6 +259,7 @@ class MusicBot(commands.Bot):
         
         # Track error count
         self.error_count += 1
+        command_errors_total.inc(error=type(error).__name__)
         
         # Handle specific error types with user-friendly messages
         if isinstance(error, commands.CommandNotFound):
@@ -224,16 +334,21 @@ class MusicBot(commands.Bot):
                     error_embed.add_field(name="Error", value=str(error)[:1024], inline=False)
                     
                     try:
-                        await owner.send(embed=error_embed)
+                        await outbound.outbound.send(owner, embed=error_embed, priority=outbound.LOW)
                     except discord.Forbidden:
                         pass
 
 
-# Create bot instance
-bot = MusicBot()
+# Commands and hooks are added to the bot by create_bot()
+async def label_command(ctx):
+    """Let the loop monitor blame a stall on the command being run"""
+    metrics.loop_monitor.label(asyncio.current_task(), ctx.command.qualified_name)
+
+async def unlabel_command(ctx):
+    metrics.loop_monitor.unlabel(asyncio.current_task())
 
 # Basic utility commands
-@bot.command(name='ping', description='Check bot latency')
+@commands.command(name='ping', description='Check bot latency')
 async def ping(ctx):
     """Check the bot's latency to Discord"""
     # Calculate different types of latency
@@ -242,7 +357,7 @@ async def ping(ctx):
     end_time = datetime.utcnow()
     
     # API latency is the websocket latency
-    api_latency = round(bot.latency * 1000)
+    api_latency = round(ctx.bot.latency * 1000)
     # Response time is how long it took to send the message
     response_time = (end_time - start_time).total_seconds() * 1000
     
@@ -265,13 +380,13 @@ async def ping(ctx):
     
     embed.add_field(name="Connection Status", value=status, inline=True)
     
-    await message.edit(content=None, embed=embed)
+    await outbound.outbound.edit(message, content=None, embed=embed, priority=outbound.HIGH)
 
-@bot.command(name='stats', description='Show bot statistics')
+@commands.command(name='stats', description='Show bot statistics')
 async def stats(ctx):
     """Display detailed bot statistics"""
     # Calculate uptime
-    uptime = datetime.utcnow() - bot.start_time
+    uptime = datetime.utcnow() - ctx.bot.start_time
     hours, remainder = divmod(int(uptime.total_seconds()), 3600)
     minutes, seconds = divmod(remainder, 60)
     days, hours = divmod(hours, 24)
@@ -292,31 +407,82 @@ async def stats(ctx):
     )
     
     # General stats
-    embed.add_field(name="Servers", value=f"{len(bot.guilds):,}", inline=True)
-    embed.add_field(name="Users", value=f"{sum(guild.member_count for guild in bot.guilds):,}", inline=True)
-    embed.add_field(name="Commands", value=f"{len(bot.commands)}", inline=True)
+    embed.add_field(name="Servers", value=f"{len(ctx.bot.guilds):,}", inline=True)
+    embed.add_field(name="Users", value=f"{sum(guild.member_count for guild in ctx.bot.guilds):,}", inline=True)
+    embed.add_field(name="Commands", value=f"{len(ctx.bot.commands)}", inline=True)
     
     # Voice connections
-    voice_connections = len(bot.voice_clients)
+    voice_connections = len(ctx.bot.voice_clients)
     embed.add_field(name="Voice Connections", value=f"{voice_connections}", inline=True)
     embed.add_field(name="Memory Usage", value=memory_str, inline=True)
-    embed.add_field(name="Total Commands Used", value=f"{sum(bot.command_stats.values()):,}", inline=True)
+    embed.add_field(name="Total Commands Used", value=f"{sum(ctx.bot.command_stats.values()):,}", inline=True)
     
     # Uptime
     uptime_str = f"{days}d {hours}h {minutes}m {seconds}s"
     embed.add_field(name="Uptime", value=uptime_str, inline=True)
-    embed.add_field(name="Errors", value=f"{bot.error_count}", inline=True)
+    embed.add_field(name="Errors", value=f"{ctx.bot.error_count}", inline=True)
     embed.add_field(name="Python Version", value=f"{sys.version.split()[0]}", inline=True)
     
+    # Extraction cache effectiveness
+    music = ctx.bot.get_cog('Music')
+    if music:
+        cache = await music.extraction_stats()
+        embed.add_field(
+            name="Extraction Cache",
+            value=f"{cache['hit_rate']:.0%} hits | {cache['size']} entries | {cache['coalesced']} coalesced",
+            inline=True
+        )
+        
+        audio = await music.audio_cache_stats()
+        if audio:
+            embed.add_field(
+                name="Audio Cache",
+                value=f"{audio['hit_rate']:.0%} hits | {audio['files']} songs | {audio['bytes'] / 1024 / 1024:.0f} MB",
+                inline=True
+            )
+    
+    # Per-shard load, so an overloaded or lagging gateway connection stands out
+    shards = ctx.bot.shard_stats()
+    if len(shards) > 1 or ctx.bot.shard_count:
+        lines = []
+        for shard_id, shard in sorted(shards.items())[:15]:
+            latency_str = f"{shard['latency'] * 1000:.0f}ms" if shard['latency'] is not None else "?"
+            lines.append(f"`#{shard_id}` {latency_str} · {shard['guilds']:,} servers · "
+                         f"{shard['voice']} voice · {shard['players']} players")
+        if len(shards) > 15:
+            lines.append(f"... and {len(shards) - 15} more")
+        embed.add_field(name=f"Shards ({ctx.bot.shard_count or len(shards)} total)", value='\n'.join(lines), inline=False)
+    
+    # Every process of the cluster, gathered over IPC
+    if ctx.bot.cluster:
+        try:
+            processes = await ctx.bot.cluster.request('stats')
+        except (asyncio.TimeoutError, ConnectionError, OSError) as e:
+            logger.warning(f"Could not gather cluster stats: {e}")
+        else:
+            answered = {cluster_id: data for cluster_id, data in processes.items() if isinstance(data, dict)}
+            lines = [f"**Total** {sum(data['guilds'] for data in answered.values()):,} servers · "
+                     f"{sum(data['voice'] for data in answered.values())} voice · "
+                     f"{sum(data['players'] for data in answered.values())} players"]
+            for cluster_id, data in sorted(processes.items()):
+                if cluster_id not in answered:
+                    lines.append(f"`P{cluster_id}` not responding")
+                    continue
+                shard_range = f"{data['shard_ids'][0]}-{data['shard_ids'][-1]}" if data['shard_ids'] else "-"
+                memory = f"{data['memory'] / 1024 / 1024:.0f} MB" if data['memory'] else "?"
+                lines.append(f"`P{cluster_id}` shards {shard_range} · {data['guilds']:,} servers · "
+                             f"{data['voice']} voice · {memory}")
+            embed.add_field(name=f"Cluster ({len(processes)} processes)", value='\n'.join(lines)[:1024], inline=False)
+    
     # Most used commands
-    if bot.command_stats:
-        top_commands = sorted(bot.command_stats.items(), key=lambda x: x[1], reverse=True)[:3]
+    if ctx.bot.command_stats:
+        top_commands = sorted(ctx.bot.command_stats.items(), key=lambda x: x[1], reverse=True)[:3]
         top_commands_str = '\n'.join([f"`{cmd}`: {count:,}" for cmd, count in top_commands])
         embed.add_field(name="Top Commands", value=top_commands_str or "None yet", inline=False)
     
     await ctx.send(embed=embed)
 
-@bot.command(name='invite', description='Get bot invite link')
+@commands.command(name='invite', description='Get bot invite link')
 async def invite(ctx):
     """Get the bot's invite link with proper permissions"""
     # Calculate permissions integer for the invite
@@ -333,7 +499,7 @@ async def invite(ctx):
         change_nickname=True
     )
     
-    invite_url = discord.utils.oauth_url(bot.user.id, permissions=permissions)
+    invite_url = discord.utils.oauth_url(ctx.bot.user.id, permissions=permissions)
     
     embed = discord.Embed(
         title="🔗 Invite Links",
@@ -349,7 +515,7 @@ async def invite(ctx):
     )
     
     # Admin permissions link (for lazy server owners)
-    admin_url = discord.utils.oauth_url(bot.user.id, permissions=discord.Permissions(administrator=True))
+    admin_url = discord.utils.oauth_url(ctx.bot.user.id, permissions=discord.Permissions(administrator=True))
     embed.add_field(
         name="Administrator Permissions",
         value=f"[Invite with admin perms]({admin_url})\n*⚠️ Only use if you trust the bot*",
@@ -357,7 +523,7 @@ async def invite(ctx):
     )
     
     # No permissions link (user can configure after)
-    basic_url = discord.utils.oauth_url(bot.user.id, permissions=discord.Permissions(0))
+    basic_url = discord.utils.oauth_url(ctx.bot.user.id, permissions=discord.Permissions(0))
     embed.add_field(
         name="No Permissions",
         value=f"[Invite without perms]({basic_url})\n*Configure permissions after inviting*",
@@ -368,7 +534,7 @@ async def invite(ctx):
     
     await ctx.send(embed=embed)
 
-@bot.command(name='support', description='Get support server link')
+@commands.command(name='support', description='Get support server link')
 async def support(ctx):
     """Get support server information and helpful links"""
     embed = discord.Embed(
@@ -409,16 +575,16 @@ async def support(ctx):
     # Bot information
     embed.set_footer(
         text=f"Version 1.0.0 | Made with discord.py",
-        icon_url=bot.user.display_avatar.url
+        icon_url=ctx.bot.user.display_avatar.url
     )
     
     await ctx.send(embed=embed)
 
-@bot.command(name='about', description='Information about the bot')
+@commands.command(name='about', description='Information about the bot')
 async def about(ctx):
     """Display detailed information about the bot"""
     embed = discord.Embed(
-        title=f"About {bot.user.name}",
+        title=f"About {ctx.bot.user.name}",
         description="A feature-rich music bot for Discord servers!",
         color=discord.Color.blue()
     )
@@ -446,21 +612,21 @@ async def about(ctx):
     
     embed.add_field(
         name="Links",
-        value=f"• [Invite Bot]({discord.utils.oauth_url(bot.user.id)})\n"
+        value=f"• [Invite Bot]({discord.utils.oauth_url(ctx.bot.user.id)})\n"
               "• [GitHub](https://github.com/d-dziublenko/discord-audio-player.git)\n",
         inline=True
     )
     
-    embed.set_thumbnail(url=bot.user.display_avatar.url)
+    embed.set_thumbnail(url=ctx.bot.user.display_avatar.url)
     embed.set_footer(
-        text=f"Serving {len(bot.guilds)} servers | {sum(g.member_count for g in bot.guilds):,} users",
-        icon_url=bot.user.display_avatar.url
+        text=f"Serving {len(ctx.bot.guilds)} servers | {sum(g.member_count for g in ctx.bot.guilds):,} users",
+        icon_url=ctx.bot.user.display_avatar.url
     )
     
     await ctx.send(embed=embed)
 
 # Owner-only commands
-@bot.command(name='shutdown', hidden=True)
+@commands.command(name='shutdown', hidden=True)
 @commands.is_owner()
 async def shutdown(ctx):
     """Gracefully shutdown the bot (owner only)"""
@@ -473,26 +639,44 @@ async def shutdown(ctx):
     
     logger.info(f"Shutdown command issued by {ctx.author}")
     
+    if ctx.bot.cluster:
+        # The launcher stops every process, this one included
+        ctx.bot.cluster.notify('shutdown')
+        return
+    
     # Disconnect from all voice channels
-    for vc in bot.voice_clients:
+    for vc in ctx.bot.voice_clients:
         await vc.disconnect()
     
     # Close the bot
-    await bot.close()
+    await ctx.bot.close()
 
-@bot.command(name='reload', hidden=True)
+@commands.command(name='reload', hidden=True)
 @commands.is_owner()
 async def reload(ctx, extension: str = 'music_player'):
     """Reload a cog without restarting the bot (owner only)"""
+    if ctx.bot.cluster:
+        results = await ctx.bot.cluster.request('reload', extension=extension)
+        lines = []
+        for cluster_id, result in sorted(results.items()):
+            if result == 'ok':
+                lines.append(f"✅ Process {cluster_id}")
+            else:
+                error = result['error'] if isinstance(result, dict) else "no response"
+                lines.append(f"❌ Process {cluster_id}: {error}")
+        await ctx.send(f"Reloaded `{extension}` across the cluster:\n" + '\n'.join(lines))
+        logger.info(f"Reloaded extension {extension} across the cluster")
+        return
+    
     try:
-        await bot.reload_extension(extension)
+        await ctx.bot.reload_extension(extension)
         await ctx.send(f"✅ Successfully reloaded `{extension}`")
         logger.info(f"Reloaded extension: {extension}")
     except Exception as e:
         await ctx.send(f"❌ Failed to reload `{extension}`: {str(e)}")
         logger.error(f"Failed to reload {extension}: {e}")
 
-@bot.command(name='debug', hidden=True)
+@commands.command(name='debug', hidden=True)
 @commands.is_owner()
 async def debug(ctx):
     """Show debug information (owner only)"""
@@ -509,18 +693,46 @@ async def debug(ctx):
         timestamp=datetime.utcnow()
     )
     
-    embed.add_field(name="Bot User", value=f"{bot.user} ({bot.user.id})", inline=False)
+    embed.add_field(name="Bot User", value=f"{ctx.bot.user} ({ctx.bot.user.id})", inline=False)
     embed.add_field(name="Discord.py Version", value=discord.__version__, inline=True)
     embed.add_field(name="Python Version", value=sys.version.split()[0], inline=True)
     embed.add_field(name="System", value=system_info, inline=True)
-    embed.add_field(name="Shards", value=f"{bot.shard_count or 1}", inline=True)
+    shard_ids = f" (running {', '.join(map(str, ctx.bot.shard_ids))})" if getattr(ctx.bot, 'shard_ids', None) else ""
+    embed.add_field(name="Shards", value=f"{ctx.bot.shard_count or 1}{shard_ids}", inline=True)
     embed.add_field(name="Command Prefix", value=f"`{COMMAND_PREFIX}`", inline=True)
     embed.add_field(name="Development Mode", value=str(DEVELOPMENT_MODE), inline=True)
     
+    # Extractor pool utilisation, useful for tuning EXTRACTOR_WORKERS
+    music = ctx.bot.get_cog('Music')
+    if music:
+        pool = music.extractor_stats()
+        embed.add_field(
+            name="Extractor Pool",
+            value=f"{pool['backend']} x{pool['workers']} | {pool['running']} running, {pool['pending']} queued\n"
+                  f"Wait avg {pool['avg_wait'] * 1000:.0f}ms, p95 {pool['p95_wait'] * 1000:.0f}ms, "
+                  f"max {pool['max_wait'] * 1000:.0f}ms | {pool['rejected']} rejected",
+            inline=False
+        )
+    
+    # Event loop health, the first thing to check when audio stutters
+    loop_stats = metrics.loop_monitor.stats()
+    loop_info = (f"Lag {loop_stats['last_lag'] * 1000:.0f}ms, p95 {loop_stats['p95_lag'] * 1000:.0f}ms, "
+                 f"max {loop_stats['max_lag'] * 1000:.0f}ms | {loop_stats['stalls']} stalls")
+    for stall in reversed(loop_stats['recent'][-3:]):
+        culprit = f"!{stall['command']}" if stall['command'] else stall['task'] or 'callback'
+        loop_info += f"\n{stall['seconds'] * 1000:.0f}ms · {culprit} · `{stall['where']}`"
+    embed.add_field(name="Event Loop", value=loop_info[:1024], inline=False)
+    
+    # REST calls waiting for their rate limit budget
+    depth = outbound.outbound.stats()
+    embed.add_field(name="Outbound Queue",
+                    value=f"{depth['high']} replies, {depth['normal']} normal, {depth['low']} background",
+                    inline=False)
+    
     # Show cogs status
     cogs_status = []
     for cog_name in ['music_player']:  # Add more cog names as you add them
-        if cog_name in bot.extensions:
+        if cog_name in ctx.bot.extensions:
             cogs_status.append(f"✅ {cog_name}")
         else:
             cogs_status.append(f"❌ {cog_name}")
@@ -529,6 +741,50 @@ async def debug(ctx):
     
     await ctx.send(embed=embed)
 
+@commands.command(name='latency', hidden=True)
+@commands.is_owner()
+async def latency(ctx, guild_id: int = None):
+    """Show play pipeline latency percentiles, overall or for one server (owner only)"""
+    summary = metrics.latency.summary(guild_id)
+    
+    embed = discord.Embed(
+        title="⏱️ Play Pipeline Latency",
+        description=f"Server `{guild_id}`" if guild_id else "All servers",
+        color=discord.Color.orange(),
+        timestamp=datetime.utcnow()
+    )
+    
+    # Stages in pipeline order; anything else recorded is listed after them
+    order = ['queued', 'extract', 'resolve', 'ffmpeg_start', 'voice_play', 'first_frame', 'time_to_audio', 'seek']
+    for stage in sorted(summary, key=lambda name: order.index(name) if name in order else len(order)):
+        timing = summary[stage]
+        embed.add_field(
+            name=stage,
+            value=f"p50 {timing['p50'] * 1000:.0f}ms | p95 {timing['p95'] * 1000:.0f}ms | "
+                  f"p99 {timing['p99'] * 1000:.0f}ms\n{timing['count']:,} samples",
+            inline=True
+        )
+    
+    if not summary:
+        embed.add_field(name="No data", value="Nothing has been played yet", inline=False)
+    
+    await ctx.send(embed=embed)
+
+
+def create_bot():
+    """Build the bot with its commands and hooks
+
+    Nothing is built at import: a spawned cluster worker runs this file once as
+    __mp_main__ before it has its shard settings, then imports it again as main
+    and should end up with exactly one bot.
+    """
+    bot = MusicBot()
+    bot.before_invoke(label_command)
+    bot.after_invoke(unlabel_command)
+    for command in (ping, stats, invite, support, about, shutdown, reload, debug, latency):
+        bot.add_command(command)
+    return bot
+
 
 async def main():
     """Main function to run the bot with proper error handling"""
@@ -544,6 +800,12 @@ async def main():
         print("3. Saved the file\n")
         return
     
+    if SHARD_IDS and not SHARD_COUNT:
+        logger.error("SHARD_IDS needs SHARD_COUNT to be set as well")
+        return
+    
+    bot = create_bot()
+    
     try:
         logger.info("Starting bot...")
         await bot.start(token)
@@ -562,6 +824,11 @@ async def main():
 
 
 if __name__ == "__main__":
+    if CLUSTER_PROCESSES > 1:
+        # Each process runs its own bot for a range of the shards
+        cluster.run(CLUSTER_PROCESSES, SHARD_COUNT or CLUSTER_PROCESSES)
+        sys.exit()
+    
     # Run the bot
     try:
         asyncio.run(main())
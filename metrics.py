@@ -0,0 +1,399 @@
+"""
+Metrics for the bot.
+
+Counters, gauges and latency histograms are kept in a registry and exported
+in the Prometheus text format over a small local HTTP endpoint. Values are
+updated where things happen, so a scrape only formats what is already there
+instead of walking guilds, players or queues. Stages of the play pipeline are
+timed into histograms, overall and per guild.
+
+This module keeps its state when the music cog is reloaded.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+from aiohttp import web
+
+logger = logging.getLogger('discord_bot.metrics')
+
+# Stack frames under this directory belong to the bot rather than to libraries
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+
+class Histogram:
+    """Counts observations (in seconds) into fixed exponential buckets.
+
+    Memory is constant per histogram, so one can be kept for every guild and
+    stage. Quantiles are interpolated within a bucket; bucket bounds grow by
+    half each step, which is accurate enough to tell stages apart.
+    """
+
+    # 1 ms up to about 2 minutes, plus an overflow bucket
+    BUCKETS = tuple(round(0.001 * 1.5 ** step, 6) for step in range(30))
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate the q-quantile (0 < q <= 1), 0.0 without observations"""
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.BUCKETS[index - 1] if index else 0.0
+                upper = self.BUCKETS[min(index, len(self.BUCKETS) - 1)]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.BUCKETS[-1]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+class LatencyTracker:
+    """Per-stage latency histograms, kept overall and per guild"""
+
+    name = 'bot_stage_latency_seconds'
+
+    def __init__(self):
+        self.stages = {}
+        self.guilds = {}
+
+    def observe(self, stage, seconds, guild_id=None):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.observe(seconds)
+
+        if guild_id is not None:
+            stages = self.guilds.setdefault(guild_id, {})
+            histogram = stages.get(stage)
+            if histogram is None:
+                histogram = stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, stage, guild_id=None):
+        """Time the body of a ``with`` block; failed attempts are not recorded"""
+        started = time.perf_counter()
+        yield
+        self.observe(stage, time.perf_counter() - started, guild_id)
+
+    def summary(self, guild_id=None):
+        """Count and p50/p95/p99 for every stage, overall or for one guild"""
+        stages = self.stages if guild_id is None else self.guilds.get(guild_id, {})
+        return {stage: histogram.summary() for stage, histogram in stages.items()}
+
+    def forget(self, guild_id):
+        self.guilds.pop(guild_id, None)
+
+    def render(self):
+        """Overall histograms in the Prometheus text format"""
+        lines = [
+            '# HELP bot_stage_latency_seconds Time spent in each stage of the play pipeline',
+            '# TYPE bot_stage_latency_seconds histogram',
+        ]
+        for stage, histogram in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, count in zip(Histogram.BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'bot_stage_latency_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'bot_stage_latency_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'bot_stage_latency_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'bot_stage_latency_seconds_count{{stage="{stage}"}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(labelnames, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    """Monotonic count, optionally split by labels"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        if not self.values and not self.labelnames:
+            lines.append(f'{self.name} 0')
+        for key, value in self.values.items():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return '\n'.join(lines)
+
+
+class Gauge(Counter):
+    """Value that goes up and down, kept current by whoever changes it"""
+
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def remove(self, **labels):
+        self.values.pop(self._key(labels), None)
+
+
+class CallbackGauge:
+    """Gauge read from a callback at scrape time; the callback must be O(1)"""
+
+    def __init__(self, name, documentation, callback, kind='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.kind = kind
+
+    def render(self):
+        value = self.callback()
+        if value is None:
+            return ''
+        return f'# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.kind}\n{self.name} {value}'
+
+
+class Registry:
+    """Metrics by name. Asking for an existing name returns the existing metric,
+    so modules that are reloaded keep their values."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def _get_or_create(self, cls, name, documentation, labelnames):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, documentation, labelnames)
+        return metric
+
+    def register(self, metric):
+        """Add or replace a collector (anything with ``name`` and ``render()``)"""
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        parts = (metric.render().rstrip('\n') for metric in self.metrics.values())
+        return '\n'.join(part for part in parts if part) + '\n'
+
+
+def process_rss():
+    """Resident memory of this process in bytes, None if it cannot be read"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class LoopMonitor:
+    """Measures event loop lag and finds out what blocked the loop.
+
+    A task sleeps for ``interval`` and records how late it wakes up. A watchdog
+    thread notices when that wakeup is overdue by more than ``threshold`` and
+    captures the running task, the command it serves and the stack of the
+    loop thread while the stall is still happening.
+    """
+
+    name = 'bot_event_loop_lag_seconds'
+
+    def __init__(self, interval=0.5, threshold=0.1, keep=20):
+        self.interval = interval
+        self.threshold = threshold
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.histogram = Histogram()
+        self.stall_count = 0
+        self.stalls = deque(maxlen=keep)  # Most recent stalls, newest last
+        self.labels = {}  # Task -> command it is running
+        self._task = None
+        self._loop = None
+        self._thread_id = None
+        self._beat = None  # time.monotonic() of the last wakeup
+        self._capture = None  # Filled in by the watchdog during a stall
+        self._stopped = None
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped = threading.Event()
+        self._task = self._loop.create_task(self._run(), name='loop monitor')
+        threading.Thread(target=self._watch, args=(self._stopped,), name='loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        if self._stopped is not None:
+            self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def label(self, task, text):
+        """Name what ``task`` is doing, for stalls that happen while it runs"""
+        self.labels[task] = text
+
+    def unlabel(self, task):
+        self.labels.pop(task, None)
+
+    async def _run(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._beat = now
+            self._record(max(0.0, now - expected))
+
+    def _record(self, lag):
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.histogram.observe(lag)
+
+        capture, self._capture = self._capture, None
+        if lag < self.threshold:
+            return
+
+        stall = capture or {'task': None, 'command': None, 'where': 'unknown', 'stack': ''}
+        stall['seconds'] = lag
+        stall['at'] = time.time()
+        self.stall_count += 1
+        self.stalls.append(stall)
+
+        culprit = f"command '{stall['command']}'" if stall['command'] else stall['task'] or 'a callback'
+        logger.warning(f"Event loop blocked for {lag * 1000:.0f}ms by {culprit} at {stall['where']}\n{stall['stack']}")
+
+    def _watch(self, stopped):
+        """Watchdog thread: capture the loop thread while a wakeup is overdue"""
+        while not stopped.wait(max(self.threshold / 2, 0.01)):
+            beat = self._beat
+            if self._capture is not None or time.monotonic() - beat < self.interval + self.threshold:
+                continue
+            capture = self._snapshot()
+            # Only keep it if the loop has not caught up in the meantime
+            if capture is not None and self._beat == beat:
+                self._capture = capture
+
+    def _snapshot(self):
+        frame = sys._current_frames().get(self._thread_id)
+        if frame is None:
+            return None
+        frames = traceback.extract_stack(frame)
+        # The innermost frame in the bot's own files points at the culprit
+        own = [entry for entry in frames if entry.filename.startswith(_BASE_DIR)]
+        where = (own or frames)[-1]
+
+        task = asyncio.current_task(self._loop)
+        if task is not None:
+            coro = task.get_coro()
+            task_name = f"{task.get_name()} ({getattr(coro, '__qualname__', coro)})"
+        else:
+            task_name = None
+
+        return {
+            'task': task_name,
+            'command': self.labels.get(task),
+            'where': f"{os.path.basename(where.filename)}:{where.lineno} in {where.name}",
+            'stack': ''.join(traceback.format_list(frames[-8:])),
+        }
+
+    def stats(self):
+        return {
+            'last_lag': self.last_lag,
+            'p95_lag': self.histogram.quantile(0.95),
+            'max_lag': self.max_lag,
+            'stalls': self.stall_count,
+            'recent': list(self.stalls),
+        }
+
+    def render(self):
+        lines = ['# HELP bot_event_loop_lag_seconds How late the event loop ran a timer',
+                 '# TYPE bot_event_loop_lag_seconds histogram']
+        cumulative = 0
+        for bound, count in zip(Histogram.BUCKETS, self.histogram.counts):
+            cumulative += count
+            lines.append(f'bot_event_loop_lag_seconds_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'bot_event_loop_lag_seconds_bucket{{le="+Inf"}} {self.histogram.count}')
+        lines.append(f'bot_event_loop_lag_seconds_sum {self.histogram.sum}')
+        lines.append(f'bot_event_loop_lag_seconds_count {self.histogram.count}')
+        lines.append('# HELP bot_event_loop_stalls_total Times the event loop was blocked past the threshold')
+        lines.append('# TYPE bot_event_loop_stalls_total counter')
+        lines.append(f'bot_event_loop_stalls_total {self.stall_count}')
+        return '\n'.join(lines)
+
+
+# Shared by the bot and the music cog
+registry = Registry()
+latency = registry.register(LatencyTracker())
+loop_monitor = registry.register(LoopMonitor())
+registry.register(CallbackGauge('bot_process_resident_memory_bytes', 'Resident memory of the bot process', process_rss))
+
+
+async def handle_metrics(request):
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+
+async def start_http_server(port, host='127.0.0.1'):
+    """Serve /metrics on the running event loop; returns the runner to clean up"""
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
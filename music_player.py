@@ -1,6 +1,8 @@
 import discord
 from discord.ext import commands
 import asyncio
+import audioop
+import hashlib
 import itertools
 import sys
 import traceback
@@ -8,10 +10,24 @@ import logging
 import os
 import time
 import random
+import re
+import shlex
+import signal
+import multiprocessing
+import json
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor
 from functools import partial
 from typing import Optional, Dict, List
 from datetime import datetime, timedelta
 import yt_dlp as youtube_dl
+import numpy
+
+from metrics import latency, registry, CallbackGauge
+from outbound import outbound, TokenBucket, HIGH, LOW
 
 # Set up logging for this module
 logger = logging.getLogger('discord_bot.music')
@@ -23,6 +39,38 @@ INACTIVITY_TIMEOUT = int(os.getenv('INACTIVITY_TIMEOUT', '300'))  # 5 minutes de
 MAX_QUEUE_SIZE = int(os.getenv('MAX_QUEUE_SIZE', '0'))  # 0 means no limit
 AUDIO_BITRATE = int(os.getenv('AUDIO_BITRATE', '192'))
 FORCE_IPV4 = os.getenv('FORCE_IPV4', 'true').lower() == 'true'
+PREFETCH_COUNT = int(os.getenv('PREFETCH_COUNT', '1'))  # Upcoming songs to resolve while playing
+STREAM_URL_TTL = int(os.getenv('STREAM_URL_TTL', '18000'))  # Fallback lifetime of a stream URL
+STREAM_URL_MARGIN = int(os.getenv('STREAM_URL_MARGIN', '60'))  # Re-resolve URLs this close to expiry
+METADATA_CACHE_SIZE = int(os.getenv('METADATA_CACHE_SIZE', '512'))  # Cached extraction results
+METADATA_CACHE_TTL = int(os.getenv('METADATA_CACHE_TTL', '3600'))  # Lifetime of cached metadata
+STREAM_CACHE_TTL = int(os.getenv('STREAM_CACHE_TTL', '1800'))  # Lifetime of cached stream URLs
+EXTRACTION_CACHE_DIR = os.getenv('EXTRACTION_CACHE_DIR', '')  # Persist the cache here (empty = memory only)
+EXTRACTOR_BACKEND = os.getenv('EXTRACTOR_BACKEND', 'thread').lower()  # thread or process
+EXTRACTOR_WORKERS = int(os.getenv('EXTRACTOR_WORKERS', '4'))  # Concurrent yt-dlp extractions
+EXTRACTOR_MAX_PENDING = int(os.getenv('EXTRACTOR_MAX_PENDING', '64'))  # Queued extractions before rejecting
+EXTRACTOR_MAX_PENDING_PER_GUILD = int(os.getenv('EXTRACTOR_MAX_PENDING_PER_GUILD', '8'))
+MAX_PLAYLIST_SIZE = int(os.getenv('MAX_PLAYLIST_SIZE', '500'))  # Songs imported from one playlist
+PLAYLIST_BATCH_SIZE = int(os.getenv('PLAYLIST_BATCH_SIZE', '25'))  # Playlist entries read per worker job
+GAPLESS_PLAYBACK = os.getenv('GAPLESS_PLAYBACK', 'false').lower() == 'true'  # Splice songs without a gap
+CROSSFADE_SECONDS = float(os.getenv('CROSSFADE_SECONDS', '0'))  # Fade songs into each other (0 = off)
+PRELOAD_SECONDS = float(os.getenv('PRELOAD_SECONDS', '10'))  # Open the next song this long before the fade
+OPUS_MODE = os.getenv('OPUS_MODE', 'pcm').lower()  # pcm, auto (Opus passthrough at 100% volume), ffmpeg or copy
+FFMPEG_PROFILE = os.getenv('FFMPEG_PROFILE', 'default').lower()  # Default FFmpeg profile, see FFMPEG_PROFILES
+LOUDNESS_NORMALIZATION = os.getenv('LOUDNESS_NORMALIZATION', 'false').lower() == 'true'
+LOUDNESS_TARGET = float(os.getenv('LOUDNESS_TARGET', '-16'))  # Mean volume songs are brought to, in dBFS
+LOUDNESS_SCAN_SECONDS = int(os.getenv('LOUDNESS_SCAN_SECONDS', '30'))  # Audio analysed per song
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', '')  # Keep popular songs here as Opus files (empty = off)
+AUDIO_CACHE_MAX_MB = int(os.getenv('AUDIO_CACHE_MAX_MB', '2048'))  # Size limit, least recently played go first
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv('AUDIO_CACHE_MIN_PLAYS', '3'))  # Plays before a song is cached
+AUDIO_CACHE_MAX_DURATION = int(os.getenv('AUDIO_CACHE_MAX_DURATION', '1200'))  # Longer songs are not cached
+NOW_PLAYING_INTERVAL = float(os.getenv('NOW_PLAYING_INTERVAL', '15'))  # Seconds between progress edits (0 = off)
+NOW_PLAYING_EDIT_RATE = float(os.getenv('NOW_PLAYING_EDIT_RATE', '5'))  # Now playing edits per second, all servers
+# How process workers are started; fork is avoided because the bot process runs threads
+EXTRACTOR_START_METHOD = os.getenv(
+    'EXTRACTOR_START_METHOD',
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
 
 # Suppress noise about console usage from errors
 youtube_dl.utils.bug_reports_message = lambda: ''
@@ -56,15 +104,915 @@ ytdlopts = {
 if FORCE_IPV4:
     ytdlopts['force-ipv4'] = True
 
-# Enhanced FFmpeg options for better audio quality and stability
-ffmpegopts = {
-    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -nostdin',
-    'options': f'-vn -ab {AUDIO_BITRATE}k'
+# FFmpeg command lines, chosen with FFMPEG_PROFILE and per server with the profile command.
+# A profile may also override OPUS_MODE.
+FFMPEG_PROFILES = {
+    # Reconnects dropped streams, FFmpeg's default probing and buffering
+    'default': {
+        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -nostdin',
+        'options': '-vn',
+    },
+    # Starts playing sooner: minimal probing and no input buffering
+    'low-latency': {
+        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -nostdin '
+                          '-probesize 32k -analyzeduration 0 -fflags nobuffer',
+        'options': '-vn',
+    },
+    # Least CPU: Opus streams are copied (volume is not applied to them), one decoder thread
+    'low-cpu': {
+        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -nostdin -threads 1',
+        'options': '-vn -threads 1',
+        'opus_mode': 'copy',
+    },
+    # Rides out flaky networks: reconnects on any network error, with a longer window
+    'robust': {
+        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_on_network_error 1 '
+                          '-reconnect_delay_max 30 -rw_timeout 30000000 -nostdin',
+        'options': '-vn',
+    },
 }
 
+if FFMPEG_PROFILE not in FFMPEG_PROFILES:
+    logger.warning(f"Unknown FFMPEG_PROFILE {FFMPEG_PROFILE!r}, using 'default'")
+    FFMPEG_PROFILE = 'default'
+
+# Options of the default profile, for FFmpeg runs that are not tied to a server
+ffmpegopts = {key: FFMPEG_PROFILES[FFMPEG_PROFILE][key] for key in ('before_options', 'options')}
+
+# Kept in the metrics module, so the values survive a reload of this cog
+ffmpeg_processes = registry.gauge('bot_ffmpeg_processes', 'FFmpeg processes started by the bot and still running')
+voice_connections = registry.gauge('bot_voice_connections', 'Voice channels the bot is connected to')
+queued_tracks = registry.gauge('bot_queued_tracks', 'Songs waiting in all queues')
+queue_length = registry.gauge('bot_queue_length', 'Songs waiting in the queue of a server', ('guild',))
+now_playing_updates = registry.counter('bot_now_playing_updates_total',
+                                       'Now playing message updates by result (sent, edited, unchanged, dropped)',
+                                       ('result',))
+
 # Create yt-dlp instance with our options
 ytdl = youtube_dl.YoutubeDL(ytdlopts)
 
+# Separate instance for flat extraction (search results without stream URLs)
+ytdl_flat = youtube_dl.YoutubeDL({**ytdlopts, 'extract_flat': True, 'force_generic_extractor': False})
+
+# Fields of a yt-dlp info dict that playback and embeds actually use
+INFO_FIELDS = ('_type', 'id', 'title', 'webpage_url', 'url', 'duration', 'thumbnail', 'uploader',
+               'uploader_url', 'upload_date', 'view_count', 'like_count', 'extractor',
+               'ext', 'acodec', 'is_live', 'http_headers')
+
+# Flat, lazy extraction for playlist imports: entries are streamed page by page
+ytdl_playlist = youtube_dl.YoutubeDL({**ytdlopts, 'noplaylist': False, 'extract_flat': 'in_playlist',
+                                      'lazy_playlist': True})
+
+_PLAYLIST_URL = re.compile(r'^https?://\S*(?:youtube\.com/playlist\?\S*list=|soundcloud\.com/\S+/sets/)',
+                           re.IGNORECASE)
+
+_YOUTUBE_ID = re.compile(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/)|youtu\.be/)([\w-]{11})')
+
+
+def stream_expiry(url, default_ttl=STREAM_URL_TTL):
+    """Return the unix timestamp at which a signed stream URL stops working"""
+    # YouTube embeds the expiry either as a query parameter or as a path segment
+    match = re.search(r'[?&/]expire[=/](\d+)', url or '')
+    if match:
+        return int(match.group(1))
+    return time.time() + default_ttl
+
+
+def cache_key(query, *, flat=False):
+    """Normalize a URL or search query into an extraction cache key"""
+    query = query.strip()
+    match = _YOUTUBE_ID.search(query)
+    if match:
+        key = f'youtube:{match.group(1)}'
+    elif re.match(r'https?://', query, re.IGNORECASE):
+        key = 'url:' + query.split('#', 1)[0]
+    else:
+        key = 'search:' + ' '.join(query.lower().split())
+    return f'flat:{key}' if flat else key
+
+
+def is_playlist_url(query):
+    """Check whether a query is a link to a whole playlist"""
+    return bool(_PLAYLIST_URL.match(query.strip()))
+
+
+def slim_info(data):
+    """Strip a yt-dlp info dict down to the fields we use (formats alone can be hundreds of KB)"""
+    slim = {field: data[field] for field in INFO_FIELDS if field in data}
+    if data.get('entries') is not None:
+        slim['entries'] = [slim_info(entry) for entry in data['entries'] if entry]
+    return slim
+
+
+class ExtractionCache:
+    """Process-wide TTL + LRU cache of yt-dlp extraction results shared by all guilds"""
+    
+    def __init__(self, maxsize=METADATA_CACHE_SIZE, ttl=METADATA_CACHE_TTL, stream_ttl=STREAM_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stream_ttl = stream_ttl
+        
+        # key -> (metadata expiry, stream URL expiry, info dict), oldest first
+        self._entries = OrderedDict()
+        
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, *, need_stream=False):
+        """Return the cached info dict, or None if it is missing or expired"""
+        return self._check(key, self._load(key), need_stream)
+    
+    async def get_async(self, key, *, loop, need_stream=False):
+        """Like get(), for callers on the event loop"""
+        return self.get(key, need_stream=need_stream)
+    
+    def _check(self, key, entry, need_stream):
+        """Apply expiry to a raw entry and count the lookup"""
+        now = time.time()
+        
+        if entry is not None and entry[0] <= now:
+            self._entries.pop(key, None)
+            entry = None
+        
+        # Metadata may outlive the signed stream URL it was extracted with
+        if entry is None or (need_stream and entry[1] <= now):
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        return entry[2]
+    
+    def put(self, key, data):
+        """Store an info dict, evicting the least recently used entries when full"""
+        if self.maxsize <= 0:
+            return
+        
+        now = time.time()
+        stream_expires_at = 0
+        if data.get('url'):
+            expires_at = stream_expiry(data['url'])
+            stream_expires_at = min(now + self.stream_ttl, expires_at - STREAM_URL_MARGIN)
+            # Tracks built from the cached dict later must not outlive the cached URL
+            data['_stream_expires_at'] = min(now + self.stream_ttl + STREAM_URL_MARGIN, expires_at)
+        
+        self._store(key, (now + self.ttl, stream_expires_at, data))
+    
+    def _load(self, key):
+        """Look up a raw entry and mark it as recently used"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+    
+    def _store(self, key, entry):
+        """Insert a raw entry and enforce the size bound"""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+    
+    async def clear(self):
+        """Drop every cached entry"""
+        self._entries.clear()
+    
+    def close(self):
+        """Release resources held by the cache"""
+    
+    async def stats(self):
+        """Return size and hit/miss counters"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class PersistentExtractionCache(ExtractionCache):
+    """Extraction cache backed by SQLite so results survive restarts and cog reloads.
+    
+    The in-memory LRU stays in front of the database; disk is only read on a memory miss.
+    All database work runs on one background thread, so writes never block the event loop
+    and a read always sees the writes queued before it.
+    """
+    
+    # Delete expired rows after this many writes
+    PRUNE_INTERVAL = 256
+    
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._writes = 0
+        
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS extraction_cache ('
+            'key TEXT PRIMARY KEY, expires_at REAL, stream_expires_at REAL, data TEXT)'
+        )
+        self._prune()
+        
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='extraction-cache')
+    
+    async def get_async(self, key, *, loop, need_stream=False):
+        entry = super()._load(key)
+        if entry is None:
+            entry = self._promote(key, await loop.run_in_executor(self._io, self._read, key))
+        return self._check(key, entry, need_stream)
+    
+    def _load(self, key):
+        entry = super()._load(key)
+        if entry is not None:
+            return entry
+        return self._promote(key, self._io.submit(self._read, key).result())
+    
+    def _promote(self, key, entry):
+        """Copy an entry read from disk into memory so the next lookup skips the database"""
+        if entry is not None:
+            super()._store(key, entry)
+        return entry
+    
+    def _read(self, key):
+        """Fetch an unexpired row (runs on the database thread)"""
+        try:
+            row = self._db.execute(
+                'SELECT expires_at, stream_expires_at, data FROM extraction_cache WHERE key = ?', (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Extraction cache read failed: {e}")
+            return None
+        
+        if row is None or row[0] <= time.time():
+            return None
+        return (row[0], row[1], json.loads(row[2]))
+    
+    def _store(self, key, entry):
+        super()._store(key, entry)
+        self._io.submit(self._write, key, entry)
+    
+    def _write(self, key, entry):
+        """Persist one entry (runs on the database thread)"""
+        try:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO extraction_cache VALUES (?, ?, ?, ?)',
+                    (key, entry[0], entry[1], json.dumps(entry[2]))
+                )
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logger.warning(f"Extraction cache write failed: {e}")
+            return
+        
+        self._writes += 1
+        if self._writes % self.PRUNE_INTERVAL == 0:
+            self._prune()
+    
+    def _prune(self):
+        """Delete rows whose metadata has expired"""
+        try:
+            with self._db:
+                self._db.execute('DELETE FROM extraction_cache WHERE expires_at <= ?', (time.time(),))
+        except sqlite3.Error as e:
+            logger.warning(f"Extraction cache prune failed: {e}")
+    
+    def _clear_rows(self):
+        with self._db:
+            self._db.execute('DELETE FROM extraction_cache')
+    
+    def _count_rows(self):
+        try:
+            return self._db.execute('SELECT COUNT(*) FROM extraction_cache').fetchone()[0]
+        except sqlite3.Error:
+            return 0
+    
+    async def clear(self):
+        await super().clear()
+        await asyncio.get_running_loop().run_in_executor(self._io, self._clear_rows)
+    
+    def close(self):
+        """Flush queued writes and close the database"""
+        self._io.shutdown(wait=True)
+        self._db.close()
+    
+    async def stats(self):
+        stats = await super().stats()
+        stats['disk_size'] = await asyncio.get_running_loop().run_in_executor(self._io, self._count_rows)
+        return stats
+
+
+def create_extraction_cache():
+    """Build the extraction cache configured through the environment"""
+    if EXTRACTION_CACHE_DIR:
+        path = os.path.join(EXTRACTION_CACHE_DIR, 'extraction_cache.sqlite3')
+        try:
+            return PersistentExtractionCache(path)
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"Could not open extraction cache at {path}, using memory only: {e}")
+    return ExtractionCache()
+
+
+# Shared by every guild the bot is in. Opened by the cog in the bot process only,
+# since extractor workers import this module too; lookups skip it until then.
+extraction_cache = None
+
+# Read from the counters the cache already keeps; replaced along with the cache on reload
+registry.register(CallbackGauge('bot_extraction_cache_hits_total', 'Extraction cache lookups answered from the cache',
+                                lambda: extraction_cache.hits if extraction_cache is not None else None,
+                                kind='counter'))
+registry.register(CallbackGauge('bot_extraction_cache_misses_total', 'Extraction cache lookups that needed yt-dlp',
+                                lambda: extraction_cache.misses if extraction_cache is not None else None,
+                                kind='counter'))
+
+
+class AudioCache:
+    """Disk cache of frequently played songs, transcoded to Ogg Opus.
+    
+    Plays are counted per song in a SQLite index next to the files. Once a song
+    has been played ``min_plays`` times it is transcoded in the background, and
+    later plays read the local file instead of streaming it again. The least
+    recently played files are evicted to stay under ``max_bytes``. Sizes are
+    checked on every lookup and SHA-256 checksums on the first lookup after a
+    start, so a truncated or corrupted file is dropped instead of played.
+    """
+    
+    # Leftover files younger than this may belong to a transcode that is still running
+    STALE_SECONDS = 600
+    
+    def __init__(self, directory, *, max_bytes, min_plays=AUDIO_CACHE_MIN_PLAYS,
+                 max_duration=AUDIO_CACHE_MAX_DURATION):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.max_duration = max_duration
+        
+        self.hits = 0
+        self.misses = 0
+        self._verified = set()  # Keys whose checksum was checked by this process
+        self._storing = set()  # Keys being transcoded right now
+        self._tasks = set()  # Background play counting and transcodes, finished before closing
+        self._lock = threading.Lock()  # Lookups run on executor threads
+        
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS audio_cache ('
+            'key TEXT PRIMARY KEY, plays INTEGER, last_used REAL, file TEXT, size INTEGER, sha256 TEXT)'
+        )
+        self._reconcile()
+    
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.ogg')
+    
+    def _reconcile(self):
+        """Bring the index and the directory back in line after a crash or manual cleanup"""
+        with self._lock, self._db:
+            files = {row[0] for row in self._db.execute('SELECT file FROM audio_cache WHERE file IS NOT NULL')}
+            stale = time.time() - self.STALE_SECONDS
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.endswith('.part') or (name.endswith('.ogg') and path not in files):
+                    try:
+                        if os.path.getmtime(path) < stale:
+                            os.remove(path)
+                    except OSError:
+                        pass
+            for path in files:
+                if not os.path.exists(path):
+                    self._db.execute('UPDATE audio_cache SET file = NULL, size = NULL, sha256 = NULL '
+                                     'WHERE file = ?', (path,))
+            # Forget play counts of songs nobody played for a month
+            self._db.execute('DELETE FROM audio_cache WHERE file IS NULL AND last_used < ?',
+                             (time.time() - 30 * 86400,))
+    
+    def lookup(self, url):
+        """Return the cached file for a song, or None. Blocking, run it in an executor."""
+        key = cache_key(url)
+        with self._lock:
+            row = self._db.execute('SELECT file, size, sha256 FROM audio_cache WHERE key = ? AND file IS NOT NULL',
+                                   (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        
+        path, size, digest = row
+        try:
+            intact = os.path.getsize(path) == size
+            if intact and key not in self._verified:
+                intact = self._digest(path) == digest
+        except OSError:
+            intact = False
+        if not intact:
+            logger.warning(f"Dropping damaged audio cache file for {key}")
+            self._drop(key, path)
+            self.misses += 1
+            return None
+        
+        self._verified.add(key)
+        with self._lock, self._db:
+            self._db.execute('UPDATE audio_cache SET last_used = ? WHERE key = ?', (time.time(), key))
+        self.hits += 1
+        return path
+    
+    def record_play(self, track):
+        """Count a play of ``track``; True if it has become popular enough to be cached"""
+        # Downloads and cached files are local already, live streams never end
+        if track.is_local or not track.duration or track.duration > self.max_duration:
+            return False
+        
+        key = cache_key(track.webpage_url)
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT INTO audio_cache (key, plays, last_used) VALUES (?, 1, ?) '
+                'ON CONFLICT(key) DO UPDATE SET plays = plays + 1, last_used = excluded.last_used',
+                (key, time.time())
+            )
+            plays, path = self._db.execute('SELECT plays, file FROM audio_cache WHERE key = ?', (key,)).fetchone()
+        return path is None and plays >= self.min_plays and key not in self._storing
+    
+    def played(self, track, *, loop):
+        """Count a play in the background and cache the song once it is popular"""
+        task = loop.create_task(self._played(track))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _played(self, track):
+        if await self._run_blocking(self.record_play, track):
+            await self.store(track)
+    
+    @staticmethod
+    async def _run_blocking(func, *args):
+        """Run ``func`` on an executor thread; if cancelled, wait for it so the database stays open for it"""
+        future = asyncio.get_running_loop().run_in_executor(None, func, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.wait([future])
+            raise
+    
+    async def store(self, track):
+        """Transcode a song from its stream URL into the cache"""
+        key = cache_key(track.webpage_url)
+        if key in self._storing:
+            return
+        self._storing.add(key)
+        
+        path = self._path(key)
+        try:
+            # Unique, as another process of a cluster may be transcoding the same song
+            fd, part = tempfile.mkstemp(suffix='.part', prefix=os.path.basename(path) + '.', dir=self.directory)
+            os.close(fd)
+        except OSError as e:
+            logger.warning(f"Could not cache audio of {track.title}: {e}")
+            self._storing.discard(key)
+            return
+        
+        # Opus streams only need a new container
+        codec = ['-c:a', 'copy'] if track.codec == 'opus' else ['-c:a', 'libopus', '-b:a', f'{AUDIO_BITRATE}k']
+        args = [*shlex.split(ffmpegopts['before_options']), '-loglevel', 'error', '-i', track.stream_url,
+                '-vn', '-map_metadata', '-1', *codec, '-f', 'ogg', '-y', part]
+        try:
+            process = await asyncio.create_subprocess_exec(
+                'ffmpeg', *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+            )
+            ffmpeg_processes.inc()
+            try:
+                _, error = await process.communicate()
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                raise
+            finally:
+                ffmpeg_processes.dec()
+            if process.returncode != 0:
+                raise OSError(error.decode(errors='replace').strip()[-200:] or f"exit code {process.returncode}")
+            
+            await self._run_blocking(self._commit, key, part, path)
+            logger.info(f"Cached audio of {track.title}")
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Could not cache audio of {track.title}: {e}")
+            self._remove_part(part)
+        except asyncio.CancelledError:
+            self._remove_part(part)
+            raise
+        finally:
+            self._storing.discard(key)
+    
+    @staticmethod
+    def _remove_part(part):
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+    
+    def _commit(self, key, part, path):
+        size = os.path.getsize(part)
+        if not size:
+            raise OSError("FFmpeg produced an empty file")
+        digest = self._digest(part)
+        
+        # The write transaction makes processes sharing the cache take turns; the
+        # first to finish a song keeps its file and later transcodes are dropped
+        with self._lock, self._db:
+            claimed = self._db.execute(
+                'UPDATE audio_cache SET file = ?, size = ?, sha256 = ?, last_used = ? WHERE key = ? AND file IS NULL',
+                (path, size, digest, time.time(), key)
+            ).rowcount
+            if claimed:
+                os.replace(part, path)
+        if not claimed:
+            os.remove(part)
+            return
+        self._verified.add(key)
+        self._evict()
+    
+    def _evict(self):
+        """Delete the least recently played files until the cache fits ``max_bytes``"""
+        with self._lock:
+            total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM audio_cache').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = self._db.execute('SELECT key, file, size FROM audio_cache WHERE file IS NOT NULL '
+                                    'ORDER BY last_used').fetchall()
+        
+        for key, path, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._drop(key, path)
+            total -= size
+    
+    def _drop(self, key, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        self._verified.discard(key)
+        with self._lock, self._db:
+            self._db.execute('UPDATE audio_cache SET file = NULL, size = NULL, sha256 = NULL WHERE key = ?', (key,))
+    
+    @staticmethod
+    def _digest(path):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(partial(file.read, 1 << 20), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+    
+    async def aclose(self):
+        """Cancel background plays and transcodes, then close the index"""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.close()
+    
+    def close(self):
+        self._db.close()
+    
+    def stats(self):
+        """Return file count, bytes on disk and hit/miss counters"""
+        with self._lock:
+            files, size = self._db.execute(
+                'SELECT COUNT(file), COALESCE(SUM(size), 0) FROM audio_cache'
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'files': files,
+            'bytes': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def create_audio_cache():
+    """Build the audio cache configured through the environment, None when it is off"""
+    if not AUDIO_CACHE_DIR:
+        return None
+    try:
+        return AudioCache(AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_MAX_MB * 1024 * 1024)
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Could not open the audio cache at {AUDIO_CACHE_DIR}: {e}")
+        return None
+
+
+# Opened by the cog in the bot process only; extractor workers import this module too
+audio_cache = None
+
+registry.register(CallbackGauge('bot_audio_cache_hits_total', 'Songs played from the audio cache',
+                                lambda: audio_cache.hits if audio_cache is not None else None, kind='counter'))
+registry.register(CallbackGauge('bot_audio_cache_misses_total', 'Audio cache lookups without a cached file',
+                                lambda: audio_cache.misses if audio_cache is not None else None, kind='counter'))
+
+
+async def load_cached_audio(track, *, loop):
+    """Point a track at its cached file if it has one; returns whether it does"""
+    if audio_cache is None or track.is_local:
+        return False
+    path = await loop.run_in_executor(None, audio_cache.lookup, track.webpage_url)
+    if path is None:
+        return False
+    track.set_local(path)
+    track.codec = 'opus'
+    return True
+
+
+class ExtractorBusy(commands.CommandError):
+    """Raised when the extractor pool queue is full."""
+
+
+def _extract(query, flat=False, download=False):
+    """Run a blocking yt-dlp extraction and return the slimmed info dict.
+    
+    Defined at module level so process workers can unpickle it. Slimming happens
+    in the worker, so only a few hundred bytes travel back to the bot process.
+    """
+    instance = ytdl_flat if flat else ytdl
+    return slim_info(instance.extract_info(query, download=download))
+
+
+def _open_playlist(url):
+    """Fetch the first page of a playlist and return (title, lazy iterator over its entries)"""
+    info = ytdl_playlist.extract_info(url, download=False, process=False)
+    entries = info.get('entries') or []
+    if isinstance(entries, youtube_dl.utils.PagedList):
+        entries = _iter_paged(entries)
+    return info.get('title') or 'Playlist', iter(entries)
+
+
+def _iter_paged(paged):
+    """Iterate over a yt-dlp PagedList one batch at a time"""
+    start = 0
+    while True:
+        batch = paged.getslice(start, start + PLAYLIST_BATCH_SIZE)
+        if not batch:
+            return
+        yield from batch
+        start += len(batch)
+
+
+def _next_entries(entries, count):
+    """Read up to ``count`` entries from a playlist iterator (may fetch the next page)"""
+    return [slim_info(entry) for entry in itertools.islice(entries, count) if entry]
+
+
+def _init_extractor_worker():
+    """Prepare an extractor worker process"""
+    # The bot process owns shutdown; Ctrl+C should not kill workers mid-extraction
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    
+    # Importing this module created the worker's own YoutubeDL instances. Load the
+    # YouTube extractor now so the first real lookup does not pay for it.
+    try:
+        ytdl.get_info_extractor('Youtube')
+    except Exception:
+        pass
+
+
+def _worker_ready():
+    """No-op job used to start worker processes ahead of time"""
+    return os.getpid()
+
+
+class ExtractorPool:
+    """Dedicated, bounded worker pool for yt-dlp extraction.
+    
+    Jobs wait in per-guild queues that are served round-robin, so one guild
+    queueing a burst of songs cannot starve the others. The pool never touches
+    the event loop's default executor.
+    """
+    
+    # Number of recent queue wait times kept for percentiles
+    WAIT_SAMPLES = 1000
+    
+    def __init__(self, workers=EXTRACTOR_WORKERS, backend=EXTRACTOR_BACKEND,
+                 max_pending=EXTRACTOR_MAX_PENDING, max_pending_per_guild=EXTRACTOR_MAX_PENDING_PER_GUILD):
+        if backend not in ('thread', 'process'):
+            logger.warning(f"Unknown extractor backend '{backend}', using threads")
+            backend = 'thread'
+        
+        self.workers = max(1, workers)
+        self.backend = backend
+        self.max_pending = max_pending
+        self.max_pending_per_guild = max_pending_per_guild
+        
+        self._executor = None
+        self._thread_executor = None  # Jobs holding unpicklable state, when the backend is process
+        self._queues = OrderedDict()  # guild id -> deque of waiting jobs, in round-robin order
+        self._pending = 0
+        self._running = 0
+        
+        # Queue wait time metrics
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._recent_waits = deque(maxlen=self.WAIT_SAMPLES)
+    
+    def _get_executor(self):
+        """Create the executor on first use"""
+        if self._executor is None:
+            if self.backend == 'process':
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(EXTRACTOR_START_METHOD),
+                    initializer=_init_extractor_worker
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ytdl')
+        return self._executor
+    
+    def _get_thread_executor(self):
+        """Executor for jobs that must run in this process"""
+        if self.backend == 'thread':
+            return self._get_executor()
+        if self._thread_executor is None:
+            self._thread_executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ytdl')
+        return self._thread_executor
+    
+    async def warm_up(self, loop=None):
+        """Start every process worker now instead of on the first request"""
+        if self.backend != 'process':
+            return
+        loop = loop or asyncio.get_event_loop()
+        executor = self._get_executor()
+        pids = await asyncio.gather(*(loop.run_in_executor(executor, _worker_ready)
+                                      for _ in range(self.workers)))
+        logger.info(f"Extractor pool started {len(set(pids))} worker processes")
+    
+    async def run(self, fn, *args, loop=None, guild_id=None, local=False):
+        """Queue a blocking call and wait for its result.
+        
+        ``local`` jobs always run on a thread of this process, for work on objects
+        that cannot be sent to a worker process (e.g. a lazy playlist generator).
+        """
+        loop = loop or asyncio.get_event_loop()
+        
+        queue = self._queues.get(guild_id)
+        if (self._pending >= self.max_pending or
+                (queue is not None and len(queue) >= self.max_pending_per_guild)):
+            self.rejected += 1
+            raise ExtractorBusy('The bot is busy looking up other songs. Please try again in a moment.')
+        
+        if queue is None:
+            queue = self._queues[guild_id] = deque()
+        
+        future = loop.create_future()
+        queue.append((fn, args, local, future, time.perf_counter()))
+        self._pending += 1
+        self._dispatch(loop)
+        
+        return await future
+    
+    def _dispatch(self, loop):
+        """Start queued jobs while there are idle workers"""
+        while self._running < self.workers and self._queues:
+            # Take one job from the guild at the front, then move that guild to the back
+            guild_id, queue = next(iter(self._queues.items()))
+            fn, args, local, future, enqueued_at = queue.popleft()
+            del self._queues[guild_id]
+            if queue:
+                self._queues[guild_id] = queue
+            self._pending -= 1
+            
+            if future.done():
+                # The caller gave up while waiting
+                continue
+            
+            wait = time.perf_counter() - enqueued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self._recent_waits.append(wait)
+            
+            self._running += 1
+            executor = self._get_thread_executor() if local else self._get_executor()
+            job = loop.run_in_executor(executor, fn, *args)
+            job.add_done_callback(partial(self._finished, loop, future))
+    
+    def _finished(self, loop, future, job):
+        """Hand a finished job's result to its caller and start the next job"""
+        self._running -= 1
+        self.completed += 1
+        
+        if not future.done():
+            if job.cancelled():
+                future.cancel()
+            elif isinstance(job.exception(), BrokenExecutor):
+                # A worker process died (e.g. OOM-killed); start a fresh pool for later jobs
+                if self._executor is not None:
+                    logger.error("Extractor pool broke, restarting it")
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+                future.set_exception(commands.CommandError('The song lookup failed, please try again.'))
+            elif job.exception() is not None:
+                future.set_exception(job.exception())
+            else:
+                future.set_result(job.result())
+        
+        self._dispatch(loop)
+    
+    def shutdown(self):
+        """Stop the workers without waiting for running extractions"""
+        for executor in (self._executor, self._thread_executor):
+            if executor is not None:
+                executor.shutdown(wait=False)
+        self._executor = None
+        self._thread_executor = None
+    
+    def stats(self):
+        """Return pool utilisation and queue wait time statistics"""
+        waits = sorted(self._recent_waits)
+        return {
+            'backend': self.backend,
+            'workers': self.workers,
+            'running': self._running,
+            'pending': self._pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'avg_wait': self.total_wait / self.completed if self.completed else 0.0,
+            'p95_wait': waits[int(len(waits) * 0.95)] if waits else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+# Shared by every guild the bot is in
+extractor_pool = ExtractorPool()
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one shared in-flight task"""
+    
+    def __init__(self):
+        self._inflight = {}
+        self.started = 0
+        self.coalesced = 0
+    
+    async def do(self, key, factory, *, loop):
+        """Await the in-flight task for ``key``, or start one with ``factory()``"""
+        task = self._inflight.get(key)
+        if task is None:
+            self.started += 1
+            task = loop.create_task(factory())
+            self._inflight[key] = task
+            task.add_done_callback(partial(self._forget, key))
+        else:
+            self.coalesced += 1
+        
+        # Shield so one caller giving up does not cancel the lookup for everybody else
+        return await asyncio.shield(task)
+    
+    def _forget(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark the exception as retrieved even if every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+    
+    def stats(self):
+        """Return the number of started and coalesced lookups"""
+        return {'inflight': len(self._inflight), 'started': self.started, 'coalesced': self.coalesced}
+
+
+# Identical lookups from any guild share one extraction
+extraction_flights = SingleFlight()
+
+
+async def fetch_info(query, *, loop, flat=False, need_stream=False, fresh=False, guild_id=None):
+    """Extract info for a URL or search query through the shared cache.
+    
+    Concurrent lookups of the same key share one extraction; ``fresh`` skips the
+    cache lookup. The returned dict is shared with the cache and must be treated
+    as read-only.
+    """
+    key = cache_key(query, flat=flat)
+    if not fresh and extraction_cache is not None:
+        data = await extraction_cache.get_async(key, loop=loop, need_stream=need_stream)
+        if data is not None:
+            return data
+    
+    return await extraction_flights.do(
+        key, partial(_extract_and_cache, key, query, flat, loop=loop, guild_id=guild_id), loop=loop
+    )
+
+
+async def _extract_and_cache(key, query, flat, *, loop, guild_id):
+    """Run one extraction on the pool and store the result"""
+    data = await extractor_pool.run(_extract, query, flat, loop=loop, guild_id=guild_id)
+    if extraction_cache is None:
+        return data
+    extraction_cache.put(key, data)
+    
+    # Make a resolved search result reachable through the video it found
+    if not flat and data.get('entries') and data['entries'][0].get('webpage_url'):
+        first = data['entries'][0]
+        extraction_cache.put(cache_key(first['webpage_url']), first)
+    
+    return data
+
 
 class VoiceConnectionError(commands.CommandError):
     """Custom Exception class for connection errors."""
@@ -74,30 +1022,461 @@ class InvalidVoiceChannel(VoiceConnectionError):
     """Exception for cases of invalid Voice Channels."""
 
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    """Enhanced audio source class with better error handling and metadata"""
+class Track:
+    """Compact queue entry holding only what playback and embeds need.
     
-    def __init__(self, source, *, data, requester):
-        self.original = source
-
-        super().__init__(source)
+    Queue memory scales with the number of entries instead of with the size of
+    yt-dlp's info dicts (formats, thumbnails, descriptions, ...).
+    """
+    
+    __slots__ = ('id', 'title', 'webpage_url', 'duration', 'thumbnail', 'uploader', 'uploader_url',
+                 'upload_date', 'view_count', 'requester', 'stream_url', 'stream_expires_at', 'codec',
+                 'gain_db', 'requested_at', '_display')
+    
+    def __init__(self, *, title, webpage_url, requester, id='', duration=0, thumbnail='',
+                 uploader='Unknown', uploader_url='', upload_date='', view_count=0):
+        self.id = id
+        self.title = title
+        self.webpage_url = webpage_url
+        self.duration = duration
+        self.thumbnail = thumbnail
+        self.uploader = uploader
+        self.uploader_url = uploader_url
+        self.upload_date = upload_date
+        self.view_count = view_count
         self.requester = requester
         
-        # Extract all available metadata
-        self.title = data.get('title', 'Unknown Title')
-        self.web_url = data.get('webpage_url', '')
-        self.duration = data.get('duration', 0)
-        self.thumbnail = data.get('thumbnail', '')
-        self.uploader = data.get('uploader', 'Unknown')
-        self.uploader_url = data.get('uploader_url', '')
-        self.upload_date = data.get('upload_date', '')
-        self.description = data.get('description', '')
-        self.view_count = data.get('view_count', 0)
-        self.like_count = data.get('like_count', 0)
-        self.stream_url = data.get('url', '')
+        # Filled in once the stream URL has been resolved
+        self.stream_url = None
+        self.stream_expires_at = 0
+        self.codec = None  # Audio codec of the stream, None until known
+        self.gain_db = None  # Loudness normalization gain, None until analysed
+        self.requested_at = None  # perf_counter() of a play command that should start this track right away
+        self._display = None  # TrackDisplay, formatted on first use
+    
+    @classmethod
+    def from_info(cls, data, requester):
+        """Build a track from a yt-dlp info dict, keeping the stream URL if it has one"""
+        track = cls(
+            id=data.get('id') or '',
+            title=data.get('title') or 'Unknown Title',
+            webpage_url=data.get('webpage_url') or data.get('url') or '',
+            requester=requester,
+            duration=int(data.get('duration') or 0),
+            thumbnail=data.get('thumbnail') or '',
+            uploader=data.get('uploader') or 'Unknown',
+            uploader_url=data.get('uploader_url') or '',
+            upload_date=data.get('upload_date') or '',
+            view_count=data.get('view_count') or 0
+        )
+        # Flat entries (_type 'url') point at the video page rather than at a stream
+        if data.get('url') and data.get('_type') != 'url':
+            track.set_stream(data)
+        return track
+    
+    def set_stream(self, data):
+        """Remember a resolved stream URL and fill in metadata the track was created without"""
+        self.stream_url = data['url']
+        # Dicts from the extraction cache carry the expiry the cache gave the URL when it was extracted
+        self.stream_expires_at = data.get('_stream_expires_at') or stream_expiry(self.stream_url)
+        self.codec = data.get('acodec') if data.get('acodec') not in (None, 'none') else None
+        
+        # Entries from flat extraction only carry a few fields
+        if not self.duration:
+            self.duration = int(data.get('duration') or 0)
+        if not self.thumbnail:
+            self.thumbnail = data.get('thumbnail') or ''
+        if not self.uploader_url:
+            self.uploader_url = data.get('uploader_url') or ''
+        if self.uploader == 'Unknown':
+            self.uploader = data.get('uploader') or 'Unknown'
+        if not self.view_count:
+            self.view_count = data.get('view_count') or 0
+        self._display = None  # Formatted again with the new metadata
+    
+    def set_local(self, path):
+        """Point the track at a downloaded file, which never expires"""
+        self.stream_url = path
+        self.stream_expires_at = float('inf')
+    
+    def invalidate(self):
+        """Forget the stream URL, e.g. after it failed to load"""
+        self.stream_url = None
+        self.stream_expires_at = 0
+        self.codec = None
+    
+    @property
+    def display(self):
+        """Text shown for the track in embeds"""
+        if self._display is None:
+            self._display = TrackDisplay(self)
+        return self._display
+    
+    @property
+    def is_local(self):
+        """Whether the track plays from a file on disk (download or audio cache)"""
+        return self.stream_expires_at == float('inf')
+    
+    def has_fresh_stream(self):
+        """Check whether the track holds a stream URL that is not about to expire"""
+        return bool(self.stream_url) and self.stream_expires_at - STREAM_URL_MARGIN > time.time()
+    
+    @property
+    def gain(self):
+        """Linear normalization gain"""
+        return 10 ** (self.gain_db / 20) if self.gain_db else 1.0
+    
+    @property
+    def state(self):
+        """Resolution state: 'unresolved', 'resolved' or 'expiring' (URL near or past expiry)"""
+        if not self.stream_url:
+            return 'unresolved'
+        return 'resolved' if self.has_fresh_stream() else 'expiring'
+    
+    def __repr__(self):
+        return f'<Track title={self.title!r} url={self.webpage_url!r}>'
+
+
+class TrackDisplay:
+    """Embed text of a track, formatted once rather than by every command and now playing update.
+    
+    Built on first use, so tracks that sit in a long queue without being shown
+    cost nothing extra.
+    """
+    
+    __slots__ = ('link', 'duration', 'uploader', 'views', 'uploaded', 'requester', 'queue_entry')
+    
+    def __init__(self, track):
+        self.link = f"[{track.title}]({track.webpage_url})"
+        self.duration = YTDLSource.format_duration(track.duration)
+        self.uploader = f"[{track.uploader}]({track.uploader_url})" if track.uploader_url else track.uploader
+        self.views = f"{track.view_count:,}" if track.view_count else ''
+        # yt-dlp dates are YYYYMMDD
+        date = track.upload_date
+        self.uploaded = f"{date[:4]}-{date[4:6]}-{date[6:]}" if len(date) == 8 and date.isdigit() else ''
+        self.requester = track.requester.mention if track.requester is not None else ''
+        self.queue_entry = f"{self.link} | `{self.duration}` | {self.requester}"
+
+
+class TrackQueue:
+    """Async FIFO of tracks for a MusicPlayer.
+    
+    Backed by a deque so pushes and pops are O(1), with the indexed operations
+    the queue commands need (remove, move, shuffle, paging) done in place
+    instead of rebuilding an ``asyncio.Queue`` through its private ``_queue``.
+    """
+    
+    def __init__(self, on_resize=None, on_reorder=None):
+        self._items = deque()
+        self._getters = deque()  # Futures of get() calls waiting for a track
+        
+        # Kept up to date on every change so !queue does not have to sum the queue
+        self.total_duration = 0
         
-        # Set initial volume
-        self.volume = DEFAULT_VOLUME
+        # Called with the change in length whenever tracks are added or removed
+        self._on_resize = on_resize
+        # Called when tracks change places without the length changing
+        self._on_reorder = on_reorder
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def __iter__(self):
+        return iter(self._items)
+    
+    def __getitem__(self, index):
+        return self._items[index]
+    
+    def qsize(self):
+        """Number of tracks in the queue"""
+        return len(self._items)
+    
+    def empty(self):
+        """Return True if the queue holds no tracks"""
+        return not self._items
+    
+    def put_nowait(self, track):
+        """Append a track to the end of the queue"""
+        self._items.append(track)
+        self.total_duration += track.duration or 0
+        self._resized(1)
+        self._wakeup_next()
+    
+    async def put(self, track):
+        """Append a track to the end of the queue"""
+        self.put_nowait(track)
+    
+    def get_nowait(self):
+        """Remove and return the first track, raising QueueEmpty if there is none"""
+        if not self._items:
+            raise asyncio.QueueEmpty
+        track = self._items.popleft()
+        self.total_duration -= track.duration or 0
+        self._resized(-1)
+        return track
+    
+    async def get(self):
+        """Remove and return the first track, waiting until one is available"""
+        while not self._items:
+            getter = asyncio.get_running_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except BaseException:
+                getter.cancel()
+                try:
+                    self._getters.remove(getter)
+                except ValueError:
+                    pass
+                # Pass a wakeup we consumed on to the next waiter
+                if self._items and not getter.cancelled():
+                    self._wakeup_next()
+                raise
+        return self.get_nowait()
+    
+    def _resized(self, delta):
+        if self._on_resize is not None:
+            self._on_resize(delta)
+    
+    def _reordered(self):
+        if self._on_reorder is not None:
+            self._on_reorder()
+    
+    def _wakeup_next(self):
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+    
+    def peek(self, count):
+        """Return the first ``count`` tracks without removing them"""
+        return list(itertools.islice(self._items, 0, count))
+    
+    def page(self, start, end):
+        """Return the tracks at positions ``start`` to ``end`` (0-based, end exclusive)"""
+        size = len(self._items)
+        end = min(end, size)
+        if start >= end:
+            return []
+        if start > size // 2:
+            # Walk from the nearer end for pages near the back of a long queue
+            tail = list(itertools.islice(reversed(self._items), size - end, size - start))
+            tail.reverse()
+            return tail
+        return list(itertools.islice(self._items, start, end))
+    
+    def remove(self, index):
+        """Remove and return the track at ``index`` (0-based)"""
+        track = self._items[index]
+        del self._items[index]
+        self.total_duration -= track.duration or 0
+        self._resized(-1)
+        return track
+    
+    def move(self, from_index, to_index):
+        """Move the track at ``from_index`` to ``to_index`` (0-based) and return it"""
+        track = self._items[from_index]
+        del self._items[from_index]
+        self._items.insert(to_index, track)
+        self._reordered()
+        return track
+    
+    def shuffle(self):
+        """Shuffle the queue in place"""
+        # Shuffling a deque directly is O(n^2) because of its indexing cost
+        tracks = list(self._items)
+        random.shuffle(tracks)
+        self._items.clear()
+        self._items.extend(tracks)
+        self._reordered()
+    
+    def clear(self):
+        """Remove every track and return how many were removed"""
+        count = len(self._items)
+        self._items.clear()
+        self.total_duration = 0
+        if count:
+            self._resized(-count)
+        return count
+
+
+def scale_pcm(data, gain):
+    """Scale 16-bit stereo PCM by ``gain``, saturating instead of wrapping around"""
+    # Boosts need clipping, which audioop does natively and cheaper than NumPy
+    if gain > 1.0:
+        return audioop.mul(data, 2, gain)
+    
+    samples = numpy.frombuffer(data, numpy.int16) * numpy.float32(gain)
+    return samples.astype(numpy.int16).tobytes()
+
+
+async def analyse_loudness(track):
+    """Measure the start of a track with FFmpeg and store the gain that normalizes it"""
+    args = [*shlex.split(ffmpegopts['before_options']), '-t', str(LOUDNESS_SCAN_SECONDS),
+            '-i', track.stream_url, '-vn', '-af', 'volumedetect', '-f', 'null', '-']
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+        ffmpeg_processes.inc()
+        try:
+            _, output = await process.communicate()
+        finally:
+            ffmpeg_processes.dec()
+    except OSError as e:
+        logger.warning(f"Loudness scan failed for {track.title}: {e}")
+        output = b''
+    
+    match = re.search(rb'mean_volume: (-?[\d.]+) dB', output)
+    if match is None:
+        track.gain_db = 0.0  # Play unchanged rather than scanning again
+    else:
+        # Quiet songs are boosted less than loud ones are cut, to limit clipping
+        track.gain_db = max(-12.0, min(6.0, LOUDNESS_TARGET - float(match.group(1))))
+    return track.gain_db
+
+
+class GainTransformer(discord.AudioSource):
+    """Applies the volume and a normalization gain to PCM frames.
+    
+    Replaces discord.PCMVolumeTransformer: frames pass through untouched at unity
+    gain, are attenuated with NumPy when it is installed and boosted with
+    audioop. Changing the volume only recomputes one factor.
+    """
+    
+    def __init__(self, original, volume=1.0):
+        if original.is_opus():
+            raise discord.ClientException('AudioSource must not be Opus encoded.')
+        
+        self.original = original
+        self._gain_db = 0.0
+        self.volume = volume
+    
+    @property
+    def volume(self):
+        return self._volume
+    
+    @volume.setter
+    def volume(self, value):
+        self._volume = max(value, 0.0)
+        self._update_gain()
+    
+    @property
+    def gain_db(self):
+        return self._gain_db
+    
+    @gain_db.setter
+    def gain_db(self, value):
+        self._gain_db = value
+        self._update_gain()
+    
+    def _update_gain(self):
+        self._gain = min(self._volume * 10 ** (self._gain_db / 20), 4.0)
+    
+    def cleanup(self):
+        # Also reached from __del__ when __init__ rejected the source
+        original = getattr(self, 'original', None)
+        if original is not None:
+            original.cleanup()
+    
+    def read(self):
+        data = self.original.read()
+        if self._gain == 1.0 or not data:
+            return data
+        return scale_pcm(data, self._gain)
+
+
+# Audio returned by one read() of a source
+FRAME_SECONDS = discord.opus.Encoder.FRAME_LENGTH / 1000
+
+
+class TrackSource:
+    """Metadata accessors shared by the audio sources, read from ``self.track``"""
+    
+    # When FFmpeg was started and with which profile, for time-to-first-frame stats
+    opened_at = None
+    profile = FFMPEG_PROFILE
+    
+    # Whether this source is counted in bot_ffmpeg_processes
+    _counted = False
+    
+    # The frame of the song the source was opened at (after a seek) and the frames
+    # read since. Counted in the read path, so the position needs no clock.
+    start_frame = 0
+    frames_read = 0
+    
+    def read(self):
+        data = super().read()
+        if data:
+            self.frames_read += 1
+        return data
+    
+    @property
+    def frame(self):
+        """Index of the next frame of the song"""
+        return self.start_frame + self.frames_read
+    
+    @property
+    def position(self):
+        """Playback position in seconds, exact to one frame (20 ms)"""
+        return self.frame * FRAME_SECONDS
+    
+    def count_process(self):
+        """Count the FFmpeg process of this source until it is cleaned up"""
+        if not self._counted:
+            self._counted = True
+            ffmpeg_processes.inc()
+    
+    def cleanup(self):
+        if self._counted:
+            self._counted = False
+            ffmpeg_processes.dec()
+        super().cleanup()
+    
+    @property
+    def requester(self):
+        return self.track.requester
+    
+    @property
+    def title(self):
+        return self.track.title
+    
+    @property
+    def web_url(self):
+        return self.track.webpage_url
+    
+    @property
+    def webpage_url(self):
+        return self.track.webpage_url
+    
+    @property
+    def duration(self):
+        return self.track.duration
+    
+    @property
+    def thumbnail(self):
+        return self.track.thumbnail
+    
+    @property
+    def uploader(self):
+        return self.track.uploader
+    
+    @property
+    def uploader_url(self):
+        return self.track.uploader_url
+    
+    @property
+    def view_count(self):
+        return self.track.view_count
+    
+    @property
+    def stream_url(self):
+        return self.track.stream_url
+    
+    @property
+    def display(self):
+        return self.track.display
 
     def __del__(self):
         try:
@@ -109,6 +1488,47 @@ class YTDLSource(discord.PCMVolumeTransformer):
         """Allows us to access attributes similar to a dict."""
         return self.__getattribute__(item)
 
+
+class YTDLOpusSource(TrackSource, discord.FFmpegOpusAudio):
+    """Audio source that sends Opus packets from FFmpeg straight to Discord.
+    
+    Streams that already are Opus are copied without being decoded; anything
+    else is encoded by FFmpeg instead of in the bot process. Volume is applied
+    by FFmpeg when the source is opened and cannot change while it plays.
+    """
+    
+    def __init__(self, track, *, volume=1.0, copy=None, profile=FFMPEG_PROFILE, before_options=None):
+        gain = volume * track.gain
+        # Copy Opus when that loses nothing, unless told otherwise
+        self.passthrough = track.codec == 'opus' and gain == 1.0 if copy is None else copy
+        options = FFMPEG_PROFILES[profile]['options']
+        if not self.passthrough and gain != 1.0:
+            options = f'{options} -af volume={gain:.3f}'
+        
+        self.opened_at = time.perf_counter()
+        self.profile = profile
+        super().__init__(track.stream_url, bitrate=AUDIO_BITRATE, codec='copy' if self.passthrough else 'libopus',
+                         before_options=before_options or FFMPEG_PROFILES[profile]['before_options'],
+                         options=options)
+        self.track = track
+        self.volume = volume
+
+
+class YTDLSource(TrackSource, GainTransformer):
+    """Enhanced audio source class with better error handling and metadata"""
+    
+    def __init__(self, source, *, data=None, requester=None, track=None):
+        self.original = source
+
+        super().__init__(source)
+        
+        # Metadata lives on the compact track instead of being copied from the info dict
+        self.track = track if track is not None else Track.from_info(data, requester)
+        
+        # Set initial volume
+        self.volume = DEFAULT_VOLUME
+        self.gain_db = self.track.gain_db or 0.0
+    
     @classmethod
     async def create_source(cls, ctx, search: str, *, loop, download=False):
         """Create an audio source from search query or URL with enhanced error handling"""
@@ -124,10 +1544,17 @@ class YTDLSource(discord.PCMVolumeTransformer):
         
         try:
             # Extract info from youtube
-            to_run = partial(ytdl.extract_info, url=search, download=download)
-            data = await loop.run_in_executor(None, to_run)
+            with latency.span('extract', ctx.guild.id):
+                if download:
+                    data = await extractor_pool.run(_extract, search, False, True, loop=loop, guild_id=ctx.guild.id)
+                else:
+                    data = await fetch_info(search, loop=loop, guild_id=ctx.guild.id)
+        except ExtractorBusy:
+            ctx.discard(processing_msg)
+            raise
         except Exception as e:
-            await processing_msg.delete()
+            # Queued, so the error reply can take over the message instead
+            ctx.discard(processing_msg)
             
             # Handle specific yt-dlp errors with user-friendly messages
             error_msg = str(e).lower()
@@ -149,68 +1576,116 @@ class YTDLSource(discord.PCMVolumeTransformer):
         
         # Check duration limit if configured
         if MAX_SONG_DURATION > 0 and data.get('duration', 0) > MAX_SONG_DURATION:
-            await processing_msg.delete()
+            ctx.discard(processing_msg)
             max_duration_str = cls.format_duration(MAX_SONG_DURATION)
             raise commands.CommandError(f'Song is too long! Maximum duration allowed is {max_duration_str}')
         
-        # Delete processing message
-        await processing_msg.delete()
+        # Queue deleting the processing message; the reply below becomes an edit of it
+        ctx.discard(processing_msg)
+        
+        track = Track.from_info(data, ctx.author)
+        if download:
+            track.set_local(ytdl.prepare_filename(data))
         
-        # Create detailed embed for queue notification
+        await ctx.send(embed=cls.queued_embed(track))
+        return track
+    
+    @staticmethod
+    def queued_embed(track):
+        """Detailed embed announcing that ``track`` was added to the queue"""
+        display = track.display
         embed = discord.Embed(
             title="✅ Added to queue",
-            description=f"[{data['title']}]({data['webpage_url']})",
+            description=display.link,
             color=discord.Color.green()
         )
         
-        # Add thumbnail if available
-        if data.get('thumbnail'):
-            embed.set_thumbnail(url=data['thumbnail'])
-        
-        # Add detailed information
-        embed.add_field(name="Duration", value=cls.format_duration(data.get('duration', 0)), inline=True)
-        embed.add_field(name="Uploader", value=data.get('uploader', 'Unknown'), inline=True)
-        embed.add_field(name="Requested by", value=ctx.author.mention, inline=True)
-        
-        # Add view count if available
-        if data.get('view_count'):
-            view_count = f"{data['view_count']:,}"
-            embed.add_field(name="Views", value=view_count, inline=True)
-        
-        # Add upload date if available
-        if data.get('upload_date'):
-            try:
-                upload_date = datetime.strptime(data['upload_date'], '%Y%m%d')
-                embed.add_field(name="Uploaded", value=upload_date.strftime('%Y-%m-%d'), inline=True)
-            except:
-                pass
-        
-        await ctx.send(embed=embed)
-        
-        if download:
-            source = ytdl.prepare_filename(data)
-        else:
-            return {'webpage_url': data['webpage_url'], 'requester': ctx.author, 'title': data['title'], 
-                   'thumbnail': data.get('thumbnail'), 'duration': data.get('duration', 0), 
-                   'uploader': data.get('uploader', 'Unknown'), 'data': data}
+        # Add thumbnail if available
+        if track.thumbnail:
+            embed.set_thumbnail(url=track.thumbnail)
         
-        return cls(discord.FFmpegPCMAudio(source, **ffmpegopts), data=data, requester=ctx.author)
+        # Add detailed information
+        embed.add_field(name="Duration", value=display.duration, inline=True)
+        embed.add_field(name="Uploader", value=track.uploader, inline=True)
+        embed.add_field(name="Requested by", value=display.requester, inline=True)
+        
+        # Add view count and upload date if available
+        if display.views:
+            embed.add_field(name="Views", value=display.views, inline=True)
+        if display.uploaded:
+            embed.add_field(name="Uploaded", value=display.uploaded, inline=True)
+        return embed
 
     @classmethod
-    async def regather_stream(cls, data, *, loop):
+    async def regather_stream(cls, track, *, loop, guild_id=None, fresh=False, volume=1.0, profile=FFMPEG_PROFILE):
         """Used for preparing a stream with better error handling"""
         loop = loop or asyncio.get_event_loop()
-        requester = data['requester']
         
+        # Only extract again if the track has no stream URL or it is about to expire
+        if fresh or track.state != 'resolved':
+            await cls.resolve_stream(track, loop=loop, guild_id=guild_id, fresh=fresh)
+        
+        return await cls.open_track(track, volume=volume, profile=profile, guild_id=guild_id)
+    
+    @classmethod
+    async def open_track(cls, track, *, volume=1.0, profile=FFMPEG_PROFILE, guild_id=None, start=0, opus=None):
+        """Open a resolved track with an FFmpeg profile, skipping the PCM path where the Opus mode allows it.
+        
+        ``start`` skips into the song, ``opus`` forces an Opus (True) or PCM (False) source.
+        """
+        with latency.span('ffmpeg_start', guild_id):
+            return await cls._open_track(track, volume, profile, start, opus)
+    
+    @classmethod
+    async def _open_track(cls, track, volume, profile, start=0, opus=None):
+        options = FFMPEG_PROFILES[profile]
+        opus_mode = options.get('opus_mode', OPUS_MODE)
+        
+        # Files on disk need no reconnect handling, and seek exactly and instantly
+        before_options = '-nostdin' if track.is_local else options['before_options']
+        if start:
+            # Before the input, so FFmpeg seeks in the input instead of decoding up to the position
+            before_options = f'{before_options} -ss {start:.3f}'
+        
+        if opus or (opus is None and opus_mode in ('auto', 'ffmpeg', 'copy')):
+            if track.codec is None:
+                # Direct links and some extractors do not report the codec
+                codec, _ = await discord.FFmpegOpusAudio.probe(track.stream_url)
+                track.codec = codec or ''
+            
+            copy = track.codec == 'opus' and (opus_mode == 'copy' or volume * track.gain == 1.0)
+            if opus or copy or opus_mode != 'auto':
+                source = YTDLOpusSource(track, volume=volume, copy=copy, profile=profile,
+                                        before_options=before_options)
+                source.start_frame = round(start / FRAME_SECONDS)
+                source.count_process()
+                return source
+        
+        opened_at = time.perf_counter()
+        source = cls(discord.FFmpegPCMAudio(track.stream_url, before_options=before_options,
+                                            options=options['options']), track=track)
+        source.opened_at = opened_at
+        source.profile = profile
+        source.start_frame = round(start / FRAME_SECONDS)
+        source.count_process()
+        return source
+    
+    @classmethod
+    async def resolve_stream(cls, track, *, loop, guild_id=None, fresh=False):
+        """Resolve the stream URL of a queued track and remember it on the track"""
+        loop = loop or asyncio.get_event_loop()
+        
+        # A concurrent prefetch of the same song shares this lookup
         try:
-            to_run = partial(ytdl.extract_info, url=data['webpage_url'], download=False)
-            processed_data = await loop.run_in_executor(None, to_run)
+            with latency.span('resolve', guild_id):
+                processed_data = await fetch_info(track.webpage_url, loop=loop, need_stream=True,
+                                                  fresh=fresh, guild_id=guild_id)
         except Exception as e:
             logger.error(f"Error regathering stream: {e}")
             raise commands.CommandError(f'Error loading audio stream: {str(e)}')
         
-        return cls(discord.FFmpegPCMAudio(processed_data['url'], **ffmpegopts), 
-                  data=processed_data, requester=requester)
+        track.set_stream(processed_data)
+        return processed_data
     
     @staticmethod
     def format_duration(duration):
@@ -226,14 +1701,326 @@ class YTDLSource(discord.PCMVolumeTransformer):
             return f"{hours}:{minutes:02d}:{seconds:02d}"
         else:
             return f"{minutes}:{seconds:02d}"
+    
+    @staticmethod
+    def format_progress(position, duration, width=30):
+        """Progress bar and 'elapsed / total' text for a position in a song of known duration"""
+        filled = min(width, int(position / duration * width))
+        elapsed = YTDLSource.format_duration(int(position)) if position >= 1 else "0:00"
+        return f"{'█' * filled}{'░' * (width - filled)}", f"{elapsed} / {YTDLSource.format_duration(duration)}"
+
+
+class FirstFrameStats:
+    """Time from starting FFmpeg to its first audio frame, per FFmpeg profile"""
+    
+    SAMPLES = 100
+    
+    def __init__(self):
+        self._samples = {}
+    
+    def record(self, profile, seconds):
+        # Called from voice threads; deque appends are atomic
+        self._samples.setdefault(profile, deque(maxlen=self.SAMPLES)).append(seconds)
+    
+    def stats(self):
+        """Samples, median and 95th percentile in seconds for every profile that was used"""
+        result = {}
+        for profile, samples in list(self._samples.items()):
+            times = sorted(samples)
+            result[profile] = {
+                'samples': len(times),
+                'p50': times[len(times) // 2],
+                'p95': times[int(len(times) * 0.95)],
+            }
+        return result
+
+
+# Shared by every guild the bot is in
+first_frame_stats = FirstFrameStats()
+
+
+class MixingSource(discord.AudioSource):
+    """Audio source that plays one YTDLSource after another without a gap.
+    
+    The next source is attached with ``queue_source`` while the current one is
+    playing. It is spliced in when the current source runs out, or faded in over
+    the last ``crossfade`` seconds of it. Frames outside a crossfade are passed
+    through untouched, so mixing only costs CPU while two songs overlap.
+    
+    A mixer carries either PCM or Opus for its whole lifetime, since the voice
+    client only sets up its encoder when playback starts. Opus sources are
+    spliced but never crossfaded.
+    """
+    
+    FRAME_SECONDS = FRAME_SECONDS
+    
+    def __init__(self, source, *, crossfade=0.0, lead=0.0, on_near_end=None, on_handover=None,
+                 on_first_frame=None):
+        self.crossfade_frames = round(crossfade / self.FRAME_SECONDS)
+        self.lead_frames = round(lead / self.FRAME_SECONDS) + self.crossfade_frames
+        self.on_near_end = on_near_end
+        self.on_handover = on_handover
+        self.on_first_frame = on_first_frame  # Called once, when the first source produces audio
+        self.done = False
+        self.failed = False  # Ended without the playing song producing any audio
+        self._opus = source.is_opus()
+        
+        self._next = None
+        self._fading = None
+        self._fade_pos = 0
+        self._fade_len = 0
+        self._replacement = None  # (source, frames) swapped in by the next read after a seek
+        self._start(source)
+    
+    def _start(self, source):
+        """Make ``source`` the playing source and reset the per-song counters"""
+        self.current = source
+        self._total_frames = round((source.duration or 0) / self.FRAME_SECONDS)
+        self._notified = self.on_near_end is None
+    
+    @property
+    def frames(self):
+        """Index of the next frame of the playing song, counted by its source"""
+        return self.current.frame
+    
+    def __getattr__(self, name):
+        # Metadata (title, duration, requester...) comes from the playing source
+        if name == 'current':
+            raise AttributeError(name)
+        return getattr(self.current, name)
+    
+    @property
+    def volume(self):
+        return self.current.volume
+    
+    @volume.setter
+    def volume(self, value):
+        self.current.volume = value
+        if self._next is not None:
+            self._next.volume = value
+    
+    def queue_source(self, source):
+        """Attach the source to play next; returns False if it cannot follow the current one"""
+        if self.done or source.is_opus() != self._opus:
+            return False
+        self._next = source
+        return True
+    
+    def unqueue_source(self, source):
+        """Detach a source attached with queue_source; returns False if it already started playing"""
+        if self._next is not source:
+            return False
+        self._next = None
+        return True
+    
+    def is_opus(self):
+        return self._opus
+    
+    def replace(self, source, on_first_frame=None):
+        """Continue the playing song from ``source``, opened further into it.
+        
+        The swap happens on the voice thread with the next frame. Returns False
+        if the source cannot take over from the playing one.
+        """
+        if self.done or source.is_opus() != self._opus:
+            return False
+        self._replacement = (source, on_first_frame)
+        return True
+    
+    def _replace(self):
+        (source, on_first_frame), self._replacement = self._replacement, None
+        old = self.current
+        if self._fading is not None:
+            self._fading.cleanup()
+            self._fading = None
+        
+        notified = self._notified
+        self._start(source)
+        # Still the same song, so it is not preloaded for a second time
+        self._notified = notified
+        if on_first_frame is not None:
+            self.on_first_frame = on_first_frame
+        old.cleanup()
+    
+    def read(self):
+        if self._replacement is not None:
+            self._replace()
+        
+        if self._fading is not None:
+            return self._read_crossfade()
+        
+        remaining = self._total_frames - self.frames
+        if self._next is not None and not self._opus and 0 < remaining <= self.crossfade_frames:
+            # Fade the next song in over the rest of this one
+            self._fading = self.current
+            self._fade_pos = 0
+            self._fade_len = remaining
+            self._switch()
+            return self._read_crossfade()
+        
+        data = self.current.read()
+        if not data and self._next is not None:
+            # Splice the next song in without a gap
+            self.current.cleanup()
+            self._switch()
+            data = self.current.read()
+        
+        if not data:
+            # FFmpeg exits at once on an expired or blocked stream URL
+            self.failed = self.current.frames_read == 0 and self.current.start_frame == 0
+            self.done = True
+            return b''
+        
+        if self.on_first_frame is not None:
+            self.on_first_frame()
+            self.on_first_frame = None
+        
+        self._check_near_end()
+        return data
+    
+    def _read_crossfade(self):
+        outgoing = self._fading.read()
+        data = self.current.read()
+        self._fade_pos += 1
+        
+        if outgoing and data:
+            gain = self._fade_pos / self._fade_len
+            data = audioop.add(audioop.mul(outgoing, 2, 1.0 - gain), audioop.mul(data, 2, gain), 2)
+        
+        if not outgoing or self._fade_pos >= self._fade_len:
+            self._fading.cleanup()
+            self._fading = None
+        
+        if not data:
+            # The incoming song ended first; let the outgoing one finish the fade
+            data = outgoing or b''
+            if not data:
+                self.done = True
+            return data
+        
+        self._check_near_end()
+        return data
+    
+    def _switch(self):
+        source, self._next = self._next, None
+        self._start(source)
+        if self.on_handover:
+            self.on_handover(source)
+    
+    def _check_near_end(self):
+        # Songs without a known duration (live streams) are never preloaded
+        if not self._notified and self._total_frames and self._total_frames - self.frames <= self.lead_frames:
+            self._notified = True
+            self.on_near_end()
+    
+    def cleanup(self):
+        """Clean up the playing and fading sources. An attached next source is left to its owner."""
+        self.done = True
+        self.current.cleanup()
+        if self._fading is not None:
+            self._fading.cleanup()
+            self._fading = None
+
+
+# Keeps the now playing edits of every guild within a share of the REST rate limits
+now_playing_bucket = TokenBucket(NOW_PLAYING_EDIT_RATE, max(1, NOW_PLAYING_EDIT_RATE))
+
+
+class NowPlayingMessage:
+    """One now playing message per guild, edited as the song, its progress and the queue change.
+    
+    ``render`` returns the embed for the current state, or None to leave the
+    message as it is. Updates requested with ``update()`` are debounced, so a burst
+    of them (a song change, a playlist being queued) costs a single edit, and
+    they wait for the shared bucket. Progress ticks every ``interval`` seconds
+    are dropped instead when the bucket is empty, and edits that would not
+    change the message are skipped. Discord allows 5 edits per 5 seconds in a
+    channel, which the debounce delay keeps a single message well under. The
+    edits go through the outbound queue behind command replies.
+    """
+    
+    DEBOUNCE = 1.0  # Seconds to wait for more updates before editing
+    
+    def __init__(self, channel, render, *, loop, interval=NOW_PLAYING_INTERVAL, bucket=now_playing_bucket):
+        self.channel = channel
+        self.render = render
+        self.interval = interval
+        self.bucket = bucket
+        self.message = None
+        self._last = None  # Embed of the last edit, as a dict
+        self._dirty = asyncio.Event()
+        self._task = loop.create_task(self._run())
+    
+    def update(self):
+        """Bring the message up to date soon; calls in quick succession are coalesced"""
+        self._dirty.set()
+    
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._dirty.wait(), self.interval or None)
+                tick = False
+            except asyncio.TimeoutError:
+                tick = True
+            else:
+                await asyncio.sleep(self.DEBOUNCE)
+                self._dirty.clear()
+            
+            try:
+                await self._publish(tick)
+            except Exception as e:
+                logger.warning(f"Updating the now playing message failed: {e}")
+    
+    async def _publish(self, tick):
+        if not tick:
+            await self.bucket.acquire()
+        embed = self.render()
+        if embed is None or (tick and self.message is None):
+            return
+        
+        data = embed.to_dict()
+        if data == self._last:
+            now_playing_updates.inc(result='unchanged')
+            return
+        # Progress can wait for the next tick if edits are saturated
+        if tick and not self.bucket.try_acquire():
+            now_playing_updates.inc(result='dropped')
+            return
+        
+        if self.message is not None:
+            try:
+                await outbound.edit(self.message, embed=embed, priority=LOW)
+                self._last = data
+                now_playing_updates.inc(result='edited')
+                return
+            except discord.NotFound:
+                self.message = None  # Deleted by someone, so send a new one
+        
+        self.message = await outbound.send(self.channel, embed=embed, priority=LOW)
+        self._last = data
+        now_playing_updates.inc(result='sent')
+    
+    async def delete(self):
+        """Delete the message; the next update sends a new one"""
+        message, self.message, self._last = self.message, None, None
+        if message is not None:
+            try:
+                await outbound.delete(message)
+            except discord.HTTPException:
+                pass
+    
+    async def close(self):
+        """Stop updating and delete the message"""
+        self._task.cancel()
+        await self.delete()
 
 
 class MusicPlayer:
     """Enhanced music player class with better queue management and features"""
     
-    __slots__ = ('bot', '_guild', '_channel', '_cog', 'queue', 'next', 'current', 'np', 
+    __slots__ = ('bot', '_guild', '_channel', '_cog', 'queue', 'next', 'current', 'now_playing', 
                  'volume', 'repeat_mode', '_task', 'skip_votes', 'audio_player', 
-                 'start_time', 'pause_time', 'total_paused')
+                 '_prefetch_task', '_mixer', '_preload_task', '_preload_track', '_handover', '_np_template')
     
     def __init__(self, ctx):
         self.bot = ctx.bot
@@ -241,133 +2028,414 @@ class MusicPlayer:
         self._channel = ctx.channel
         self._cog = ctx.cog
         
-        self.queue = asyncio.Queue()
+        self.queue = TrackQueue(on_resize=self._queue_resized, on_reorder=self._check_preload)
         self.next = asyncio.Event()
         
-        self.np = None  # Now playing message
+        self.now_playing = NowPlayingMessage(ctx.channel, self.now_playing_embed, loop=ctx.bot.loop)
+        self._np_template = None  # (state, embed dict) the now playing embed is rendered from
         self.volume = DEFAULT_VOLUME
         self.current = None
         self.repeat_mode = 'off'  # off, one, all
         self.skip_votes = set()  # Track skip votes
         
-        # Timing tracking for current position
-        self.start_time = None
-        self.pause_time = None
-        self.total_paused = 0
+        # Background resolution of upcoming songs
+        self._prefetch_task = None
+        
+        # Gapless playback: the mixing source and the next song opened ahead of time
+        self._mixer = None
+        self._preload_task = None
+        self._preload_track = None  # Head of the queue the preload is for; it stays queued until played
+        self._handover = None
         
         self._task = ctx.bot.loop.create_task(self.player_loop())
     
     async def player_loop(self):
         """Main player loop with enhanced error handling and logging"""
         await self.bot.wait_until_ready()
+        last_track = None
+        handover = None
+        retry = retried = None  # Song to play again with a fresh stream URL, and the last one that was
         
         while not self.bot.is_closed():
             self.next.clear()
             self.skip_votes.clear()  # Clear skip votes for new song
             
-            try:
-                # Wait for the next song with timeout
-                async with asyncio.timeout(INACTIVITY_TIMEOUT):
-                    if self.repeat_mode == 'one' and self.current:
-                        # Re-create the same source for repeat one
-                        source = await YTDLSource.regather_stream(self.current, loop=self.bot.loop)
-                    else:
-                        source = await self.queue.get()
-            except asyncio.TimeoutError:
-                logger.info(f"Player timeout in guild {self._guild.name}")
-                return self.destroy(self._guild)
-            except Exception as e:
-                logger.error(f"Error in player loop: {e}")
-                await self._channel.send(f'An error occurred in the player: {str(e)}')
-                continue
-            
-            if not isinstance(source, YTDLSource):
-                # Source was probably a stream (not downloaded)
-                try:
-                    source = await YTDLSource.regather_stream(source, loop=self.bot.loop)
-                except Exception as e:
-                    logger.error(f"Error processing song: {e}")
-                    await self._channel.send(f'There was an error processing your song.\n```css\n[{e}]\n```')
-                    continue
+            preload, self._preload_task = self._preload_task, None
+            if handover is not None:
+                self._take_preloaded(handover.track)
+            if handover is not None and not self._mixer.done:
+                # The mixer already switched to the preloaded song
+                source, track = handover, handover.track
+            else:
+                source = None
+                if handover is None and preload is not None and not preload.cancelled():
+                    # Opened ahead of time but the song before it was skipped
+                    source = await preload
+                    if source is not None:
+                        self._take_preloaded(source.track)
+                self._preload_track = None
+                
+                # Sources opened ahead of time would skew the time-to-first-frame stats
+                timed = source is None
+                if source is None:
+                    try:
+                        # Wait for the next song with timeout
+                        async with asyncio.timeout(INACTIVITY_TIMEOUT):
+                            fresh = retry is not None
+                            if fresh:
+                                track, retry = retry, None
+                            elif self.repeat_mode == 'one' and last_track:
+                                # Play the same track again for repeat one
+                                track = last_track
+                            else:
+                                track = await self.queue.get()
+                    except asyncio.TimeoutError:
+                        logger.info(f"Player timeout in guild {self._guild.name}")
+                        return self.destroy(self._guild)
+                    except Exception as e:
+                        logger.error(f"Error in player loop: {e}")
+                        outbound.send(self._channel, f'An error occurred in the player: {str(e)}')
+                        continue
+                    
+                    try:
+                        source = await self.prepare_source(track, fresh=fresh)
+                    except Exception as e:
+                        logger.error(f"Error processing song: {e}")
+                        outbound.send(self._channel, f'There was an error processing your song.\n```css\n[{e}]\n```')
+                        last_track = None
+                        continue
+                
+                track = source.track
+                source.volume = self.volume
+                self._mixer = self.create_mixer(source, timed=timed)
+                
+                # Play the song
+                with latency.span('voice_play', self._guild.id):
+                    self._guild.voice_client.play(
+                        self._mixer,
+                        after=lambda _: self.bot.loop.call_soon_threadsafe(self.next.set)
+                    )
             
-            source.volume = self.volume
+            handover = None
             self.current = source
+            self.record_play(track)
             
-            # Track timing
-            self.start_time = time.time()
-            self.pause_time = None
-            self.total_paused = 0
-            
-            # Play the song
-            self._guild.voice_client.play(
-                source, 
-                after=lambda _: self.bot.loop.call_soon_threadsafe(self.next.set)
-            )
-            
-            # Send now playing embed with enhanced information
-            embed = discord.Embed(
-                title="🎵 Now playing",
-                description=f"[{source.title}]({source.web_url})",
-                color=discord.Color.blue()
-            )
-            embed.set_thumbnail(url=source.thumbnail or '')
-            
-            # Add fields
-            fields = [
-                ("Duration", YTDLSource.format_duration(source.duration), True),
-                ("Requested by", source.requester.mention, True),
-                ("Uploader", f"[{source.uploader}]({source.uploader_url})" if source.uploader_url else source.uploader, True),
-                ("Volume", f"{int(source.volume * 100)}%", True),
-                ("Repeat", self.repeat_mode.upper(), True),
-                ("Queue", f"{self.queue.qsize()} songs", True)
-            ]
-            
-            for name, value, inline in fields:
-                embed.add_field(name=name, value=value, inline=inline)
-            
-            # Add progress bar (placeholder for live updates)
-            if source.duration:
-                embed.add_field(
-                    name="Progress",
-                    value=f"```[{'─' * 30}] 0:00 / {YTDLSource.format_duration(source.duration)}```",
-                    inline=False
-                )
+            # Resolve the next songs while this one plays
+            self.schedule_prefetch()
             
-            self.np = await self._channel.send(embed=embed)
+            # The now playing message is edited to show the new song
+            self.now_playing.update()
             
-            # Wait for the song to finish
+            # Wait for the song to finish or for the mixer to move on to the next one
             await self.next.wait()
             
-            # Cleanup
-            source.cleanup()
+            handover, self._handover = self._handover, None
+            if handover is None:
+                source.cleanup()
             
-            # Delete now playing message
-            try:
-                await self.np.delete()
-            except discord.HTTPException:
-                pass
+            if handover is None and self._mixer.failed and not track.is_local and track is not retried:
+                # Starting FFmpeg does not fail on a dead URL, it just produces nothing
+                logger.warning(f"{track.title} played no audio, retrying with a fresh extraction")
+                retry = retried = track
+                self.current = None
+                continue
+            retried = None
             
             # Handle repeat all mode
             if self.repeat_mode == 'all':
-                await self.queue.put(self.current)
+                await self.queue.put(track)
             
+            if handover is None and self.repeat_mode != 'one' and not self.queue:
+                # Nothing more to play
+                await self.now_playing.delete()
+            
+            last_track = track
             self.current = None
     
+    def now_playing_embed(self):
+        """Now playing embed with the progress of the playing song, None between songs.
+        
+        Everything but the progress is rendered once for each song and player
+        state, since the message is re-rendered on every progress tick.
+        """
+        source = self.current
+        if source is None:
+            return None
+        
+        state = (source.track, source.volume, self.repeat_mode, len(self.queue))
+        if self._np_template is None or self._np_template[0] != state:
+            self._np_template = (state, self._now_playing_template(source))
+        data = self._np_template[1]
+        
+        if source.duration:
+            bar, time_display = YTDLSource.format_progress(source.position, source.duration)
+            progress = {'name': "Progress", 'value': f"```{bar}```{time_display}", 'inline': False}
+            data = {**data, 'fields': data['fields'] + [progress]}
+        return discord.Embed.from_dict(data)
+    
+    def _now_playing_template(self, source):
+        display = source.display
+        embed = discord.Embed(
+            title="🎵 Now playing",
+            description=display.link,
+            color=discord.Color.blue()
+        )
+        embed.set_thumbnail(url=source.thumbnail or '')
+        
+        # Add fields
+        fields = [
+            ("Duration", display.duration, True),
+            ("Requested by", display.requester, True),
+            ("Uploader", display.uploader, True),
+            ("Volume", f"{int(source.volume * 100)}%", True),
+            ("Repeat", self.repeat_mode.upper(), True),
+            ("Queue", f"{self.queue.qsize()} songs", True)
+        ]
+        
+        for name, value, inline in fields:
+            embed.add_field(name=name, value=value, inline=inline)
+        return embed.to_dict()
+    
+    async def prepare_source(self, track, *, fresh=False):
+        """Turn a queued track into a playable source.
+        
+        The stream URL is only resolved if the track has none or it is close to
+        expiry. If that fails, the track is resolved once more with a fresh
+        extraction (bypassing the cache) before the error is raised. Songs in
+        the audio cache are played from disk. ``fresh`` goes straight to the
+        fresh extraction, for a URL that turned out not to work.
+        """
+        if fresh:
+            track.invalidate()
+        else:
+            await load_cached_audio(track, loop=self.bot.loop)
+            try:
+                return await YTDLSource.regather_stream(track, loop=self.bot.loop, guild_id=self._guild.id,
+                                                        volume=self.volume, profile=self.ffmpeg_profile)
+            except Exception as e:
+                logger.warning(f"Loading {track.title} failed, retrying with a fresh extraction: {e}")
+                track.invalidate()
+        
+        return await YTDLSource.regather_stream(track, loop=self.bot.loop, guild_id=self._guild.id,
+                                                fresh=True, volume=self.volume, profile=self.ffmpeg_profile)
+    
+    def record_play(self, track):
+        """Count a play for the audio cache and cache the song once it is popular"""
+        if audio_cache is not None:
+            audio_cache.played(track, loop=self.bot.loop)
+    
+    @property
+    def ffmpeg_profile(self):
+        """FFmpeg profile chosen for this server, or the configured default"""
+        return self._cog.ffmpeg_profiles.get(self._guild.id, FFMPEG_PROFILE)
+    
+    def create_mixer(self, source, *, timed=False):
+        """Wrap a source in the mixer, hooking up preloading when gapless playback is on.
+        
+        With ``timed``, the delay until the source's first frame is recorded for its FFmpeg profile.
+        """
+        # All callbacks run on the voice thread
+        call = self.bot.loop.call_soon_threadsafe
+        def record_first_frame():
+            now = time.perf_counter()
+            first_frame_stats.record(source.profile, now - source.opened_at)
+            call(self._record_first_frame, source, now)
+        
+        on_first_frame = record_first_frame if timed and source.opened_at is not None else None
+        
+        if not (GAPLESS_PLAYBACK or CROSSFADE_SECONDS > 0):
+            return MixingSource(source, on_first_frame=on_first_frame)
+        
+        mixer = MixingSource(
+            source, crossfade=CROSSFADE_SECONDS, lead=PRELOAD_SECONDS,
+            on_near_end=lambda: call(self._start_preload, mixer),
+            on_handover=lambda new: call(self._on_handover, mixer, new),
+            on_first_frame=on_first_frame
+        )
+        return mixer
+    
+    def _record_first_frame(self, source, now):
+        latency.observe('first_frame', now - source.opened_at, self._guild.id)
+        track = source.track
+        if track.requested_at is not None:
+            # End to end: the play command until the song is heard
+            latency.observe('time_to_audio', now - track.requested_at, self._guild.id)
+            track.requested_at = None
+    
+    def _take_preloaded(self, track):
+        """Remove a preloaded song from the head of the queue now that it is playing"""
+        preloaded, self._preload_track = self._preload_track, None
+        if preloaded is track and self.queue and self.queue[0] is track:
+            self.queue.get_nowait()
+    
+    def _check_preload(self):
+        """Drop the preload if its song was removed from the head of the queue"""
+        track = self._preload_track
+        if track is not None and not (self.queue and self.queue[0] is track):
+            self.discard_preload()
+    
+    def _start_preload(self, mixer):
+        if mixer is self._mixer and self._preload_task is None:
+            self._preload_task = self.bot.loop.create_task(self._preload(mixer))
+    
+    def _on_handover(self, mixer, source):
+        if mixer is self._mixer:
+            self._handover = source
+            self.next.set()
+    
+    async def _preload(self, mixer):
+        """Open the next song's source and attach it to the mixer before the current one ends.
+        
+        The song stays at the head of the queue until it starts playing, so the
+        queue commands still see it; taking it out of the queue drops the preload.
+        """
+        if self.repeat_mode == 'one':
+            track = mixer.current.track
+        elif self.queue:
+            track = self._preload_track = self.queue[0]
+        else:
+            return None
+        
+        try:
+            source = await self.prepare_source(track)
+        except Exception as e:
+            # Skip the song, as the player loop would
+            self._take_preloaded(track)
+            logger.error(f"Error processing song: {e}")
+            outbound.send(self._channel, f'There was an error processing your song.\n```css\n[{e}]\n```')
+            return None
+        
+        source.volume = self.volume
+        # If playback ended meanwhile the player loop picks the source up from this task
+        mixer.queue_source(source)
+        return source
+    
+    def schedule_prefetch(self):
+        """Start resolving upcoming stream URLs in the background"""
+        if PREFETCH_COUNT <= 0 and not LOUDNESS_NORMALIZATION:
+            return
+        if self._prefetch_task and not self._prefetch_task.done():
+            return
+        self._prefetch_task = self.bot.loop.create_task(self._prefetch())
+    
+    async def _prefetch(self):
+        """Resolve the head of the queue so track changes only need to spawn FFmpeg.
+        
+        With loudness normalization on, songs are also analysed here.
+        """
+        attempted = set()
+        
+        while True:
+            current = self.current
+            if LOUDNESS_NORMALIZATION and current is not None and current.track.gain_db is None:
+                # The playing song was not analysed ahead of time, adjust it once measured
+                await analyse_loudness(current.track)
+                if not current.is_opus():
+                    current.gain_db = current.track.gain_db
+                continue
+            
+            # Re-read the queue every round, it may have changed while we were resolving
+            upcoming = self.queue.peek(PREFETCH_COUNT)
+            pending = [entry for entry in upcoming if id(entry) not in attempted and (
+                entry.state != 'resolved' or (LOUDNESS_NORMALIZATION and entry.gain_db is None))]
+            if not pending:
+                return
+            
+            entry = pending[0]
+            attempted.add(id(entry))
+            try:
+                if entry.state != 'resolved' and not await load_cached_audio(entry, loop=self.bot.loop):
+                    await YTDLSource.resolve_stream(entry, loop=self.bot.loop, guild_id=self._guild.id)
+                if LOUDNESS_NORMALIZATION and entry.gain_db is None:
+                    await analyse_loudness(entry)
+            except Exception as e:
+                # The player loop retries and reports the error when the song comes up
+                logger.warning(f"Prefetch failed for {entry.title}: {e}")
+    
     def get_current_position(self):
-        """Get current playback position in seconds"""
-        if not self.start_time or not self.current:
+        """Get current playback position in seconds, from the frames the song's source has read"""
+        if not self.current:
             return 0
-        
-        if self.pause_time:
-            # Currently paused
-            return self.pause_time - self.start_time - self.total_paused
+        return self.current.position
+    
+    async def seek(self, position):
+        """Restart FFmpeg for the playing song at ``position`` seconds; returns False if the song changed.
+        
+        The song's stream URL is reused unless it is close to expiry, so seeking
+        usually does not extract it again.
+        """
+        requested_at = time.perf_counter()
+        mixer, current = self._mixer, self.current
+        track = current.track
+        if not track.is_local and track.state != 'resolved':
+            # Unresolved, or its signed URL is about to expire
+            await YTDLSource.resolve_stream(track, loop=self.bot.loop, guild_id=self._guild.id)
+        
+        source = await YTDLSource.open_track(track, volume=self.volume, profile=self.ffmpeg_profile,
+                                             guild_id=self._guild.id, start=position, opus=mixer.is_opus())
+        source.volume = self.volume
+        
+        def on_first_frame():
+            self.bot.loop.call_soon_threadsafe(
+                latency.observe, 'seek', time.perf_counter() - requested_at, self._guild.id)
+        
+        if mixer is not self._mixer or self.current is not current or not mixer.replace(source, on_first_frame):
+            source.cleanup()
+            return False
+        self.current = source
+        return True
+    
+    def _queue_resized(self, delta):
+        queued_tracks.inc(delta)
+        # Only servers with a queue get a series, so idle servers cost nothing
+        if self.queue:
+            queue_length.set(len(self.queue), guild=self._guild.id)
         else:
-            # Currently playing
-            return time.time() - self.start_time - self.total_paused
+            queue_length.remove(guild=self._guild.id)
+        self.now_playing.update()  # Shows the queue length
+        self._check_preload()
     
     def destroy(self, guild):
         """Disconnect and cleanup the player."""
+        if self._prefetch_task:
+            self._prefetch_task.cancel()
+        self.discard_preload()
         return self.bot.loop.create_task(self._cog.cleanup(guild))
+    
+    def discard_preload(self):
+        """Drop the song opened ahead of time, if any"""
+        task, self._preload_task = self._preload_task, None
+        self._preload_track = None
+        if task is None:
+            return
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None and task.result() is not None:
+            source = task.result()
+            # A source the mixer already switched to is cleaned up with the mixer
+            if self._mixer is None or self._mixer.unqueue_source(source) or self._mixer.current is not source:
+                source.cleanup()
+
+
+def parse_position(text, current=0):
+    """Parse a seek position (SS, MM:SS, HH:MM:SS, or +/- relative to ``current``) into seconds"""
+    text = text.strip()
+    sign = text[:1] if text[:1] in '+-' else ''
+    try:
+        parts = [float(part) for part in text.lstrip('+-').split(':')]
+    except ValueError:
+        return None
+    if not 1 <= len(parts) <= 3 or any(part < 0 for part in parts) or any(part >= 60 for part in parts[1:]):
+        return None
+    
+    seconds = 0
+    for part in parts:
+        seconds = seconds * 60 + part
+    if sign == '+':
+        return current + seconds
+    if sign == '-':
+        return current - seconds
+    return seconds
 
 
 class Music(commands.Cog):
@@ -376,6 +2444,8 @@ class Music(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.players = {}
+        self.shard_players = {}  # Shard ID -> players on that shard, kept as players come and go
+        self.ffmpeg_profiles = {}  # Guild ID -> FFmpeg profile chosen with the profile command
         
         # Track statistics
         self.songs_played = 0
@@ -391,9 +2461,68 @@ class Music(commands.Cog):
             pass
         
         try:
-            del self.players[guild.id]
+            player = self.players.pop(guild.id)
         except KeyError:
             pass
+        else:
+            self.shard_players[guild.shard_id] -= 1
+            if player._prefetch_task:
+                player._prefetch_task.cancel()
+            player.discard_preload()
+            player.queue.clear()  # Takes its songs out of the queue metrics
+            await player.now_playing.close()
+    
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        """Keep the voice connection gauge current as the bot joins and leaves channels"""
+        if member.id != self.bot.user.id or before.channel == after.channel:
+            return
+        if before.channel is None:
+            voice_connections.inc()
+        elif after.channel is None:
+            voice_connections.dec()
+    
+    async def cog_load(self):
+        """Called when the cog is loaded"""
+        global extraction_cache, audio_cache
+        # Opening the caches touches the disk. After a failed reload the restored
+        # module's caches were closed by cog_unload and are opened again here.
+        if extraction_cache is None:
+            extraction_cache = await self.bot.loop.run_in_executor(None, create_extraction_cache)
+        if audio_cache is None:
+            audio_cache = await self.bot.loop.run_in_executor(None, create_audio_cache)
+        
+        try:
+            await extractor_pool.warm_up(loop=self.bot.loop)
+        except Exception as e:
+            logger.error(f"Failed to start extractor workers: {e}")
+    
+    async def cog_unload(self):
+        """Called when the cog is unloaded or reloaded"""
+        # The reloaded module opens its own cache and pool; the persistent part carries over
+        global extraction_cache, audio_cache
+        if extraction_cache is not None:
+            cache, extraction_cache = extraction_cache, None
+            await self.bot.loop.run_in_executor(None, cache.close)
+        if audio_cache is not None:
+            cache, audio_cache = audio_cache, None
+            await cache.aclose()
+        extractor_pool.shutdown()
+    
+    async def extraction_stats(self):
+        """Return statistics of the shared extraction cache"""
+        stats = await extraction_cache.stats() if extraction_cache is not None else {}
+        return {**stats, **extraction_flights.stats()}
+    
+    async def audio_cache_stats(self):
+        """Return statistics of the audio cache, None when it is off"""
+        if audio_cache is None:
+            return None
+        return await self.bot.loop.run_in_executor(None, audio_cache.stats)
+    
+    def extractor_stats(self):
+        """Return utilisation and queue wait statistics of the extractor pool"""
+        return extractor_pool.stats()
     
     async def cog_check(self, ctx):
         """A local check which applies to all commands in this cog."""
@@ -429,6 +2558,8 @@ class Music(commands.Cog):
         except KeyError:
             player = MusicPlayer(ctx)
             self.players[ctx.guild.id] = player
+            shard_id = ctx.guild.shard_id
+            self.shard_players[shard_id] = self.shard_players.get(shard_id, 0) + 1
         
         return player
     
@@ -478,6 +2609,7 @@ class Music(commands.Cog):
     @commands.cooldown(1, 3, commands.BucketType.user)  # Prevent spam
     async def play_(self, ctx, *, search: str):
         """Request a song and add it to the queue."""
+        requested_at = time.perf_counter()
         async with ctx.typing():
             vc = ctx.voice_client
             
@@ -495,6 +2627,9 @@ class Music(commands.Cog):
                 )
                 return await ctx.send(embed=embed)
             
+            if is_playlist_url(search):
+                return await self.import_playlist(ctx, player, search)
+            
             # Create the source
             try:
                 source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop, download=False)
@@ -502,13 +2637,102 @@ class Music(commands.Cog):
                 await ctx.send(f"❌ {str(e)}")
                 return
             
+            # Songs that will start right away are timed until they are heard
+            if player.current is None and player.queue.empty():
+                source.requested_at = requested_at
+            
             # Add to queue
             await player.queue.put(source)
+            latency.observe('queued', time.perf_counter() - requested_at, ctx.guild.id)
+            player.schedule_prefetch()
             
             # Update statistics
             self.songs_played += 1
-            if source.get('duration'):
-                self.total_duration += source['duration']
+            if source.duration:
+                self.total_duration += source.duration
+    
+    async def import_playlist(self, ctx, player, url):
+        """Stream a playlist into the queue as its entries are discovered.
+        
+        Entries come from flat extraction and are only resolved when they are about to
+        play, so the first song starts after a single extraction. Progress is reported
+        by editing one message.
+        """
+        embed = discord.Embed(
+            title="Importing playlist...",
+            description=f"🔍 Loading: `{url}`",
+            color=discord.Color.orange()
+        )
+        progress_msg = await ctx.send(embed=embed)
+        
+        try:
+            title, entries = await extractor_pool.run(_open_playlist, url, loop=self.bot.loop,
+                                                      guild_id=ctx.guild.id, local=True)
+        except Exception as e:
+            logger.error(f"Error loading playlist {url}: {e}")
+            embed = discord.Embed(
+                title="Playlist Error",
+                description="❌ I couldn't load that playlist. It might be private or unavailable.",
+                color=discord.Color.red()
+            )
+            return await outbound.edit(progress_msg, embed=embed)
+        
+        added = skipped = 0
+        limit_reached = False
+        batch_size = 1  # Get the first song playing as soon as possible
+        last_edit = time.monotonic()
+        
+        while True:
+            room = MAX_PLAYLIST_SIZE - added if MAX_PLAYLIST_SIZE > 0 else batch_size
+            if MAX_QUEUE_SIZE > 0:
+                room = min(room, MAX_QUEUE_SIZE - player.queue.qsize())
+            if room <= 0:
+                limit_reached = True
+                break
+            
+            try:
+                batch = await extractor_pool.run(_next_entries, entries, min(batch_size, room),
+                                                 loop=self.bot.loop, guild_id=ctx.guild.id, local=True)
+            except Exception as e:
+                logger.error(f"Error reading playlist {url}: {e}")
+                break
+            if not batch:
+                break
+            
+            for entry in batch:
+                if MAX_SONG_DURATION > 0 and (entry.get('duration') or 0) > MAX_SONG_DURATION:
+                    skipped += 1
+                    continue
+                player.queue.put_nowait(Track.from_info(entry, ctx.author))
+                added += 1
+                self.songs_played += 1
+                self.total_duration += entry.get('duration') or 0
+            
+            player.schedule_prefetch()
+            batch_size = PLAYLIST_BATCH_SIZE
+            
+            # Edit the progress message at most every few seconds
+            if time.monotonic() - last_edit >= 2:
+                last_edit = time.monotonic()
+                embed = discord.Embed(
+                    title="Importing playlist...",
+                    description=f"📥 **{title}**\nAdded {added} songs so far",
+                    color=discord.Color.orange()
+                )
+                # Queued edits of one message are merged, so a busy channel only gets the latest
+                outbound.edit(progress_msg, embed=embed, priority=LOW)
+        
+        embed = discord.Embed(
+            title="✅ Playlist added",
+            description=f"**{title}**\nAdded {added} songs to the queue",
+            color=discord.Color.green() if added else discord.Color.red()
+        )
+        if skipped:
+            embed.add_field(name="Skipped", value=f"{skipped} songs over the duration limit", inline=True)
+        if limit_reached:
+            embed.add_field(name="Limit reached", value="The rest of the playlist was not imported", inline=True)
+        embed.add_field(name="Requested by", value=ctx.author.mention, inline=True)
+        await outbound.edit(progress_msg, embed=embed)
     
     @commands.command(name='pause', description="Pause the current song")
     async def pause_(self, ctx):
@@ -531,9 +2755,6 @@ class Music(commands.Cog):
             return await ctx.send(embed=embed)
         
         vc.pause()
-        player = self.get_player(ctx)
-        if player:
-            player.pause_time = time.time()
         
         embed = discord.Embed(
             title="Paused",
@@ -563,10 +2784,6 @@ class Music(commands.Cog):
             return await ctx.send(embed=embed)
         
         vc.resume()
-        player = self.get_player(ctx)
-        if player and player.pause_time:
-            player.total_paused += time.time() - player.pause_time
-            player.pause_time = None
         
         embed = discord.Embed(
             title="Resumed",
@@ -661,6 +2878,7 @@ class Music(commands.Cog):
         
         player = self.get_player(ctx)
         player.repeat_mode = mode
+        player.now_playing.update()
         
         # Emoji based on mode
         emoji = {'off': '➡️', 'one': '🔂', 'all': '🔁'}[mode]
@@ -672,6 +2890,58 @@ class Music(commands.Cog):
         )
         await ctx.send(embed=embed)
     
+    @commands.command(name='profile', aliases=['ffmpeg'], description="Choose the FFmpeg profile")
+    async def profile_(self, ctx, name: str = None):
+        """Show or set the FFmpeg profile used for this server's songs."""
+        current = self.ffmpeg_profiles.get(ctx.guild.id, FFMPEG_PROFILE)
+        
+        if name is None:
+            stats = first_frame_stats.stats()
+            lines = []
+            for profile in FFMPEG_PROFILES:
+                marker = '▶️' if profile == current else '▫️'
+                timing = stats.get(profile)
+                if timing:
+                    first_frame = (f"first frame {timing['p50'] * 1000:.0f} ms "
+                                   f"(p95 {timing['p95'] * 1000:.0f} ms, {timing['samples']} songs)")
+                else:
+                    first_frame = "not used yet"
+                lines.append(f"{marker} **{profile}** - {first_frame}")
+            
+            embed = discord.Embed(
+                title="FFmpeg Profile",
+                description="\n".join(lines) + f"\n\nUsage: `{ctx.prefix}profile [name]`",
+                color=discord.Color.blue()
+            )
+            embed.set_footer(text="Times are measured across all servers; changes apply from the next song")
+            return await ctx.send(embed=embed)
+        
+        name = name.lower()
+        if name not in FFMPEG_PROFILES:
+            embed = discord.Embed(
+                title="Invalid Profile",
+                description="Please use: " + ", ".join(f"`{profile}`" for profile in FFMPEG_PROFILES),
+                color=discord.Color.red()
+            )
+            return await ctx.send(embed=embed)
+        
+        if not ctx.author.guild_permissions.manage_guild:
+            embed = discord.Embed(
+                title="Missing Permissions",
+                description="You need the **Manage Server** permission to change the profile.",
+                color=discord.Color.red()
+            )
+            return await ctx.send(embed=embed)
+        
+        self.ffmpeg_profiles[ctx.guild.id] = name
+        
+        embed = discord.Embed(
+            title="FFmpeg Profile Changed",
+            description=f"🎛️ Profile set to **{name}**, starting with the next song",
+            color=discord.Color.green()
+        )
+        await ctx.send(embed=embed)
+    
     @commands.command(name='queue', aliases=['q', 'playlist'], description="Show the queue")
     async def queue_info(self, ctx, page: int = 1):
         """Display the current queue with pagination"""
@@ -695,11 +2965,7 @@ class Music(commands.Cog):
             
             # Add currently playing if exists
             if player.current:
-                embed.add_field(
-                    name="Now Playing",
-                    value=f'[{vc.source.title}]({vc.source.web_url}) | `{YTDLSource.format_duration(vc.source.duration)}` | {vc.source.requester.mention}',
-                    inline=False
-                )
+                embed.add_field(name="Now Playing", value=player.current.display.queue_entry, inline=False)
             
             return await ctx.send(embed=embed)
         
@@ -716,14 +2982,11 @@ class Music(commands.Cog):
         end = start + items_per_page
         
         # Get queue items
-        queue_list = list(itertools.islice(player.queue._queue, 0, player.queue.qsize()))
-        current_page_items = queue_list[start:end]
+        current_page_items = player.queue.page(start, end)
         
         # Format queue items
-        queue_text = []
-        for idx, song in enumerate(current_page_items, start=start+1):
-            duration = YTDLSource.format_duration(song.get('duration', 0))
-            queue_text.append(f'**{idx}.** [{song["title"]}]({song["webpage_url"]}) | `{duration}` | {song["requester"].mention}')
+        queue_text = [f'**{idx}.** {song.display.queue_entry}'
+                      for idx, song in enumerate(current_page_items, start=start+1)]
         
         embed = discord.Embed(
             title=f'📋 Queue for {ctx.guild.name}',
@@ -733,16 +2996,16 @@ class Music(commands.Cog):
         
         # Add currently playing
         if player.current:
-            current_pos = player.get_current_position()
-            progress = f"{YTDLSource.format_duration(int(current_pos))}/{YTDLSource.format_duration(vc.source.duration)}"
-            embed.add_field(
-                name="Now Playing",
-                value=f'[{vc.source.title}]({vc.source.web_url}) | `{progress}` | {vc.source.requester.mention}',
-                inline=False
-            )
+            if player.current.duration:
+                _, progress = YTDLSource.format_progress(player.get_current_position(), player.current.duration)
+            else:
+                progress = YTDLSource.format_duration(0)
+            display = player.current.display
+            embed.add_field(name="Now Playing", value=f'{display.link} | `{progress}` | {display.requester}',
+                            inline=False)
         
         # Add footer with page info and stats
-        total_duration = sum(song.get('duration', 0) for song in queue_list)
+        total_duration = player.queue.total_duration
         embed.set_footer(
             text=f'Page {page}/{pages} | {player.queue.qsize()} songs | '
                  f'Total duration: {YTDLSource.format_duration(total_duration)} | '
@@ -773,24 +3036,18 @@ class Music(commands.Cog):
             )
             return await ctx.send(embed=embed)
         
-        # Calculate progress
-        current_pos = player.get_current_position()
+        # Progress from the frames sent, exact to 20 ms
         duration = player.current.duration
-        
-        # Create progress bar
         if duration > 0:
-            progress_percent = current_pos / duration
-            filled_blocks = int(progress_percent * 30)
-            empty_blocks = 30 - filled_blocks
-            progress_bar = f"{'█' * filled_blocks}{'░' * empty_blocks}"
-            time_display = f"{YTDLSource.format_duration(int(current_pos))} / {YTDLSource.format_duration(duration)}"
+            progress_bar, time_display = YTDLSource.format_progress(player.get_current_position(), duration)
         else:
             progress_bar = "🔴 LIVE STREAM"
             time_display = "N/A"
         
+        display = player.current.display
         embed = discord.Embed(
             title="🎵 Now Playing",
-            description=f"[{vc.source.title}]({vc.source.web_url})",
+            description=display.link,
             color=discord.Color.green()
         )
         
@@ -800,15 +3057,15 @@ class Music(commands.Cog):
         
         # Add fields
         embed.add_field(name="Progress", value=f"```{progress_bar}```{time_display}", inline=False)
-        embed.add_field(name="Requested by", value=player.current.requester.mention, inline=True)
+        embed.add_field(name="Requested by", value=display.requester, inline=True)
         embed.add_field(name="Uploader", value=player.current.uploader, inline=True)
         embed.add_field(name="Volume", value=f"{int(player.volume * 100)}%", inline=True)
         embed.add_field(name="Repeat Mode", value=player.repeat_mode.upper(), inline=True)
         embed.add_field(name="Queue Length", value=f"{player.queue.qsize()} songs", inline=True)
         
         # Add view count if available
-        if hasattr(player.current, 'view_count') and player.current.view_count:
-            embed.add_field(name="Views", value=f"{player.current.view_count:,}", inline=True)
+        if display.views:
+            embed.add_field(name="Views", value=display.views, inline=True)
         
         # Add controls hint
         embed.set_footer(text=f"Use {ctx.prefix}help music for all commands")
@@ -851,6 +3108,10 @@ class Music(commands.Cog):
             vc.source.volume = vol / 100
         
         player.volume = vol / 100
+        player.now_playing.update()
+        
+        # Opus sources get their volume from FFmpeg when they are opened
+        fixed_volume = vc.source is not None and vc.source.is_opus()
         
         # Volume indicator
         volume_emoji = "🔇" if vol == 0 else "🔈" if vol < 30 else "🔉" if vol < 70 else "🔊"
@@ -860,6 +3121,8 @@ class Music(commands.Cog):
             description=f"{volume_emoji} Volume set to **{int(vol)}%**",
             color=discord.Color.green()
         )
+        if fixed_volume:
+            embed.set_footer(text="Takes effect from the next song")
         await ctx.send(embed=embed)
     
     @commands.command(name='clear', aliases=['cl', 'empty'], description="Clear the queue")
@@ -885,11 +3148,8 @@ class Music(commands.Cog):
             )
             return await ctx.send(embed=embed)
         
-        # Count songs before clearing
-        song_count = player.queue.qsize()
-        
         # Clear the queue
-        player.queue._queue.clear()
+        song_count = player.queue.clear()
         
         embed = discord.Embed(
             title="Queue Cleared",
@@ -930,23 +3190,17 @@ class Music(commands.Cog):
                 )
                 return await ctx.send(embed=embed)
             
-            # Convert queue to list, remove item, recreate queue
-            queue_list = list(player.queue._queue)
-            removed_song = queue_list.pop(index - 1)
-            
-            # Clear and refill queue
-            player.queue._queue.clear()
-            for song in queue_list:
-                player.queue._queue.append(song)
+            removed_song = player.queue.remove(index - 1)
+            player.schedule_prefetch()
             
             embed = discord.Embed(
                 title="Song Removed",
-                description=f"✅ Removed: [{removed_song['title']}]({removed_song['webpage_url']})",
+                description=f"✅ Removed: [{removed_song.title}]({removed_song.webpage_url})",
                 color=discord.Color.green()
             )
             embed.add_field(
                 name="Requested by",
-                value=removed_song['requester'].mention,
+                value=removed_song.requester.mention,
                 inline=True
             )
             await ctx.send(embed=embed)
@@ -983,18 +3237,12 @@ class Music(commands.Cog):
             )
             return await ctx.send(embed=embed)
         
-        # Convert queue to list, shuffle, recreate queue
-        queue_list = list(player.queue._queue)
-        random.shuffle(queue_list)
-        
-        # Clear and refill queue
-        player.queue._queue.clear()
-        for song in queue_list:
-            player.queue._queue.append(song)
+        player.queue.shuffle()
+        player.schedule_prefetch()
         
         embed = discord.Embed(
             title="Queue Shuffled",
-            description=f"🔀 Successfully shuffled {len(queue_list)} songs!",
+            description=f"🔀 Successfully shuffled {player.queue.qsize()} songs!",
             color=discord.Color.green()
         )
         await ctx.send(embed=embed)
@@ -1012,13 +3260,49 @@ class Music(commands.Cog):
             )
             return await ctx.send(embed=embed)
         
-        # For now, seeking isn't supported with streaming
-        # This is a placeholder for future implementation
+        player = self.get_player(ctx)
+        current = player.current
+        seconds = parse_position(position, player.get_current_position())
+        if seconds is None:
+            embed = discord.Embed(
+                title="Invalid position",
+                description="Use `MM:SS`, `HH:MM:SS`, seconds, or `+30`/`-30` to skip forward or back.",
+                color=discord.Color.red()
+            )
+            return await ctx.send(embed=embed)
+        
+        if not current.duration:
+            embed = discord.Embed(
+                title="Can't seek",
+                description="Live streams and songs without a known length can't be seeked.",
+                color=discord.Color.red()
+            )
+            return await ctx.send(embed=embed)
+        
+        seconds = max(0, seconds)
+        if seconds >= current.duration:
+            embed = discord.Embed(
+                title="Invalid position",
+                description=f"The song is only {YTDLSource.format_duration(current.duration)} long.",
+                color=discord.Color.red()
+            )
+            return await ctx.send(embed=embed)
+        
+        try:
+            async with ctx.typing():
+                seeked = await player.seek(seconds)
+        except Exception as e:
+            logger.error(f"Seek failed in guild {ctx.guild.name}: {e}")
+            return await ctx.send(f"❌ Could not seek: {e}")
+        
+        if not seeked:
+            return await ctx.send("❌ The song changed while seeking.")
+        
         embed = discord.Embed(
-            title="Not Supported",
-            description="Seeking is not currently supported for streamed audio.\n"
-                       "This feature may be added in a future update!",
-            color=discord.Color.orange()
+            title="⏩ Seeked",
+            description=f"[{current.title}]({current.web_url}) from "
+                        f"{YTDLSource.format_duration(int(seconds))} / {YTDLSource.format_duration(current.duration)}",
+            color=discord.Color.blue()
         )
         await ctx.send(embed=embed)
     
@@ -1069,19 +3353,12 @@ class Music(commands.Cog):
             )
             return await ctx.send(embed=embed)
         
-        # Convert queue to list, move item, recreate queue
-        queue_list = list(player.queue._queue)
-        song_to_move = queue_list.pop(from_index - 1)
-        queue_list.insert(to_index - 1, song_to_move)
-        
-        # Clear and refill queue
-        player.queue._queue.clear()
-        for song in queue_list:
-            player.queue._queue.append(song)
+        song_to_move = player.queue.move(from_index - 1, to_index - 1)
+        player.schedule_prefetch()
         
         embed = discord.Embed(
             title="Song Moved",
-            description=f"✅ Moved **{song_to_move['title']}** from position {from_index} to {to_index}",
+            description=f"✅ Moved **{song_to_move.title}** from position {from_index} to {to_index}",
             color=discord.Color.green()
         )
         await ctx.send(embed=embed)
@@ -1110,7 +3387,7 @@ class Music(commands.Cog):
         
         # Clear the queue and stop playback
         player = self.get_player(ctx)
-        player.queue._queue.clear()
+        player.queue.clear()
         
         await self.cleanup(ctx.guild)
         
@@ -1155,7 +3432,7 @@ class Music(commands.Cog):
         
         # Try to send to user's DM
         try:
-            await ctx.author.send(embed=embed)
+            await outbound.send(ctx.author, embed=embed, priority=HIGH)
             
             # Confirm in channel
             confirm_embed = discord.Embed(
@@ -1180,22 +3457,12 @@ class Music(commands.Cog):
             search_msg = await ctx.send("🔍 Searching...")
             
             try:
-                # Configure for search results
-                search_opts = ytdlopts.copy()
-                search_opts['extract_flat'] = True
-                search_opts['force_generic_extractor'] = False
-                
-                ytdl_search = youtube_dl.YoutubeDL(search_opts)
-                
-                # Search for 5 results
+                # Search for 5 results (flat extraction, no stream URLs needed)
                 search_query = f"ytsearch5:{query}"
-                data = await self.bot.loop.run_in_executor(
-                    None, 
-                    lambda: ytdl_search.extract_info(search_query, download=False)
-                )
+                data = await fetch_info(search_query, loop=self.bot.loop, flat=True, guild_id=ctx.guild.id)
                 
                 if not data or 'entries' not in data:
-                    await search_msg.delete()
+                    ctx.discard(search_msg)
                     embed = discord.Embed(
                         title="No Results",
                         description="No results found for your search.",
@@ -1224,12 +3491,12 @@ class Music(commands.Cog):
                         inline=False
                     )
                 
-                await search_msg.delete()
+                # Replaces the searching message rather than sending a second one
+                ctx.discard(search_msg)
                 search_message = await ctx.send(embed=embed)
                 
-                # Add reactions
-                for i in range(len(entries)):
-                    await search_message.add_reaction(emojis[i])
+                # Added in the background, paced for the reaction rate limit
+                outbound.add_reactions(search_message, emojis[:len(entries)])
                 
                 # Wait for user reaction
                 def check(reaction, user):
@@ -1240,13 +3507,13 @@ class Music(commands.Cog):
                 try:
                     reaction, user = await self.bot.wait_for('reaction_add', timeout=30.0, check=check)
                 except asyncio.TimeoutError:
-                    await search_message.clear_reactions()
+                    outbound.clear_reactions(search_message)
                     timeout_embed = discord.Embed(
                         title="Search Timed Out",
                         description="You didn't select a song in time.",
                         color=discord.Color.orange()
                     )
-                    await search_message.edit(embed=timeout_embed)
+                    await outbound.edit(search_message, embed=timeout_embed)
                     return
                 
                 # Get selected song
@@ -1254,13 +3521,13 @@ class Music(commands.Cog):
                 selected_entry = entries[selected_index]
                 
                 # Clear reactions and update message
-                await search_message.clear_reactions()
+                outbound.clear_reactions(search_message)
                 selected_embed = discord.Embed(
                     title="Song Selected",
                     description=f"Selected: **{selected_entry['title']}**",
                     color=discord.Color.green()
                 )
-                await search_message.edit(embed=selected_embed)
+                await outbound.edit(search_message, embed=selected_embed)
                 
                 # Play the selected song
                 url = f"https://youtube.com/watch?v={selected_entry['id']}"
@@ -1268,7 +3535,7 @@ class Music(commands.Cog):
                 
             except Exception as e:
                 logger.error(f"Error in search command: {e}")
-                await search_msg.delete()
+                ctx.discard(search_msg)
                 embed = discord.Embed(
                     title="Search Error",
                     description="An error occurred while searching.",
@@ -0,0 +1,342 @@
+"""
+Outbound queue for the bot's REST calls.
+
+Messages the bot sends, edits and deletes and the reactions it adds go through
+one scheduler instead of being awaited inline by every command. It keeps the
+process within a global budget of calls per second and a budget per channel,
+runs command replies before background updates, and saves calls where it can:
+
+- a send that replaces a message still queued for deletion (e.g. "Searching...")
+  becomes an edit of that message
+- queued edits of the same message are merged into one
+- the reactions for a message are added by one job, paced for Discord's
+  reaction limit, rather than by a chain of awaits in the command; clearing
+  them stops that job first
+
+discord.py still handles any 429 that gets through; the queue just keeps them
+from happening in the first place.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import time
+
+from discord.ext import commands
+
+from metrics import registry
+
+logger = logging.getLogger('discord_bot.outbound')
+
+GLOBAL_RATE = float(os.getenv('OUTBOUND_RATE', '40'))  # REST calls per second, Discord allows 50
+CHANNEL_RATE = float(os.getenv('OUTBOUND_CHANNEL_RATE', '1'))  # Message calls per second and channel
+CHANNEL_BURST = 5  # Discord allows 5 messages per 5 seconds in a channel
+REACTION_INTERVAL = 0.25  # Discord allows about one reaction per 0.25 seconds
+
+# Priorities, lower numbers go first
+HIGH = 0  # Replies to commands
+NORMAL = 1
+LOW = 2  # Deletes, now playing updates
+PRIORITY_NAMES = {HIGH: 'high', NORMAL: 'normal', LOW: 'low'}
+
+# Sends with only these arguments can be turned into an edit
+EDITABLE = {'content', 'embed', 'embeds', 'allowed_mentions', 'delete_after'}
+
+queue_depth = registry.gauge('bot_outbound_queue_depth', 'REST calls waiting in the outbound queue', ('priority',))
+outbound_requests = registry.counter('bot_outbound_requests_total', 'REST calls made through the outbound queue',
+                                     ('action',))
+outbound_coalesced = registry.counter('bot_outbound_coalesced_total', 'REST calls saved by merging queued calls',
+                                      ('kind',))
+
+
+class TokenBucket:
+    """Allows ``rate`` actions per second on average, in bursts of up to ``burst``"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """Take a token if one is available"""
+        self._refill()
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def is_full(self):
+        """Whether the bucket is back to its full burst"""
+        self._refill()
+        return self._tokens >= self.burst
+
+    def wait_time(self):
+        """Seconds until a token is available"""
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self.rate)
+
+    async def acquire(self):
+        """Take a token, waiting for one if the bucket is empty"""
+        while not self.try_acquire():
+            await asyncio.sleep(self.wait_time())
+
+
+class Job:
+    """One queued REST call (or batch of reactions) and the future of its result"""
+
+    __slots__ = ('action', 'priority', 'seq', 'channel_id', 'message', 'send', 'kwargs', 'future')
+
+    def __init__(self, action, priority, seq, channel_id, future, *, message=None, send=None, kwargs=None):
+        self.action = action  # send, edit, delete, reactions or clear_reactions
+        self.priority = priority
+        self.seq = seq
+        self.channel_id = channel_id
+        self.message = message
+        self.send = send  # Coroutine function sending the message, for send
+        self.kwargs = kwargs or {}
+        self.future = future
+
+    @property
+    def route(self):
+        # Reactions have a limit of their own, a batch of them counts once
+        return ('reactions' if self.action in ('reactions', 'clear_reactions') else 'messages', self.channel_id)
+
+
+def _retrieve(future):
+    # Fire-and-forget calls never await their future
+    if not future.cancelled():
+        future.exception()
+
+
+class OutboundQueue:
+    """Schedules the bot's REST calls by priority within a global and a per-channel budget"""
+
+    def __init__(self, rate=GLOBAL_RATE, channel_rate=CHANNEL_RATE, channel_burst=CHANNEL_BURST):
+        self.bucket = TokenBucket(rate, max(1, rate))
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self._routes = {}  # Route -> TokenBucket
+        self._jobs = []
+        self._running = set()  # Calls in flight, referenced until they finish
+        self._reacting = {}  # Message ID -> (job, task) of reactions being added
+        self._seq = itertools.count()
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    # Submitting calls
+
+    def send(self, channel, content=None, *, priority=NORMAL, send=None, reuse=None, **kwargs):
+        """Queue a message to ``channel``; returns a future of the sent (or edited) message.
+
+        ``send`` replaces ``channel.send``, for contexts that add their own handling.
+        If the message ``reuse`` is still queued for deletion, it is edited instead.
+        """
+        if content is not None:
+            kwargs['content'] = content
+
+        if reuse is not None and kwargs.keys() <= EDITABLE:
+            delete = self._find('delete', reuse)
+            if delete is not None:
+                # Reuse the message that was about to be deleted
+                self._remove(delete)
+                delete.future.set_result(None)
+                outbound_coalesced.inc(kind='delete_send')
+                kwargs.setdefault('content', None)
+                if 'embeds' not in kwargs:
+                    kwargs.setdefault('embed', None)
+                return self._submit('edit', priority, channel.id, message=delete.message, kwargs=kwargs)
+
+        return self._submit('send', priority, channel.id, send=send or channel.send, kwargs=kwargs)
+
+    def edit(self, message, *, priority=NORMAL, **kwargs):
+        """Queue an edit of ``message``; edits queued for the same message are merged"""
+        job = self._find('edit', message)
+        if job is not None:
+            job.kwargs.update(kwargs)
+            if priority < job.priority:
+                queue_depth.dec(priority=PRIORITY_NAMES[job.priority])
+                queue_depth.inc(priority=PRIORITY_NAMES[priority])
+                job.priority = priority
+            outbound_coalesced.inc(kind='edit')
+            return job.future
+        return self._submit('edit', priority, message.channel.id, message=message, kwargs=kwargs)
+
+    def delete(self, message, *, priority=LOW):
+        """Queue the deletion of one of the bot's messages; failures are only logged"""
+        return self._submit('delete', priority, message.channel.id, message=message)
+
+    def add_reactions(self, message, emojis, *, priority=NORMAL):
+        """Queue adding ``emojis`` to ``message``, in order"""
+        return self._submit('reactions', priority, message.channel.id, message=message,
+                            kwargs={'emojis': list(emojis)})
+
+    def clear_reactions(self, message, *, priority=NORMAL):
+        """Queue removing all reactions from ``message``.
+
+        Reactions still queued for it are dropped, and a job still adding them
+        is stopped and waited for, so none are added after the clear.
+        """
+        job = self._find('reactions', message)
+        if job is not None:
+            self._remove(job)
+            job.future.cancel()
+        return self._submit('clear_reactions', priority, message.channel.id, message=message)
+
+    def stats(self):
+        """Queued calls by priority"""
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for job in self._jobs:
+            depth[PRIORITY_NAMES[job.priority]] += 1
+        return depth
+
+    def close(self):
+        """Stop the worker; calls still queued are cancelled"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for job in self._jobs:
+            job.future.cancel()
+            queue_depth.dec(priority=PRIORITY_NAMES[job.priority])
+        self._jobs.clear()
+
+    # Scheduling
+
+    def _submit(self, action, priority, channel_id, **fields):
+        self._ensure_worker()
+        job = Job(action, priority, next(self._seq), channel_id, self._loop.create_future(), **fields)
+        job.future.add_done_callback(_retrieve)
+        self._jobs.append(job)
+        queue_depth.inc(priority=PRIORITY_NAMES[priority])
+        self._wakeup.set()
+        return job.future
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # First use, or the bot was restarted on a new loop
+            self.close()
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+        if self._task is None:
+            self._task = loop.create_task(self._run(), name='outbound queue')
+
+    def _find(self, action, message):
+        for job in self._jobs:
+            if job.action == action and job.message.id == message.id:
+                return job
+        return None
+
+    def _remove(self, job):
+        self._jobs.remove(job)
+        queue_depth.dec(priority=PRIORITY_NAMES[job.priority])
+
+    def _route_bucket(self, route):
+        bucket = self._routes.get(route)
+        if bucket is None:
+            bucket = self._routes[route] = TokenBucket(self.channel_rate, self.channel_burst)
+        return bucket
+
+    def _next_job(self):
+        """Take the first job by priority whose channel has budget left, or return the seconds to wait"""
+        wait = None
+        for job in sorted(self._jobs, key=lambda job: (job.priority, job.seq)):
+            bucket = self._route_bucket(job.route)
+            if bucket.try_acquire():
+                self._remove(job)
+                return job, None
+            wait = bucket.wait_time() if wait is None else min(wait, bucket.wait_time())
+        return None, wait
+
+    async def _run(self):
+        while True:
+            job, wait = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self.bucket.acquire()
+            # Calls run side by side; the budgets above set the pace
+            task = self._loop.create_task(self._execute(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+            if len(self._routes) > 1000:
+                # Forget the channels that are back to a full budget
+                self._routes = {route: bucket for route, bucket in self._routes.items() if not bucket.is_full()}
+
+    async def _execute(self, job):
+        if job.action == 'reactions':
+            adding = self._reacting[job.message.id] = (job, asyncio.current_task())
+        try:
+            result = await self._perform(job)
+        except Exception as e:
+            if job.action in ('delete', 'reactions'):
+                logger.debug(f"Outbound {job.action} failed: {e}")
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            if job.action == 'reactions' and self._reacting.get(job.message.id) == adding:
+                del self._reacting[job.message.id]
+
+    async def _perform(self, job):
+        if job.action == 'reactions':
+            for index, emoji in enumerate(job.kwargs['emojis']):
+                if index:
+                    await asyncio.sleep(REACTION_INTERVAL)
+                    await self.bucket.acquire()
+                if job.future.cancelled():
+                    # Cleared while they were being added
+                    break
+                outbound_requests.inc(action='reaction')
+                await job.message.add_reaction(emoji)
+            return None
+
+        if job.action == 'clear_reactions':
+            adding = self._reacting.get(job.message.id)
+            if adding is not None:
+                adding[0].future.cancel()
+                await asyncio.wait([adding[1]])
+            outbound_requests.inc(action=job.action)
+            return await job.message.clear_reactions()
+
+        outbound_requests.inc(action=job.action)
+        if job.action == 'delete':
+            return await job.message.delete()
+        if job.action == 'edit':
+            return await job.message.edit(**job.kwargs)
+        return await job.send(**job.kwargs)
+
+
+class Context(commands.Context):
+    """Command context whose replies go through the outbound queue ahead of background calls"""
+
+    # Message of this command queued for deletion; the next reply takes it over
+    replaceable = None
+
+    def discard(self, message):
+        """Queue deleting one of this command's messages, letting its next reply (even an error) edit it instead"""
+        self.replaceable = message
+        return outbound.delete(message)
+
+    async def send(self, content=None, **kwargs):
+        kwargs.setdefault('reuse', self.replaceable)
+        self.replaceable = None
+        return await outbound.send(self.channel, content, priority=HIGH, send=super().send, **kwargs)
+
+
+# Shared by every guild the bot is in
+outbound = OutboundQueue()
@@ -0,0 +1,102 @@
+import unittest
+import asyncio
+import sys
+import os
+from unittest.mock import AsyncMock, Mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cluster import ClusterClient, ClusterLauncher, shard_ranges
+
+
+class TestShardRanges(unittest.TestCase):
+    def test_even_split(self):
+        self.assertEqual(shard_ranges(4, 2), [[0, 1], [2, 3]])
+
+    def test_uneven_split(self):
+        self.assertEqual(shard_ranges(5, 3), [[0, 1], [2, 3], [4]])
+
+    def test_more_processes_than_shards(self):
+        self.assertEqual(shard_ranges(2, 4), [[0], [1]])
+
+
+class TestWorkerBot(unittest.TestCase):
+    def test_only_main_builds_a_bot(self):
+        # A spawned worker imports main.py twice; neither import may build a bot
+        import main
+        self.assertFalse(hasattr(main, 'bot'))
+
+        bot = main.create_bot()
+        self.assertLessEqual(
+            {'ping', 'stats', 'invite', 'support', 'about', 'shutdown', 'reload', 'debug', 'latency'},
+            {command.name for command in bot.commands},
+        )
+
+
+class TestClusterIPC(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.launcher = ClusterLauncher(processes=2, shard_count=4)
+        self.launcher.serve()
+
+        self.bots = []
+        self.clients = []
+        for cluster_id in range(2):
+            bot = Mock()
+            bot.process_stats.return_value = {'guilds': 10 + cluster_id}
+            bot.reload_extension = AsyncMock()
+            bot.close = AsyncMock()
+            bot.voice_clients = []
+            client = ClusterClient(bot, cluster_id, self.launcher.address, self.launcher.authkey)
+            await client.connect()
+            self.bots.append(bot)
+            self.clients.append(client)
+
+        # Wait until the launcher has registered both connections
+        for _ in range(100):
+            if all(worker.conn for worker in self.launcher.workers):
+                break
+            await asyncio.sleep(0.01)
+
+    async def asyncTearDown(self):
+        self.launcher.stopping.set()
+        for client in self.clients:
+            client.close()
+        self.launcher.listener.close()
+
+    async def test_gathers_stats_from_every_process(self):
+        stats = await self.clients[0].request('stats')
+        self.assertEqual(stats, {0: {'guilds': 10}, 1: {'guilds': 11}})
+
+    async def test_broadcasts_reload(self):
+        results = await self.clients[1].request('reload', extension='music_player')
+
+        self.assertEqual(results, {0: 'ok', 1: 'ok'})
+        for bot in self.bots:
+            bot.reload_extension.assert_awaited_once_with('music_player')
+
+    async def test_reports_errors(self):
+        self.bots[1].reload_extension.side_effect = RuntimeError('broken')
+        results = await self.clients[0].request('reload', extension='music_player')
+        self.assertEqual(results[1], {'error': 'broken'})
+
+    async def test_shutdown_closes_every_bot(self):
+        self.clients[0].notify('shutdown')
+
+        for _ in range(100):
+            if all(bot.close.await_count for bot in self.bots):
+                break
+            await asyncio.sleep(0.01)
+
+        self.assertTrue(self.launcher.stopping.is_set())
+        for bot in self.bots:
+            bot.close.assert_awaited_once()
+
+    async def test_silent_workers_answer_none(self):
+        self.clients[1].close()
+        await asyncio.sleep(0.05)
+        stats = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: self.launcher.broadcast('stats', timeout=0.5))
+        self.assertEqual(stats, {0: {'guilds': 10}, 1: None})
+
+
+if __name__ == '__main__':
+    unittest.main()
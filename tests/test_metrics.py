@@ -0,0 +1,173 @@
+import unittest
+import asyncio
+import sys
+import os
+import threading
+
+import aiohttp
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metrics
+from metrics import CallbackGauge, Histogram, LatencyTracker, Registry
+
+
+class TestHistogram(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(Histogram().quantile(0.5), 0.0)
+
+    def test_quantiles_are_close(self):
+        histogram = Histogram()
+        for ms in range(1, 1001):
+            histogram.observe(ms / 1000)
+
+        # Within one bucket (bounds grow by 50%) of the exact value
+        for q, exact in ((0.5, 0.5), (0.95, 0.95), (0.99, 0.99)):
+            with self.subTest(q=q):
+                self.assertLess(abs(histogram.quantile(q) - exact) / exact, 0.5)
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.sum, 500.5)
+
+    def test_overflow(self):
+        histogram = Histogram()
+        histogram.observe(10000)
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(histogram.quantile(0.99), Histogram.BUCKETS[-1])
+
+
+class TestLatencyTracker(unittest.TestCase):
+    def test_overall_and_per_guild(self):
+        tracker = LatencyTracker()
+        tracker.observe('extract', 0.2, guild_id=1)
+        tracker.observe('extract', 0.4, guild_id=2)
+        tracker.observe('resolve', 0.1)
+
+        self.assertEqual(tracker.summary()['extract']['count'], 2)
+        self.assertEqual(set(tracker.summary()), {'extract', 'resolve'})
+        self.assertEqual(tracker.summary(1)['extract']['count'], 1)
+        self.assertEqual(tracker.summary(3), {})
+
+        tracker.forget(1)
+        self.assertEqual(tracker.summary(1), {})
+
+    def test_span_skips_failures(self):
+        tracker = LatencyTracker()
+        with tracker.span('extract', 1):
+            pass
+        with self.assertRaises(ValueError):
+            with tracker.span('extract', 1):
+                raise ValueError
+
+        self.assertEqual(tracker.summary(1)['extract']['count'], 1)
+
+    def test_render(self):
+        tracker = LatencyTracker()
+        tracker.observe('extract', 0.25)
+
+        text = tracker.render()
+
+        self.assertIn('# TYPE bot_stage_latency_seconds histogram', text)
+        self.assertIn('bot_stage_latency_seconds_bucket{stage="extract",le="+Inf"} 1', text)
+        self.assertIn('bot_stage_latency_seconds_count{stage="extract"} 1', text)
+
+
+class TestRegistry(unittest.TestCase):
+    def test_get_or_create(self):
+        registry = Registry()
+        counter = registry.counter('bot_test_total', 'Test', ('command',))
+        counter.inc(command='play')
+
+        again = registry.counter('bot_test_total', 'Test', ('command',))
+
+        self.assertIs(again, counter)
+        self.assertEqual(again.value(command='play'), 1)
+
+    def test_gauge(self):
+        registry = Registry()
+        gauge = registry.gauge('bot_queue_length', 'Test', ('guild',))
+        gauge.set(3, guild=1)
+        gauge.inc(guild=2)
+        gauge.dec(guild=2)
+        gauge.remove(guild=1)
+
+        self.assertEqual(gauge.values, {('2',): 0})
+
+    def test_render(self):
+        registry = Registry()
+        registry.counter('bot_commands_total', 'Commands', ('command',)).inc(command='play')
+        registry.gauge('bot_voice_connections', 'Voice')
+        registry.register(CallbackGauge('bot_hits_total', 'Hits', lambda: 7, kind='counter'))
+        registry.register(CallbackGauge('bot_memory_bytes', 'Memory', lambda: None))
+
+        text = registry.render()
+
+        self.assertIn('bot_commands_total{command="play"} 1\n', text)
+        self.assertIn('bot_voice_connections 0\n', text)
+        self.assertIn('# TYPE bot_hits_total counter\nbot_hits_total 7\n', text)
+        self.assertNotIn('bot_memory_bytes', text)
+
+    def test_process_rss(self):
+        rss = metrics.process_rss()
+        if rss is not None:
+            self.assertGreater(rss, 0)
+
+
+class TestLoopMonitor(unittest.IsolatedAsyncioTestCase):
+    async def test_samples(self):
+        monitor = metrics.LoopMonitor(interval=0.01)
+        monitor.start()
+        await asyncio.sleep(0.05)
+        monitor.stop()
+
+        self.assertGreater(monitor.histogram.count, 0)
+        self.assertIn('bot_event_loop_lag_seconds_count', monitor.render())
+
+    async def test_attributes_stall_to_command(self):
+        monitor = metrics.LoopMonitor(threshold=0.05)
+        monitor._loop = asyncio.get_running_loop()
+        monitor._thread_id = threading.get_ident()
+
+        async def blocking_command():
+            monitor.label(asyncio.current_task(), 'play')
+            # Capture from another thread while the loop is busy here, as the watchdog does
+            watchdog = threading.Thread(target=lambda: setattr(monitor, '_capture', monitor._snapshot()))
+            watchdog.start()
+            watchdog.join()
+            monitor.unlabel(asyncio.current_task())
+
+        await asyncio.create_task(blocking_command())
+        with self.assertLogs('discord_bot.metrics', 'WARNING'):
+            monitor._record(0.2)
+
+        stall = monitor.stats()['recent'][-1]
+        self.assertEqual(stall['seconds'], 0.2)
+        self.assertEqual(stall['command'], 'play')
+        self.assertIn('blocking_command', stall['where'])
+        self.assertIn('blocking_command', stall['task'])
+        self.assertEqual(monitor.labels, {})
+
+    def test_short_lag_is_not_a_stall(self):
+        monitor = metrics.LoopMonitor(threshold=0.05)
+        monitor._record(0.01)
+
+        self.assertEqual(monitor.stats()['stalls'], 0)
+        self.assertEqual(monitor.last_lag, 0.01)
+
+
+class TestMetricsEndpoint(unittest.IsolatedAsyncioTestCase):
+    async def test_serves_metrics(self):
+        metrics.latency.observe('queued', 0.01)
+        runner = await metrics.start_http_server(0)
+        try:
+            host, port = runner.addresses[0][:2]
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f'http://{host}:{port}/metrics') as response:
+                    body = await response.text()
+        finally:
+            await runner.cleanup()
+
+        self.assertEqual(response.status, 200)
+        self.assertIn('stage="queued"', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
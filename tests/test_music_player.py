@@ -6,9 +6,37 @@ from discord.ext import commands
 import tempfile
 import sys
 import os
+import math
+import time
+import threading
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from music_player import Music, YTDLSource, MusicPlayer
+import music_player
+from metrics import LatencyTracker
+from music_player import (Music, YTDLSource, MusicPlayer, ExtractionCache, PersistentExtractionCache, cache_key,
+                          fetch_info, stream_expiry, ExtractorPool, ExtractorBusy,
+                          SingleFlight, Track, TrackQueue, MixingSource, YTDLOpusSource, GainTransformer,
+                          analyse_loudness, scale_pcm, FirstFrameStats, FFMPEG_PROFILES, is_playlist_url,
+                          AudioCache, load_cached_audio, parse_position, FRAME_SECONDS, NowPlayingMessage,
+                          TokenBucket, STREAM_URL_MARGIN)
+
+
+class FakePCMSource(discord.AudioSource):
+    """PCM source that yields a fixed number of constant frames without spawning FFmpeg"""
+
+    def __init__(self, *args, frames=50, sample=0, **kwargs):
+        self.frames = frames
+        self.sample = sample.to_bytes(2, 'little', signed=True)
+        self.cleaned_up = False
+
+    def read(self):
+        if self.frames <= 0:
+            return b''
+        self.frames -= 1
+        return self.sample * (discord.opus.Encoder.FRAME_SIZE // 2)
+
+    def cleanup(self):
+        self.cleaned_up = True
 
 
 class TestMusicPlayer(unittest.IsolatedAsyncioTestCase):
@@ -60,6 +88,17 @@ class TestMusicPlayer(unittest.IsolatedAsyncioTestCase):
         player2 = self.music_cog.get_player(self.ctx)
         self.assertIs(player1, player2)
 
+    @patch('asyncio.create_task')
+    def test_players_counted_per_shard(self, mock_create_task):
+        self.ctx.guild.shard_id = 2
+        self.ctx.guild.voice_client = None
+        self.music_cog.get_player(self.ctx)
+        self.music_cog.get_player(self.ctx)
+        self.assertEqual(self.music_cog.shard_players, {2: 1})
+
+        self.bot.loop.run_until_complete(self.music_cog.cleanup(self.ctx.guild))
+        self.assertEqual(self.music_cog.shard_players, {2: 0})
+
     @patch('asyncio.create_task', return_value=MagicMock())
     @patch('music_player.YTDLSource.create_source')
     async def test_play_command(self, mock_create_source, mock_create_task):
@@ -108,6 +147,1287 @@ class TestMusicPlayer(unittest.IsolatedAsyncioTestCase):
             self.assertEqual(source.requester, self.ctx.author)
 
 
+class TestStreamPrefetch(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patcher = patch.object(music_player, 'extraction_cache', ExtractionCache())
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stream_expiry_from_query(self):
+        url = 'https://rr1.googlevideo.com/videoplayback?expire=1700000000&ei=abc'
+        self.assertEqual(stream_expiry(url), 1700000000)
+
+    def test_stream_expiry_from_path(self):
+        url = 'https://rr1.googlevideo.com/videoplayback/expire/1700000000/ei/abc'
+        self.assertEqual(stream_expiry(url), 1700000000)
+
+    def test_stream_expiry_fallback(self):
+        expires = stream_expiry('https://example.com/audio.mp3', default_ttl=100)
+        self.assertAlmostEqual(expires, time.time() + 100, delta=5)
+
+    @patch('music_player.ytdl.extract_info')
+    async def test_resolve_stream_stores_result(self, mock_extract):
+        mock_extract.return_value = {'url': 'https://example.com/a?expire=9999999999', 'title': 'Test',
+                                     'thumbnail': 'https://example.com/thumb.jpg'}
+        track = Track(title='Test', webpage_url='https://example.com/watch', requester=Mock())
+
+        loop = asyncio.get_running_loop()
+        await YTDLSource.resolve_stream(track, loop=loop)
+
+        # Capped at the lifetime the extraction cache gives stream URLs
+        self.assertAlmostEqual(track.stream_expires_at,
+                               time.time() + self.cache.stream_ttl + STREAM_URL_MARGIN, delta=5)
+        self.assertEqual(track.thumbnail, 'https://example.com/thumb.jpg')
+        self.assertTrue(track.has_fresh_stream())
+
+    @patch('music_player.discord.FFmpegPCMAudio', side_effect=FakePCMSource)
+    @patch('music_player.ytdl.extract_info')
+    async def test_regather_uses_prefetched_stream(self, mock_extract, mock_ffmpeg):
+        track = Track(title='Test', webpage_url='https://example.com/watch', requester=Mock())
+        track.set_stream({'url': 'https://example.com/a?expire=9999999999'})
+
+        source = await YTDLSource.regather_stream(track, loop=asyncio.get_running_loop())
+
+        mock_extract.assert_not_called()
+        self.assertEqual(mock_ffmpeg.call_args[0][0], track.stream_url)
+        self.assertEqual(source.title, 'Test')
+        self.assertIs(source.track, track)
+
+    def test_expired_stream_is_not_fresh(self):
+        track = Track(title='Test', webpage_url='https://example.com/watch', requester=Mock())
+        track.set_stream({'url': f'https://example.com/a?expire={int(time.time()) + 5}'})
+        self.assertFalse(track.has_fresh_stream())
+
+    def test_track_state(self):
+        track = Track(title='Test', webpage_url='https://example.com/watch', requester=Mock())
+        self.assertEqual(track.state, 'unresolved')
+
+        track.set_stream({'url': 'https://example.com/a?expire=9999999999'})
+        self.assertEqual(track.state, 'resolved')
+
+        track.set_stream({'url': f'https://example.com/a?expire={int(time.time()) + 5}'})
+        self.assertEqual(track.state, 'expiring')
+
+        track.set_local('/tmp/song.webm')
+        self.assertEqual(track.state, 'resolved')
+
+        track.invalidate()
+        self.assertEqual(track.state, 'unresolved')
+
+    def make_player(self):
+        ctx = Mock()
+        ctx.guild.id = 123
+        ctx.cog.ffmpeg_profiles = {}
+        ctx.bot.loop.create_task = lambda coro: coro.close()
+        return MusicPlayer(ctx)
+
+    @patch('music_player.discord.FFmpegPCMAudio', side_effect=[OSError('403 Forbidden'), FakePCMSource()])
+    async def test_prepare_source_retries_fresh(self, mock_ffmpeg):
+        track = Track(title='Test', webpage_url='https://example.com/watch', requester=Mock())
+        track.set_stream({'url': 'https://example.com/dead?expire=9999999999'})
+        player = self.make_player()
+
+        resolve = AsyncMock()
+        with patch.object(YTDLSource, 'resolve_stream', resolve):
+            source = await player.prepare_source(track)
+
+        # The resolved URL is used as-is first, then re-extracted once bypassing the cache
+        resolve.assert_awaited_once()
+        self.assertTrue(resolve.call_args.kwargs['fresh'])
+        self.assertEqual(mock_ffmpeg.call_count, 2)
+        self.assertIs(source.track, track)
+
+    async def test_song_without_audio_is_replayed_fresh(self):
+        ctx = Mock()
+        ctx.guild.id = 123
+        ctx.cog.ffmpeg_profiles = {}
+        ctx.bot.loop = asyncio.get_running_loop()
+        ctx.bot.wait_until_ready = AsyncMock()
+        ctx.bot.is_closed.return_value = False
+        played = []
+
+        def play(mixer, after):
+            # FFmpeg on a dead URL exits without producing a frame
+            while mixer.read():
+                pass
+            played.append(mixer.current.frames_read)
+            after(None)
+
+        ctx.guild.voice_client.play = play
+        track = Track(title='Test', webpage_url='https://example.com/watch', requester=Mock(), duration=1)
+        track.set_stream({'url': 'https://example.com/dead?expire=9999999999'})
+        dead, working = make_source('a', 0), make_source('a', 5)
+        dead.track = working.track = track
+
+        regather = AsyncMock(side_effect=[dead, working])
+        with patch.object(YTDLSource, 'regather_stream', regather), patch('music_player.PREFETCH_COUNT', 0):
+            player = MusicPlayer(ctx)
+            player.now_playing = Mock()
+            player.queue.put_nowait(track)
+            try:
+                async with asyncio.timeout(5):
+                    while len(played) < 2:
+                        await asyncio.sleep(0.01)
+            finally:
+                player._task.cancel()
+
+        self.assertEqual(played, [0, 5])
+        self.assertFalse(regather.call_args_list[0].kwargs.get('fresh', False))
+        self.assertTrue(regather.call_args_list[1].kwargs['fresh'])
+
+    async def test_prepare_source_gives_up_after_retry(self):
+        track = Track(title='Test', webpage_url='https://example.com/watch', requester=Mock())
+        player = self.make_player()
+
+        failing = AsyncMock(side_effect=commands.CommandError('Error loading audio stream: gone'))
+        with patch.object(YTDLSource, 'resolve_stream', failing):
+            with self.assertRaises(commands.CommandError):
+                await player.prepare_source(track)
+
+        self.assertEqual(failing.call_count, 2)
+        self.assertFalse(failing.call_args_list[0].kwargs['fresh'])
+        self.assertTrue(failing.call_args_list[1].kwargs['fresh'])
+
+    @patch('music_player.ytdl.extract_info')
+    async def test_fresh_fetch_skips_cache(self, mock_extract):
+        mock_extract.return_value = {'title': 'New', 'url': 'https://example.com/b?expire=9999999999'}
+        url = 'https://example.com/watch'
+        self.cache.put(cache_key(url), {'title': 'Old', 'url': 'https://example.com/a?expire=9999999999'})
+
+        loop = asyncio.get_running_loop()
+        cached = await music_player.fetch_info(url, loop=loop, need_stream=True)
+        fresh = await music_player.fetch_info(url, loop=loop, need_stream=True, fresh=True)
+
+        self.assertEqual(cached['title'], 'Old')
+        self.assertEqual(fresh['title'], 'New')
+        self.assertEqual(self.cache.get(cache_key(url), need_stream=True)['title'], 'New')
+
+
+class TestTrack(unittest.TestCase):
+    def test_from_info_keeps_only_needed_fields(self):
+        requester = Mock()
+        data = {
+            'id': 'abc', 'title': 'Test', 'webpage_url': 'https://example.com/watch',
+            'url': 'https://example.com/a', 'duration': 180.0, 'uploader': 'Artist',
+            'description': 'x' * 10000, 'formats': [{}] * 50
+        }
+
+        track = Track.from_info(data, requester)
+
+        self.assertFalse(hasattr(track, '__dict__'))
+        self.assertEqual(track.duration, 180)
+        self.assertEqual(track.stream_url, 'https://example.com/a')
+        self.assertIs(track.requester, requester)
+
+    def test_flat_entry_has_no_stream(self):
+        data = {'_type': 'url', 'url': 'https://www.youtube.com/watch?v=abc', 'title': 'Test'}
+
+        track = Track.from_info(data, Mock())
+
+        self.assertEqual(track.webpage_url, 'https://www.youtube.com/watch?v=abc')
+        self.assertIsNone(track.stream_url)
+        self.assertFalse(track.has_fresh_stream())
+
+    def test_display_is_formatted_once(self):
+        requester = Mock(mention='<@1>')
+        track = Track(title='Test', webpage_url='https://example.com/watch', requester=requester, duration=3725,
+                      upload_date='20230105', view_count=1234567)
+
+        display = track.display
+
+        self.assertIs(track.display, display)
+        self.assertEqual(display.duration, '1:02:05')
+        self.assertEqual(display.uploaded, '2023-01-05')
+        self.assertEqual(display.views, '1,234,567')
+        self.assertEqual(display.queue_entry, '[Test](https://example.com/watch) | `1:02:05` | <@1>')
+
+        embed = YTDLSource.queued_embed(track)
+        self.assertEqual([field.value for field in embed.fields],
+                         ['1:02:05', 'Unknown', '<@1>', '1,234,567', '2023-01-05'])
+
+    def test_display_follows_resolved_metadata(self):
+        track = Track(title='Test', webpage_url='https://example.com/watch', requester=Mock())
+        self.assertEqual(track.display.duration, '🔴 Live')
+
+        track.set_stream({'url': 'https://example.com/a', 'duration': 90, 'uploader': 'Artist',
+                          'uploader_url': 'https://example.com/artist'})
+
+        self.assertEqual(track.display.duration, '1:30')
+        self.assertEqual(track.display.uploader, '[Artist](https://example.com/artist)')
+
+
+def make_tracks(count):
+    return [Track(title=f'Song {n}', webpage_url=f'https://example.com/{n}', requester=None, duration=60)
+            for n in range(count)]
+
+
+class TestTrackQueue(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.queue = TrackQueue()
+        self.tracks = make_tracks(5)
+        for track in self.tracks:
+            self.queue.put_nowait(track)
+
+    def test_remove_and_move(self):
+        removed = self.queue.remove(1)
+        moved = self.queue.move(0, 2)
+
+        self.assertIs(removed, self.tracks[1])
+        self.assertIs(moved, self.tracks[0])
+        self.assertEqual(list(self.queue), [self.tracks[2], self.tracks[3], self.tracks[0], self.tracks[4]])
+        self.assertEqual(self.queue.total_duration, 240)
+
+    def test_shuffle_keeps_tracks(self):
+        self.queue.shuffle()
+        self.assertCountEqual(list(self.queue), self.tracks)
+
+    def test_page(self):
+        self.assertEqual(self.queue.page(3, 10), self.tracks[3:])
+        self.assertEqual(self.queue.page(0, 2), self.tracks[:2])
+        self.assertEqual(self.queue.page(4, 5), self.tracks[4:5])
+        self.assertEqual(self.queue.page(6, 8), [])
+
+    def test_clear(self):
+        self.assertEqual(self.queue.clear(), 5)
+        self.assertTrue(self.queue.empty())
+        self.assertEqual(self.queue.total_duration, 0)
+
+    async def test_get_waits_for_put(self):
+        self.queue.clear()
+        getter = asyncio.create_task(self.queue.get())
+        await asyncio.sleep(0)
+        self.assertFalse(getter.done())
+
+        self.queue.put_nowait(self.tracks[0])
+
+        self.assertIs(await getter, self.tracks[0])
+
+    async def test_cancelled_get_passes_wakeup_on(self):
+        self.queue.clear()
+        first = asyncio.create_task(self.queue.get())
+        second = asyncio.create_task(self.queue.get())
+        await asyncio.sleep(0)
+
+        self.queue.put_nowait(self.tracks[0])
+        first.cancel()
+
+        self.assertIs(await second, self.tracks[0])
+
+    def test_reports_resizes(self):
+        changes = []
+        queue = TrackQueue(on_resize=changes.append)
+        for track in self.tracks:
+            queue.put_nowait(track)
+        queue.get_nowait()
+        queue.remove(0)
+        queue.move(0, 1)
+        queue.clear()
+        queue.clear()
+
+        self.assertEqual(changes, [1, 1, 1, 1, 1, -1, -1, -3])
+
+
+class TestPlaylistImport(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.bot = Mock(spec=commands.Bot)
+        self.bot.loop = asyncio.get_event_loop()
+        self.music_cog = Music(self.bot)
+
+        self.progress_msg = AsyncMock()
+        self.ctx = Mock(spec=commands.Context)
+        self.ctx.guild = Mock(spec=discord.Guild)
+        self.ctx.guild.id = 123456789
+        self.ctx.author = Mock(spec=discord.Member)
+        self.ctx.send = AsyncMock(return_value=self.progress_msg)
+
+        self.player = Mock()
+        self.player.queue = TrackQueue()
+
+    def flat_playlist(self, count):
+        entries = ({'_type': 'url', 'id': f'video{n:05d}', 'title': f'Song {n}', 'duration': 120,
+                    'url': f'https://www.youtube.com/watch?v=video{n:05d}'} for n in range(count))
+        return {'title': 'Test Playlist', 'entries': entries}
+
+    def test_is_playlist_url(self):
+        self.assertTrue(is_playlist_url('https://www.youtube.com/playlist?list=PL1234'))
+        self.assertTrue(is_playlist_url('https://soundcloud.com/artist/sets/album'))
+        self.assertFalse(is_playlist_url('https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PL1234'))
+        self.assertFalse(is_playlist_url('never gonna give you up'))
+
+    @patch('music_player.ytdl_playlist.extract_info')
+    async def test_entries_are_queued_unresolved(self, mock_extract):
+        mock_extract.return_value = self.flat_playlist(60)
+
+        await self.music_cog.import_playlist(self.ctx, self.player, 'https://www.youtube.com/playlist?list=PL1')
+
+        self.assertEqual(self.player.queue.qsize(), 60)
+        self.assertIsNone(self.player.queue[0].stream_url)
+        self.assertEqual(self.player.queue[0].webpage_url, 'https://www.youtube.com/watch?v=video00000')
+        self.ctx.send.assert_called_once()
+        final_embed = self.progress_msg.edit.call_args.kwargs['embed']
+        self.assertIn('Added 60 songs', final_embed.description)
+
+    @patch('music_player.MAX_QUEUE_SIZE', 10)
+    @patch('music_player.ytdl_playlist.extract_info')
+    async def test_queue_size_limit_is_respected(self, mock_extract):
+        mock_extract.return_value = self.flat_playlist(60)
+
+        await self.music_cog.import_playlist(self.ctx, self.player, 'https://www.youtube.com/playlist?list=PL1')
+
+        self.assertEqual(self.player.queue.qsize(), 10)
+        final_embed = self.progress_msg.edit.call_args.kwargs['embed']
+        self.assertIn('Limit reached', [field.name for field in final_embed.fields])
+
+
+def make_source(title, frames, sample=0):
+    """YTDLSource at full volume whose track duration matches its frame count"""
+    track = Track(title=title, webpage_url=f'https://example.com/{title}', requester=None,
+                  duration=frames * MixingSource.FRAME_SECONDS)
+    source = YTDLSource(FakePCMSource(frames=frames, sample=sample), track=track)
+    source.volume = 1.0
+    return source
+
+
+def first_sample(frame):
+    return int.from_bytes(frame[:2], 'little', signed=True)
+
+
+class TestMixingSource(unittest.TestCase):
+    def read_all(self, mixer):
+        frames = []
+        while True:
+            frame = mixer.read()
+            if not frame:
+                return frames
+            frames.append(frame)
+
+    def test_passthrough_without_next(self):
+        source = make_source('a', 10, sample=100)
+        mixer = MixingSource(source)
+
+        frames = self.read_all(mixer)
+
+        self.assertEqual(len(frames), 10)
+        self.assertTrue(all(first_sample(frame) == 100 for frame in frames))
+        self.assertTrue(mixer.done)
+        self.assertEqual(mixer.title, 'a')
+
+    def test_gapless_splice(self):
+        first, second = make_source('a', 10, sample=100), make_source('b', 5, sample=200)
+        handovers = []
+        mixer = MixingSource(first, on_handover=handovers.append)
+        mixer.queue_source(second)
+
+        frames = self.read_all(mixer)
+
+        self.assertEqual([first_sample(frame) for frame in frames], [100] * 10 + [200] * 5)
+        self.assertEqual(handovers, [second])
+        self.assertTrue(first.original.cleaned_up)
+        self.assertIs(mixer.current, second)
+
+    def test_crossfade(self):
+        first, second = make_source('a', 100, sample=1000), make_source('b', 100, sample=3000)
+        mixer = MixingSource(first, crossfade=10 * MixingSource.FRAME_SECONDS)
+        mixer.queue_source(second)
+
+        frames = self.read_all(mixer)
+        samples = [first_sample(frame) for frame in frames]
+
+        # The fade overlaps the last 10 frames of the first song
+        self.assertEqual(len(frames), 190)
+        self.assertEqual(samples[:90], [1000] * 90)
+        self.assertTrue(all(1000 < value < 3000 for value in samples[90:99]))
+        self.assertEqual(samples[99:], [3000] * 91)
+        self.assertTrue(first.original.cleaned_up)
+
+    def test_near_end_fires_once_before_the_fade(self):
+        calls = []
+        mixer = MixingSource(make_source('a', 100), crossfade=10 * MixingSource.FRAME_SECONDS,
+                             lead=20 * MixingSource.FRAME_SECONDS, on_near_end=lambda: calls.append(mixer.frames))
+
+        self.read_all(mixer)
+
+        self.assertEqual(calls, [70])
+
+    def test_unknown_duration_is_not_preloaded(self):
+        source = make_source('live', 10)
+        source.track.duration = 0
+        calls = []
+        mixer = MixingSource(source, lead=1.0, on_near_end=lambda: calls.append(True))
+
+        self.read_all(mixer)
+
+        self.assertEqual(calls, [])
+
+    def test_volume_applies_to_next_source(self):
+        first, second = make_source('a', 10), make_source('b', 10)
+        mixer = MixingSource(first)
+        mixer.queue_source(second)
+
+        mixer.volume = 0.25
+
+        self.assertEqual(first.volume, 0.25)
+        self.assertEqual(second.volume, 0.25)
+
+    @patch('music_player.GAPLESS_PLAYBACK', True)
+    def test_player_arms_preloading_when_gapless(self):
+        ctx = Mock()
+        ctx.bot.loop.create_task = lambda coro: coro.close()
+        player = MusicPlayer(ctx)
+
+        mixer = player.create_mixer(make_source('a', 1000))
+        frames = self.read_all(mixer)
+
+        self.assertEqual(len(frames), 1000)
+        ctx.bot.loop.call_soon_threadsafe.assert_called_once_with(player._start_preload, mixer)
+
+    def test_queue_after_end_is_refused(self):
+        mixer = MixingSource(make_source('a', 1))
+        self.read_all(mixer)
+        self.assertFalse(mixer.queue_source(make_source('b', 1)))
+
+
+class TestPreload(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        ctx = Mock()
+        ctx.cog.ffmpeg_profiles = {}
+        ctx.bot.loop.create_task = lambda coro: coro.close()
+        self.player = MusicPlayer(ctx)
+        self.player._mixer = self.mixer = MixingSource(make_source('a', 100))
+
+        self.next = make_source('b', 10)
+        self.player.queue.put_nowait(self.next.track)
+        self.player.queue.put_nowait(make_tracks(1)[0])
+        patcher = patch.object(MusicPlayer, 'prepare_source', AsyncMock(return_value=self.next))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def preload(self):
+        task = self.player._preload_task = asyncio.ensure_future(self.player._preload(self.mixer))
+        await task
+
+    async def test_song_stays_queued_until_handover(self):
+        await self.preload()
+
+        self.assertIs(self.player.queue[0], self.next.track)
+        self.assertIs(self.mixer._next, self.next)
+
+        self.player._take_preloaded(self.next.track)
+        self.assertEqual(len(self.player.queue), 1)
+        self.assertIsNot(self.player.queue[0], self.next.track)
+
+    async def test_removing_the_song_drops_the_preload(self):
+        for change in (lambda queue: queue.clear(), lambda queue: queue.remove(0), lambda queue: queue.move(0, 1)):
+            with self.subTest(change=change):
+                self.setUp()
+                await self.preload()
+
+                change(self.player.queue)
+
+                self.assertIsNone(self.player._preload_task)
+                self.assertIsNone(self.mixer._next)
+                self.assertTrue(self.next.original.cleaned_up)
+
+
+class TestOpusPassthrough(unittest.IsolatedAsyncioTestCase):
+    def make_track(self, codec):
+        track = Track(title='Test', webpage_url='https://example.com/watch', requester=Mock())
+        track.set_stream({'url': 'https://example.com/a?expire=9999999999', 'acodec': codec})
+        return track
+
+    @patch('music_player.OPUS_MODE', 'auto')
+    @patch('music_player.YTDLOpusSource')
+    async def test_auto_passes_opus_through_at_full_volume(self, mock_opus):
+        track = self.make_track('opus')
+        source = await YTDLSource.open_track(track, volume=1.0)
+        mock_opus.assert_called_once_with(track, volume=1.0, copy=True, profile='default',
+                                          before_options=FFMPEG_PROFILES['default']['before_options'])
+        self.assertIs(source, mock_opus.return_value)
+
+    @patch('music_player.OPUS_MODE', 'auto')
+    @patch('music_player.discord.FFmpegPCMAudio', side_effect=FakePCMSource)
+    @patch('music_player.YTDLOpusSource')
+    async def test_auto_uses_pcm_otherwise(self, mock_opus, mock_ffmpeg):
+        self.assertIsInstance(await YTDLSource.open_track(self.make_track('opus'), volume=0.5), YTDLSource)
+        self.assertIsInstance(await YTDLSource.open_track(self.make_track('mp4a.40.2'), volume=1.0), YTDLSource)
+        mock_opus.assert_not_called()
+
+    @patch('music_player.OPUS_MODE', 'ffmpeg')
+    @patch('music_player.discord.FFmpegOpusAudio.probe', new_callable=AsyncMock, return_value=('aac', 128))
+    @patch('music_player.YTDLOpusSource')
+    async def test_unknown_codec_is_probed_once(self, mock_opus, mock_probe):
+        track = Track(title='Test', webpage_url='https://example.com/a.m4a', requester=Mock())
+        track.set_local('/tmp/a.m4a')
+
+        await YTDLSource.open_track(track, volume=0.5)
+        await YTDLSource.open_track(track, volume=0.5)
+
+        mock_probe.assert_awaited_once_with('/tmp/a.m4a')
+        self.assertEqual(track.codec, 'aac')
+        self.assertEqual(mock_opus.call_count, 2)
+
+    @patch('music_player.discord.FFmpegOpusAudio.__init__', return_value=None)
+    def test_opus_source_options(self, mock_init):
+        copied = YTDLOpusSource(self.make_track('opus'), volume=1.0)
+        self.assertTrue(copied.passthrough)
+        self.assertEqual(mock_init.call_args.kwargs['codec'], 'copy')
+        self.assertNotIn('volume=', mock_init.call_args.kwargs['options'])
+
+        encoded = YTDLOpusSource(self.make_track('opus'), volume=0.3)
+        self.assertFalse(encoded.passthrough)
+        self.assertEqual(mock_init.call_args.kwargs['codec'], 'libopus')
+        self.assertIn('-af volume=0.30', mock_init.call_args.kwargs['options'])
+        self.assertEqual(encoded.title, 'Test')
+
+    def test_mixer_keeps_one_kind_of_audio(self):
+        opus = Mock(duration=10, volume=1.0)
+        opus.is_opus.return_value = True
+        mixer = MixingSource(opus)
+
+        self.assertTrue(mixer.is_opus())
+        self.assertFalse(mixer.queue_source(make_source('pcm', 10)))
+
+
+class TestFFmpegProfiles(unittest.IsolatedAsyncioTestCase):
+    def make_track(self, codec='opus'):
+        track = Track(title='Test', webpage_url='https://example.com/watch', requester=Mock())
+        track.set_stream({'url': 'https://example.com/a?expire=9999999999', 'acodec': codec})
+        return track
+
+    def test_no_profile_passes_a_bitrate_to_pcm_output(self):
+        for name, profile in FFMPEG_PROFILES.items():
+            with self.subTest(profile=name):
+                self.assertNotIn('-ab', profile['options'])
+                self.assertIn('-nostdin', profile['before_options'])
+
+    @patch('music_player.discord.FFmpegPCMAudio', side_effect=FakePCMSource)
+    async def test_profile_options_reach_ffmpeg(self, mock_ffmpeg):
+        source = await YTDLSource.open_track(self.make_track(), volume=0.5, profile='low-latency')
+
+        self.assertIn('-fflags nobuffer', mock_ffmpeg.call_args.kwargs['before_options'])
+        self.assertEqual(source.profile, 'low-latency')
+        self.assertIsNotNone(source.opened_at)
+
+    @patch('music_player.YTDLOpusSource')
+    async def test_low_cpu_copies_opus_at_any_volume(self, mock_opus):
+        track = self.make_track()
+        await YTDLSource.open_track(track, volume=0.5, profile='low-cpu')
+        mock_opus.assert_called_once_with(track, volume=0.5, copy=True, profile='low-cpu',
+                                          before_options=FFMPEG_PROFILES['low-cpu']['before_options'])
+
+    def test_first_frame_is_recorded_per_profile(self):
+        ctx = Mock()
+        ctx.bot.loop.create_task = lambda coro: coro.close()
+        player = MusicPlayer(ctx)
+        source = make_source('a', 3)
+        source.profile, source.opened_at = 'robust', time.perf_counter()
+
+        with patch('music_player.first_frame_stats', FirstFrameStats()) as stats:
+            mixer = player.create_mixer(source, timed=True)
+            mixer.read()
+            mixer.read()
+
+            self.assertEqual(stats.stats()['robust']['samples'], 1)
+
+    def test_time_to_audio_is_recorded_once(self):
+        ctx = Mock()
+        ctx.guild.id = 42
+        ctx.bot.loop.create_task = lambda coro: coro.close()
+        player = MusicPlayer(ctx)
+        source = make_source('a', 3)
+        source.opened_at = time.perf_counter() - 0.5
+        source.track.requested_at = time.perf_counter() - 2.0
+
+        with patch('music_player.latency', LatencyTracker()) as tracker:
+            player._record_first_frame(source, time.perf_counter())
+            player._record_first_frame(source, time.perf_counter())
+
+            summary = tracker.summary(42)
+            self.assertEqual(summary['first_frame']['count'], 2)
+            self.assertEqual(summary['time_to_audio']['count'], 1)
+            self.assertIsNone(source.track.requested_at)
+
+    def test_first_frame_stats(self):
+        stats = FirstFrameStats()
+        for ms in range(1, 101):
+            stats.record('default', ms / 1000)
+
+        summary = stats.stats()['default']
+        self.assertEqual(summary['samples'], 100)
+        self.assertEqual(summary['p50'], 0.051)
+        self.assertEqual(summary['p95'], 0.096)
+
+    async def test_profile_command_is_per_guild(self):
+        cog = Music(Mock())
+        ctx = Mock()
+        ctx.guild.id = 1
+        ctx.send = AsyncMock()
+        ctx.author.guild_permissions.manage_guild = True
+
+        await cog.profile_.callback(cog, ctx, 'Robust')
+
+        self.assertEqual(cog.ffmpeg_profiles, {1: 'robust'})
+
+        ctx.author.guild_permissions.manage_guild = False
+        await cog.profile_.callback(cog, ctx, 'low-cpu')
+        self.assertEqual(cog.ffmpeg_profiles, {1: 'robust'})
+        self.assertEqual(ctx.send.call_args.kwargs['embed'].title, 'Missing Permissions')
+
+
+class TestSeek(unittest.IsolatedAsyncioTestCase):
+    def make_track(self):
+        track = Track(title='Test', webpage_url='https://example.com/watch', requester=Mock(), duration=200)
+        track.set_stream({'url': 'https://example.com/a?expire=9999999999', 'acodec': 'opus'})
+        return track
+
+    def test_parse_position(self):
+        for text, expected in (('90', 90), ('1:30', 90), ('1:02:03', 3723), ('+15', 115), ('-15', 85)):
+            with self.subTest(text=text):
+                self.assertEqual(parse_position(text, current=100), expected)
+        for text in ('abc', '1:75', '1:2:3:4', ''):
+            with self.subTest(text=text):
+                self.assertIsNone(parse_position(text))
+
+    @patch('music_player.discord.FFmpegPCMAudio', side_effect=FakePCMSource)
+    async def test_seeks_before_the_input(self, mock_ffmpeg):
+        await YTDLSource.open_track(self.make_track(), start=42.5)
+
+        before_options = mock_ffmpeg.call_args.kwargs['before_options']
+        self.assertTrue(before_options.endswith('-ss 42.500'))
+        self.assertIn('-reconnect', before_options)
+
+    @patch('music_player.discord.FFmpegPCMAudio', side_effect=FakePCMSource)
+    async def test_local_files_skip_network_options(self, mock_ffmpeg):
+        track = self.make_track()
+        track.set_local('/tmp/song.ogg')
+
+        await YTDLSource.open_track(track, start=10)
+
+        self.assertEqual(mock_ffmpeg.call_args.kwargs['before_options'], '-nostdin -ss 10.000')
+
+    def test_source_counts_frames_read(self):
+        source = make_source('a', 3)
+        source.start_frame = 500
+
+        while source.read():
+            pass
+
+        self.assertEqual(source.frames_read, 3)
+        self.assertAlmostEqual(source.position, 503 * FRAME_SECONDS)
+
+    def test_mixer_continues_from_new_source(self):
+        first = make_source('a', 100, sample=100)
+        mixer = MixingSource(first)
+        for _ in range(10):
+            mixer.read()
+
+        second = make_source('a', 50, sample=200)
+        second.start_frame = 50
+        self.assertTrue(mixer.replace(second))
+        frame = mixer.read()
+
+        self.assertEqual(first_sample(frame), 200)
+        self.assertTrue(first.original.cleaned_up)
+        self.assertIs(mixer.current, second)
+        self.assertEqual(mixer.frames, 51)
+
+    async def test_player_position_and_seek_reuse_stream_url(self):
+        ctx = Mock()
+        ctx.cog.ffmpeg_profiles = {}
+        ctx.bot.loop.create_task = lambda coro: coro.close()
+        player = MusicPlayer(ctx)
+        player.current = make_source('a', 10000)
+        player._mixer = player.create_mixer(player.current)
+        for _ in range(250):
+            player._mixer.read()
+        self.assertAlmostEqual(player.get_current_position(), 5.0)
+
+        track = player.current.track
+        track.set_stream({'url': 'https://example.com/a?expire=9999999999'})
+        new_source = make_source('a', 10)
+        new_source.start_frame = 6000
+        with patch.object(YTDLSource, 'resolve_stream') as mock_resolve, \
+                patch.object(YTDLSource, 'open_track', AsyncMock(return_value=new_source)) as mock_open:
+            self.assertTrue(await player.seek(120))
+
+        mock_resolve.assert_not_called()
+        self.assertEqual(mock_open.call_args.kwargs['start'], 120)
+        self.assertIs(player.current, new_source)
+        player._mixer.read()
+        self.assertAlmostEqual(player.get_current_position(), 120.02)
+
+    async def test_seek_resolves_expiring_stream_url(self):
+        ctx = Mock()
+        ctx.cog.ffmpeg_profiles = {}
+        ctx.bot.loop.create_task = lambda coro: coro.close()
+        player = MusicPlayer(ctx)
+        player.current = make_source('a', 10000)
+        player._mixer = player.create_mixer(player.current)
+
+        track = player.current.track
+        track.set_stream({'url': f'https://example.com/a?expire={int(time.time()) + 5}'})
+        self.assertEqual(track.state, 'expiring')
+        with patch.object(YTDLSource, 'resolve_stream', AsyncMock()) as mock_resolve, \
+                patch.object(YTDLSource, 'open_track', AsyncMock(return_value=make_source('a', 10))):
+            self.assertTrue(await player.seek(30))
+
+        mock_resolve.assert_awaited_once()
+        self.assertIs(mock_resolve.call_args.args[0], track)
+
+
+class TestNowPlayingEmbed(unittest.TestCase):
+    def test_renders_progress_on_cached_template(self):
+        ctx = Mock()
+        ctx.bot.loop.create_task = lambda coro: coro.close()
+        player = MusicPlayer(ctx)
+        player.current = make_source('a', 10000)
+        player.current.track.requester = Mock(mention='<@1>')
+        player.current.track.duration = 200
+
+        first = player.now_playing_embed()
+        template = player._np_template
+        player.current.frames_read = 5000
+        second = player.now_playing_embed()
+
+        self.assertIs(player._np_template, template)
+        self.assertEqual(first.fields[-1].value.split('```')[-1], '0:00 / 3:20')
+        self.assertEqual(second.fields[-1].value.split('```')[-1], '1:40 / 3:20')
+        self.assertEqual([field.name for field in second.fields],
+                         ['Duration', 'Requested by', 'Uploader', 'Volume', 'Repeat', 'Queue', 'Progress'])
+
+        player.volume = player.current.volume = 0.5
+        self.assertEqual(player.now_playing_embed().fields[3].value, '50%')
+        self.assertIsNot(player._np_template, template)
+
+
+class TestNowPlayingMessage(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.channel = Mock()
+        self.message = Mock()
+        self.message.edit = AsyncMock()
+        self.message.delete = AsyncMock()
+        self.channel.send = AsyncMock(return_value=self.message)
+        self.progress = 0
+
+    def render(self):
+        return discord.Embed(title='Song', description=f'{self.progress}s')
+
+    def make(self, interval=0, bucket=None):
+        patcher = patch.object(NowPlayingMessage, 'DEBOUNCE', 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        now_playing = NowPlayingMessage(self.channel, self.render, loop=asyncio.get_running_loop(),
+                                        interval=interval, bucket=bucket or TokenBucket(100, 100))
+        self.addAsyncCleanup(now_playing.close)
+        return now_playing
+
+    async def test_coalesces_updates_into_one_message(self):
+        now_playing = self.make()
+        for _ in range(5):
+            now_playing.update()
+        await asyncio.sleep(0.05)
+        self.channel.send.assert_awaited_once()
+
+        self.progress = 10
+        now_playing.update()
+        now_playing.update()
+        await asyncio.sleep(0.05)
+        self.message.edit.assert_awaited_once()
+        self.assertEqual(self.channel.send.await_count, 1)
+
+        # Nothing changed, so nothing is edited
+        now_playing.update()
+        await asyncio.sleep(0.05)
+        self.message.edit.assert_awaited_once()
+
+    async def test_drops_ticks_when_saturated(self):
+        now_playing = self.make(interval=0.01, bucket=TokenBucket(0.001, 1))
+        now_playing.update()
+        await asyncio.sleep(0.05)
+        self.channel.send.assert_awaited_once()
+
+        dropped = music_player.now_playing_updates.value(result='dropped')
+        self.progress = 10
+        await asyncio.sleep(0.05)
+
+        self.message.edit.assert_not_awaited()
+        self.assertGreater(music_player.now_playing_updates.value(result='dropped'), dropped)
+
+    async def test_ticks_edit_progress(self):
+        now_playing = self.make(interval=0.01)
+        now_playing.update()
+        await asyncio.sleep(0.05)
+        self.progress = 10
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(self.message.edit.call_args.kwargs['embed'].description, '10s')
+
+    async def test_resends_deleted_message(self):
+        now_playing = self.make()
+        now_playing.update()
+        await asyncio.sleep(0.05)
+        self.message.edit.side_effect = discord.NotFound(Mock(status=404), 'Unknown Message')
+
+        self.progress = 10
+        now_playing.update()
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(self.channel.send.await_count, 2)
+
+    async def test_close_deletes_message(self):
+        now_playing = self.make()
+        now_playing.update()
+        await asyncio.sleep(0.05)
+
+        await now_playing.close()
+
+        self.message.delete.assert_awaited_once()
+        self.assertIsNone(now_playing.message)
+
+
+class TestGainTransformer(unittest.IsolatedAsyncioTestCase):
+    def test_unity_gain_returns_frames_untouched(self):
+        original = FakePCMSource(frames=1, sample=1234)
+        transformer = GainTransformer(original, volume=1.0)
+        frame = original.sample * (discord.opus.Encoder.FRAME_SIZE // 2)
+
+        self.assertEqual(transformer.read(), frame)
+
+    def test_volume_and_normalization_combine(self):
+        transformer = GainTransformer(FakePCMSource(frames=1, sample=1000), volume=0.5)
+        transformer.gain_db = 20 * math.log10(2)  # +6 dB doubles the level
+
+        self.assertEqual(first_sample(transformer.read()), 1000)
+
+    def test_scaling_saturates(self):
+        frame = (30000).to_bytes(2, 'little', signed=True) + (-30000).to_bytes(2, 'little', signed=True)
+        self.assertEqual(scale_pcm(frame, 2.0), (32767).to_bytes(2, 'little', signed=True)
+                         + (-32768).to_bytes(2, 'little', signed=True))
+
+    def test_scaling_attenuates(self):
+        frame = (1000).to_bytes(2, 'little', signed=True) * 4
+        self.assertEqual(first_sample(scale_pcm(frame, 0.25)), 250)
+
+    def test_rejects_opus(self):
+        opus = Mock()
+        opus.is_opus.return_value = True
+        with self.assertRaises(discord.ClientException):
+            GainTransformer(opus)
+
+    @patch('music_player.asyncio.create_subprocess_exec')
+    async def test_analyse_loudness(self, mock_exec):
+        process = Mock()
+        process.communicate = AsyncMock(return_value=(b'', b'[Parsed_volumedetect_0] mean_volume: -10.5 dB\n'))
+        mock_exec.return_value = process
+        track = Track(title='Test', webpage_url='https://example.com/watch', requester=None)
+        track.set_stream({'url': 'https://example.com/a?expire=9999999999'})
+
+        self.assertEqual(await analyse_loudness(track), -5.5)
+        self.assertIn('volumedetect', mock_exec.call_args[0])
+        self.assertAlmostEqual(track.gain, 10 ** (-5.5 / 20))
+
+    @patch('music_player.asyncio.create_subprocess_exec', side_effect=FileNotFoundError('ffmpeg'))
+    async def test_failed_analysis_is_not_repeated(self, mock_exec):
+        track = Track(title='Test', webpage_url='https://example.com/watch', requester=None)
+        track.set_stream({'url': 'https://example.com/a?expire=9999999999'})
+
+        self.assertEqual(await analyse_loudness(track), 0.0)
+        self.assertEqual(track.gain, 1.0)
+
+
+class TestExtractionCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patcher = patch.object(music_player, 'extraction_cache', ExtractionCache())
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cache_key_normalizes_youtube_urls(self):
+        expected = 'youtube:dQw4w9WgXcQ'
+        self.assertEqual(cache_key('https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=10'), expected)
+        self.assertEqual(cache_key('https://youtu.be/dQw4w9WgXcQ'), expected)
+        self.assertEqual(cache_key('https://youtube.com/shorts/dQw4w9WgXcQ'), expected)
+
+    def test_cache_key_normalizes_queries(self):
+        self.assertEqual(cache_key('  Never  Gonna Give '), cache_key('never gonna give'))
+        self.assertNotEqual(cache_key('song', flat=True), cache_key('song'))
+
+    def test_lru_eviction(self):
+        cache = ExtractionCache(maxsize=2, ttl=60, stream_ttl=60)
+        cache.put('a', {'title': 'a'})
+        cache.put('b', {'title': 'b'})
+        cache.get('a')
+        cache.put('c', {'title': 'c'})
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    async def test_ttl_expiry(self):
+        cache = ExtractionCache(maxsize=10, ttl=-1, stream_ttl=60)
+        cache.put('a', {'title': 'a'})
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual((await cache.stats())['size'], 0)
+
+    async def test_stream_ttl_is_separate(self):
+        cache = ExtractionCache(maxsize=10, ttl=60, stream_ttl=-1)
+        cache.put('a', {'title': 'a', 'url': 'https://example.com/a'})
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('a', need_stream=True))
+        stats = await cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    @patch.object(music_player.extractor_pool, 'shutdown')
+    @patch.object(music_player.extractor_pool, 'warm_up', AsyncMock())
+    async def test_opened_by_the_cog(self, mock_shutdown):
+        bot = Mock(spec=commands.Bot)
+        bot.loop = asyncio.get_running_loop()
+        cog = Music(bot)
+
+        with patch.object(music_player, 'extraction_cache', None):
+            await cog.cog_load()
+            self.assertIsInstance(music_player.extraction_cache, ExtractionCache)
+            await cog.cog_unload()
+            self.assertIsNone(music_player.extraction_cache)
+
+            # As after a failed reload, which loads the old module's cog again
+            await cog.cog_load()
+            self.assertIsInstance(music_player.extraction_cache, ExtractionCache)
+
+    def test_tracks_from_cached_info_keep_the_cached_expiry(self):
+        cache = ExtractionCache(maxsize=10, ttl=60, stream_ttl=-1)
+        cache.put('a', {'title': 'a', 'webpage_url': 'https://example.com/a', 'url': 'https://example.com/a.webm'})
+
+        track = Track.from_info(cache.get('a'), None)
+
+        self.assertIsNone(cache.get('a', need_stream=True))
+        self.assertEqual(track.state, 'expiring')
+
+    @patch('music_player.ytdl.extract_info')
+    async def test_fetch_info_is_cached(self, mock_extract):
+        mock_extract.return_value = {
+            'title': 'Test', 'webpage_url': 'https://youtu.be/dQw4w9WgXcQ',
+            'url': 'https://example.com/a', 'formats': [{}] * 100
+        }
+        loop = asyncio.get_running_loop()
+
+        first = await fetch_info('https://youtu.be/dQw4w9WgXcQ', loop=loop)
+        second = await fetch_info('https://www.youtube.com/watch?v=dQw4w9WgXcQ', loop=loop, need_stream=True)
+
+        self.assertIs(first, second)
+        self.assertNotIn('formats', first)
+        mock_extract.assert_called_once()
+
+    @patch('music_player.ytdl.extract_info')
+    async def test_search_result_aliases_video(self, mock_extract):
+        mock_extract.return_value = {'entries': [{
+            'title': 'Test', 'webpage_url': 'https://youtu.be/dQw4w9WgXcQ', 'url': 'https://example.com/a'
+        }]}
+        loop = asyncio.get_running_loop()
+
+        await fetch_info('test song', loop=loop)
+        video = await fetch_info('https://youtu.be/dQw4w9WgXcQ', loop=loop, need_stream=True)
+
+        self.assertEqual(video['title'], 'Test')
+        mock_extract.assert_called_once()
+
+
+class TestExtractWorker(unittest.TestCase):
+    @patch('music_player.ytdl.extract_info')
+    def test_extract_returns_slim_info(self, mock_extract):
+        mock_extract.return_value = {
+            'title': 'Test', 'url': 'https://example.com/a', 'formats': [{}] * 50,
+            'description': 'x' * 10000, 'automatic_captions': {'en': []}
+        }
+
+        data = music_player._extract('https://youtu.be/dQw4w9WgXcQ')
+
+        self.assertEqual(data, {'title': 'Test', 'url': 'https://example.com/a'})
+
+
+class TestPersistentExtractionCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'cache', 'extraction.sqlite3')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    async def test_entries_survive_restart(self):
+        cache = PersistentExtractionCache(self.path, maxsize=10, ttl=60, stream_ttl=60)
+        cache.put('youtube:abc', {'title': 'Test', 'url': 'https://example.com/a'})
+        cache.close()
+
+        restarted = PersistentExtractionCache(self.path, maxsize=10, ttl=60, stream_ttl=60)
+        self.assertEqual(restarted.get('youtube:abc', need_stream=True)['title'], 'Test')
+        self.assertEqual((await restarted.stats())['hits'], 1)
+        restarted.close()
+
+    async def test_expired_entries_are_not_loaded(self):
+        cache = PersistentExtractionCache(self.path, maxsize=10, ttl=-1, stream_ttl=60)
+        cache.put('youtube:abc', {'title': 'Test'})
+        cache.close()
+
+        restarted = PersistentExtractionCache(self.path, maxsize=10, ttl=60, stream_ttl=60)
+        self.assertIsNone(restarted.get('youtube:abc'))
+        self.assertEqual((await restarted.stats())['disk_size'], 0)
+        restarted.close()
+
+    async def test_async_lookup_reads_disk_off_loop(self):
+        cache = PersistentExtractionCache(self.path, maxsize=10, ttl=60, stream_ttl=60)
+        cache.put('youtube:abc', {'title': 'Test'})
+        cache.close()
+
+        restarted = PersistentExtractionCache(self.path, maxsize=10, ttl=60, stream_ttl=60)
+        loop = asyncio.get_running_loop()
+
+        with patch.object(PersistentExtractionCache, '_load', side_effect=AssertionError):
+            self.assertEqual((await restarted.get_async('youtube:abc', loop=loop))['title'], 'Test')
+        # Promoted into memory by the async read
+        self.assertEqual(restarted.get('youtube:abc')['title'], 'Test')
+        restarted.close()
+
+    async def test_stats_and_clear_run_on_the_database_thread(self):
+        cache = PersistentExtractionCache(self.path, maxsize=10, ttl=60, stream_ttl=60)
+        cache.put('youtube:abc', {'title': 'Test'})
+        threads = []
+        count_rows = cache._count_rows
+
+        def count():
+            threads.append(threading.current_thread().name)
+            return count_rows()
+
+        with patch.object(cache, '_count_rows', count):
+            self.assertEqual((await cache.stats())['disk_size'], 1)
+            await cache.clear()
+            self.assertEqual((await cache.stats())['disk_size'], 0)
+
+        self.assertTrue(all(name.startswith('extraction-cache') for name in threads))
+        cache.close()
+
+
+class TestAudioCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = AudioCache(self.tmpdir.name, max_bytes=250, min_plays=2)
+        self.tracks = make_tracks(3)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def cache_file(self, track, size=100):
+        """Stand in for a finished transcode"""
+        key = cache_key(track.webpage_url)
+        self.cache.record_play(track)
+        path = self.cache._path(key)
+        with open(path + '.part', 'wb') as file:
+            file.write(os.urandom(size))
+        self.cache._commit(key, path + '.part', path)
+        return path
+
+    def test_caches_after_enough_plays(self):
+        track = self.tracks[0]
+        self.assertFalse(self.cache.record_play(track))
+        self.assertTrue(self.cache.record_play(track))
+
+    def test_skips_live_and_local_tracks(self):
+        live = Track(title='Live', webpage_url='https://example.com/live', requester=None)
+        local = self.tracks[1]
+        local.set_local('/tmp/song.ogg')
+        for _ in range(3):
+            self.assertFalse(self.cache.record_play(live))
+            self.assertFalse(self.cache.record_play(local))
+
+    async def test_plays_from_disk(self):
+        path = self.cache_file(self.tracks[0])
+        track = Track(title='Again', webpage_url=self.tracks[0].webpage_url, requester=None)
+
+        with patch.object(music_player, 'audio_cache', self.cache):
+            self.assertTrue(await load_cached_audio(track, loop=asyncio.get_running_loop()))
+
+        self.assertEqual(track.stream_url, path)
+        self.assertEqual(track.state, 'resolved')
+        self.assertEqual(track.codec, 'opus')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_drops_damaged_files(self):
+        path = self.cache_file(self.tracks[0])
+        self.cache._verified.clear()  # As after a restart
+        with open(path, 'r+b') as file:
+            file.write(b'garbage')
+
+        with self.assertLogs('discord_bot.music', 'WARNING'):
+            self.assertIsNone(self.cache.lookup(self.tracks[0].webpage_url))
+        self.assertFalse(os.path.exists(path))
+
+    def test_evicts_least_recently_played(self):
+        first = self.cache_file(self.tracks[0])
+        second = self.cache_file(self.tracks[1])
+        self.cache.lookup(self.tracks[0].webpage_url)
+        self.cache_file(self.tracks[2])
+
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertEqual(self.cache.stats()['bytes'], 200)
+
+    def test_concurrent_transcodes_keep_the_first_file(self):
+        # Another process of a cluster sharing the directory
+        other = AudioCache(self.tmpdir.name, max_bytes=250, min_plays=2)
+        self.addCleanup(other.close)
+        track = self.tracks[0]
+        key = cache_key(track.webpage_url)
+        self.cache.record_play(track)
+        path = self.cache._path(key)
+
+        parts = []
+        for cache, content in ((self.cache, b'first'), (other, b'second')):
+            part = os.path.join(self.tmpdir.name, f'{content.decode()}.part')
+            with open(part, 'wb') as file:
+                file.write(content)
+            cache._commit(key, part, path)
+            parts.append(part)
+
+        with open(path, 'rb') as file:
+            self.assertEqual(file.read(), b'first')
+        self.assertFalse(any(os.path.exists(part) for part in parts))
+        self.assertEqual(other.lookup(track.webpage_url), path)
+
+    def test_restart_removes_leftovers(self):
+        path = self.cache_file(self.tracks[0])
+        stale = time.time() - AudioCache.STALE_SECONDS - 1
+        for name in ('stray.ogg.part', 'stray.ogg', 'running.ogg.part'):
+            with open(os.path.join(self.tmpdir.name, name), 'wb'):
+                pass
+            if name.startswith('stray'):
+                os.utime(os.path.join(self.tmpdir.name, name), (stale, stale))
+        self.cache.close()
+
+        self.cache = AudioCache(self.tmpdir.name, max_bytes=250, min_plays=2)
+
+        files = os.listdir(self.tmpdir.name)
+        self.assertIn(os.path.basename(path), files)
+        self.assertNotIn('stray.ogg.part', files)
+        self.assertNotIn('stray.ogg', files)
+        # May still be written by a transcode in another process
+        self.assertIn('running.ogg.part', files)
+        self.assertEqual(self.cache.lookup(self.tracks[0].webpage_url), path)
+
+    async def test_close_waits_for_background_work(self):
+        track = self.tracks[0]
+        started = asyncio.Event()
+
+        async def transcode(track):
+            started.set()
+            await asyncio.sleep(60)
+
+        with patch.object(self.cache, 'store', side_effect=transcode) as store:
+            self.cache.played(track, loop=asyncio.get_running_loop())
+            self.cache.played(track, loop=asyncio.get_running_loop())
+            await asyncio.wait_for(started.wait(), 5)
+
+            await self.cache.aclose()
+
+        store.assert_called_once_with(track)
+        self.assertEqual(self.cache._tasks, set())
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patcher = patch.object(music_player, 'extraction_cache', ExtractionCache())
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_concurrent_identical_lookups_share_one_extraction(self):
+        flights = SingleFlight()
+        calls = []
+
+        async def lookup():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {'title': 'Test'}
+
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(flights.do('key', lookup, loop=loop) for _ in range(5)))
+
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(flights.stats(), {'inflight': 0, 'started': 1, 'coalesced': 4})
+
+    async def test_cancelled_waiter_does_not_cancel_others(self):
+        flights = SingleFlight()
+
+        async def lookup():
+            await asyncio.sleep(0.01)
+            return 'done'
+
+        loop = asyncio.get_running_loop()
+        first = asyncio.create_task(flights.do('key', lookup, loop=loop))
+        second = asyncio.create_task(flights.do('key', lookup, loop=loop))
+        await asyncio.sleep(0)
+        first.cancel()
+
+        self.assertEqual(await second, 'done')
+
+    @patch('music_player.ytdl.extract_info')
+    async def test_fetch_info_coalesces(self, mock_extract):
+        def slow_extract(*args, **kwargs):
+            time.sleep(0.05)
+            return {'title': 'Test', 'url': 'https://example.com/a'}
+        mock_extract.side_effect = slow_extract
+        loop = asyncio.get_running_loop()
+
+        await asyncio.gather(*(fetch_info('https://youtu.be/dQw4w9WgXcQ', loop=loop, guild_id=guild)
+                               for guild in range(10)))
+
+        mock_extract.assert_called_once()
+
+
+class TestExtractorPool(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        self.pool.shutdown()
+
+    async def test_guilds_are_served_round_robin(self):
+        self.pool = ExtractorPool(workers=1, backend='thread', max_pending=10, max_pending_per_guild=10)
+        order = []
+
+        jobs = [asyncio.create_task(self.pool.run(order.append, name, guild_id=guild))
+                for guild, name in [(1, 'a1'), (1, 'a2'), (1, 'a3'), (2, 'b1')]]
+        await asyncio.gather(*jobs)
+
+        self.assertLess(order.index('b1'), order.index('a3'))
+        self.assertEqual(self.pool.stats()['completed'], 4)
+
+    async def test_per_guild_limit_rejects(self):
+        self.pool = ExtractorPool(workers=1, backend='thread', max_pending=10, max_pending_per_guild=1)
+        release = threading.Event()
+
+        running = asyncio.create_task(self.pool.run(release.wait, guild_id=1))
+        queued = asyncio.create_task(self.pool.run(len, 'x', guild_id=1))
+        await asyncio.sleep(0)
+
+        with self.assertRaises(ExtractorBusy):
+            await self.pool.run(len, 'y', guild_id=1)
+        self.assertEqual(self.pool.stats()['rejected'], 1)
+
+        release.set()
+        await asyncio.gather(running, queued)
+
+    async def test_process_backend(self):
+        self.pool = ExtractorPool(workers=1, backend='process')
+        await self.pool.warm_up()
+
+        self.assertEqual(await self.pool.run(divmod, 7, 2), (3, 1))
+
+    async def test_exceptions_reach_the_caller(self):
+        self.pool = ExtractorPool(workers=2, backend='thread')
+
+        with self.assertRaises(ZeroDivisionError):
+            await self.pool.run(divmod, 1, 0)
+        self.assertEqual(self.pool.stats()['running'], 0)
+
+
 class TestMusicPlayerIntegration(unittest.TestCase):
     def setUp(self):
         self.loop = asyncio.new_event_loop()
@@ -0,0 +1,144 @@
+import unittest
+import asyncio
+import sys
+import os
+from unittest.mock import AsyncMock, Mock, patch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import outbound
+from outbound import HIGH, LOW, OutboundQueue, TokenBucket
+
+
+def make_channel(channel_id):
+    channel = Mock(id=channel_id)
+    channel.send = AsyncMock(side_effect=lambda **kwargs: make_message(channel))
+    return channel
+
+
+def make_message(channel):
+    message = Mock(channel=channel)
+    message.edit = AsyncMock(return_value=message)
+    message.delete = AsyncMock()
+    message.add_reaction = AsyncMock()
+    message.clear_reactions = AsyncMock()
+    return message
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=1, burst=2)
+
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        self.assertGreater(bucket.wait_time(), 0.9)
+
+
+class TestOutboundQueue(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.queue = OutboundQueue(rate=100)
+        self.channel = make_channel(1)
+
+    async def asyncTearDown(self):
+        self.queue.close()
+
+    async def test_send_replaces_reusable_delete(self):
+        processing = make_message(self.channel)
+
+        deleted = self.queue.delete(processing)
+        message = await self.queue.send(self.channel, embed='added', reuse=processing)
+
+        self.assertIs(message, processing)
+        processing.edit.assert_awaited_once_with(embed='added', content=None)
+        processing.delete.assert_not_awaited()
+        self.channel.send.assert_not_awaited()
+        self.assertIsNone(await deleted)
+
+    async def test_send_keeps_plain_delete(self):
+        old = make_message(self.channel)
+
+        deleted = self.queue.delete(old)
+        await self.queue.send(self.channel, 'hello')
+        await deleted
+
+        old.delete.assert_awaited_once()
+        self.channel.send.assert_awaited_once_with(content='hello')
+
+    async def test_send_only_reuses_the_named_message(self):
+        now_playing, processing = make_message(self.channel), make_message(self.channel)
+
+        deletes = [self.queue.delete(now_playing), self.queue.delete(processing)]
+        message = await self.queue.send(self.channel, 'added', reuse=processing)
+        await asyncio.gather(*deletes)
+
+        self.assertIs(message, processing)
+        now_playing.delete.assert_awaited_once()
+        processing.delete.assert_not_awaited()
+
+    async def test_merges_edits_of_one_message(self):
+        message = make_message(self.channel)
+
+        first = self.queue.edit(message, content='a', priority=LOW)
+        second = self.queue.edit(message, embed='b', priority=HIGH)
+        self.assertEqual(self.queue.stats(), {'high': 1, 'normal': 0, 'low': 0})
+        await asyncio.gather(first, second)
+
+        message.edit.assert_awaited_once_with(content='a', embed='b')
+        self.assertEqual(self.queue.stats(), {'high': 0, 'normal': 0, 'low': 0})
+
+    async def test_runs_replies_first(self):
+        calls = []
+        background = make_message(self.channel)
+        background.delete.side_effect = lambda: calls.append('delete')
+        self.channel.send.side_effect = lambda **kwargs: calls.append('send')
+
+        await asyncio.gather(self.queue.delete(background), self.queue.send(self.channel, 'reply', priority=HIGH))
+
+        self.assertEqual(calls, ['send', 'delete'])
+
+    async def test_channel_budget_does_not_hold_up_other_channels(self):
+        queue = OutboundQueue(rate=100, channel_rate=0.01, channel_burst=1)
+        self.addCleanup(queue.close)
+        other = make_channel(2)
+
+        queue.send(self.channel, 'first')
+        waiting = queue.send(self.channel, 'second')
+        await queue.send(other, 'elsewhere')
+
+        self.assertEqual(self.channel.send.await_count, 1)
+        self.assertFalse(waiting.done())
+        self.assertEqual(queue.stats()['normal'], 1)
+
+    async def test_adds_reactions_in_one_job(self):
+        message = make_message(self.channel)
+
+        with patch.object(outbound, 'REACTION_INTERVAL', 0):
+            await self.queue.add_reactions(message, ['1️⃣', '2️⃣', '3️⃣'])
+
+        self.assertEqual([call.args[0] for call in message.add_reaction.await_args_list], ['1️⃣', '2️⃣', '3️⃣'])
+
+    async def test_clearing_stops_reactions_being_added(self):
+        message = make_message(self.channel)
+        calls = []
+        message.add_reaction.side_effect = lambda emoji: calls.append(emoji)
+        message.clear_reactions.side_effect = lambda: calls.append('clear')
+
+        with patch.object(outbound, 'REACTION_INTERVAL', 0.05):
+            adding = self.queue.add_reactions(message, ['1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣'])
+            while not calls:
+                await asyncio.sleep(0)
+            await self.queue.clear_reactions(message)
+
+        self.assertTrue(adding.cancelled())
+        self.assertEqual(calls[-1], 'clear')
+        self.assertLess(len(calls), 6)
+
+    async def test_failures_reach_the_caller(self):
+        self.channel.send.side_effect = RuntimeError('forbidden')
+
+        with self.assertRaises(RuntimeError):
+            await self.queue.send(self.channel, 'hello')
+
+
+if __name__ == '__main__':
+    unittest.main()